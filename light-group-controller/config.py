@@ -6,24 +6,93 @@ ENCODER_SW_PIN = 14
 # Connection settings
 WIFI_RETRY_COUNT = 3
 WIFI_MAX_WAIT = 20  # seconds
+WIFI_POLL_MS = 20  # interval between link status checks while joining
+WIFI_FAST_JOIN_TIMEOUT_MS = 3000  # give up on the cached BSSID/static IP join after this long
+WIFI_CACHE_FILE = 'wifi_cache.json'  # last good BSSID and IP settings for fast rejoin
+WIFI_STATIC_IP_MAX_MS = 60000  # time after a fast join before rejoining with DHCP; the cached IP is only borrowed until then
+WIFI_CHECK_MS = 2000  # interval between link checks while connected
+WIFI_RECONNECT_MIN_MS = 1000  # first backoff delay between background rejoins
+WIFI_RECONNECT_MAX_MS = 60000  # cap on the background rejoin backoff delay
+WIFI_MAX_OUTAGE_S = 1800  # reboot after the link has been down this long (0 never reboots)
+MQTT_PORT = 1883
 MQTT_KEEPALIVE = 60  # seconds
+MQTT_DNS_TTL_S = 3600  # seconds a resolved broker address is reused before resolving again
+MQTT_ADDR_CACHE_FILE = 'broker_addr.json'  # last working broker address, used to skip DNS at boot
+MQTT_CLEAN_SESSION = False  # keep subscriptions and queued messages across reconnects
+MQTT_COMMAND_QOS = 1  # QoS for outgoing commands
+MQTT_SUBSCRIBE_QOS = 1  # QoS for state updates, so the broker queues them while we're away
+MQTT_INFLIGHT_WINDOW = 4  # unacknowledged QoS 1 commands allowed at once
+MQTT_ROUTE_CACHE_SIZE = 16  # topics remembered after matching a wildcard subscription
+MQTT_ECHO_SLOTS = 4  # recently sent states remembered for echo suppression
+MQTT_ECHO_TIMEOUT_MS = 5000  # how long a sent state may take to be echoed back
+MQTT_ECHO_TEMP_TOLERANCE = 2  # mireds HA may shift color_temp by (kelvin rounding)
+MQTT_ECHO_BRIGHTNESS_TOLERANCE = 2  # brightness levels HA may shift by (percent rounding)
+MQTT_SOCKET_TIMEOUT = 5  # seconds a blocking socket call may take once connected
+MQTT_CONNECT_TIMEOUT_MS = 10000  # give up on a connection attempt after this long
+MQTT_RECONNECT_MIN_MS = 1000  # first reconnect backoff delay
+MQTT_RECONNECT_MAX_MS = 60000  # cap on the reconnect backoff delay
+MQTT_RX_BUFFER_SIZE = 1024  # bytes preallocated for incoming messages (0 allocates per message)
+MQTT_TX_BUFFER_SIZE = 256  # bytes preallocated to send each packet in one write (0 writes per field)
 
 # Encoder settings
+ENCODER_MODE = 'irq'  # 'poll' samples CLK in the main loop, 'irq' decodes every edge, 'pio' decodes in PIO
+ENCODER_PIO_SM = 0  # state machine used by 'pio' mode
+ENCODER_RING_SIZE = 32  # detents buffered between checks (power of two)
 DOUBLE_PRESS_TIMEOUT_MS = 400  # Maximum time between presses to count as double press
+LONG_PRESS_MS = 800  # hold time that selects the next light group
 
 # Performance settings
 BATCH_DELAY_MS = 100  # milliseconds to wait before sending batched updates 
+BATCH_DELAY_MIN_MS = 50  # lower bound when adapting the batch delay to round-trip time
+BATCH_DELAY_MAX_MS = 400  # upper bound when adapting the batch delay to round-trip time
+OFFLINE_RECONCILE_MS = 500  # wait after reconnecting for HA's state before sending offline changes
+OFFLINE_JOURNAL_MAX_AGE_MS = 600000  # offline changes older than this lose to HA's state
+MQTT_POLL_MS = 50  # interval between checks while a broker connection is being opened
+MQTT_FLUSH_MS = 50  # minimum interval between sends of queued MQTT messages
+LED_BLINK_MS = 500  # LED blink period while disconnected
+LED_PREVIEW_MS = 120  # LED flash length when previewing a scene
+
+# Power settings
+POWER_CHECK_MS = 200  # interval between idle checks, and time awake between lightsleeps
+POWERSAVE_AFTER_MS = 10000  # idle time before the radio enters power-save
+LIGHTSLEEP_AFTER_MS = 30000  # idle time before lightsleeping between wakes (None never sleeps)
+LIGHTSLEEP_MAX_MS = 10000  # longest single lightsleep; keep well below MQTT_KEEPALIVE / 2
+# Estimated average current per power state, for the battery life estimate
+CURRENT_ACTIVE_MA = 45
+CURRENT_POWERSAVE_MA = 18
+CURRENT_SLEEP_MA = 4
+BATTERY_MAH = 800
+DORMANT_AFTER_MS = 7200000  # idle time before deep sleeping until the switch is pressed (None never)
+DORMANT_SNAPSHOT_FILE = 'dormant.json'  # LightState saved across a dormant deep sleep
 
 # Light settings
 DEFAULT_COLOR_TEMP = 370
 MIN_COLOR_TEMP = 200
 MAX_COLOR_TEMP = 454
 COLOR_TEMP_STEP = 5
+# Rotation acceleration: (max ms between detents, step multiplier), fastest first
+COLOR_TEMP_ACCEL_CURVE = ((30, 10), (60, 4), (120, 2))
+
+# Brightness levels (1-255) a detent steps between in brightness mode:
+# 255 * (i / 24) ** 2.2, so low levels are fine and high levels coarse
+BRIGHTNESS_STEPS = (1, 3, 5, 8, 12, 17, 23, 29, 37, 46, 55, 66, 78, 91, 105, 119, 135, 153, 171, 190, 211, 232, 255)
 
 # Scene settings
 AVAILABLE_SCENES = ['scene.bright_day', 'scene.warm_evening', 'scene.warmest_night', 'scene.tv_time']
+SCENE_SETTLE_MS = 700  # idle time before a previewed scene is activated (None activates on every detent)
+
+# Light groups the knob can control: (name, base topic). Each group uses
+# <base>/temp/state, /temp/set, /scene/set, /scene/state and /availability;
+# a long press selects the next group
+LIGHT_GROUPS = (
+    ('living_room_lamps', 'home/living_room_lamps'),
+)
 
 # MQTT Topics
-MQTT_TOPIC_STATE = 'home/living_room_lamps/temp/state'
-MQTT_TOPIC_SET = 'home/living_room_lamps/temp/set'
-MQTT_TOPIC_SCENE_SET = 'home/living_room_lamps/scene/set'
+MQTT_TOPIC_SET = 'home/living_room_lamps/temp/set'  # default state command topic without a group
+MQTT_TOPIC_SCENE_SET = 'home/living_room_lamps/scene/set'  # default scene command topic without a group
+CONTROLLER_BASE_TOPIC = 'home/light_controller'  # topics about the controller itself, not a light group
+MQTT_TOPIC_CONFIG = CONTROLLER_BASE_TOPIC + '/config/+'
+
+# Settings that may be changed over MQTT_TOPIC_CONFIG (LightState attributes)
+REMOTE_CONFIG_KEYS = ('batch_delay_min_ms', 'batch_delay_max_ms', 'scene_settle_ms')
@@ -1,10 +1,129 @@
 from machine import Pin
+from array import array
 import time
-from config import DOUBLE_PRESS_TIMEOUT_MS
+from config import DOUBLE_PRESS_TIMEOUT_MS, LONG_PRESS_MS
+
+try:
+    import rp2
+except ImportError:
+    rp2 = None  # PIO backend only exists on RP2040/RP2350
+
+# Quadrature transition table indexed by (previous_state << 2) | state, where
+# state is (clk << 1) | dt. Valid Gray-code moves give +1/-1; no change and
+# invalid two-bit jumps (missed edges or bounce) give 0.
+TRANSITIONS = array('b', (0, -1, 1, 0, 1, 0, 0, -1, -1, 0, 0, 1, 0, 1, -1, 0))
+
+# Both pins are pulled high when the encoder rests on a detent
+REST_STATE = 0b11
+
+if rp2:
+    # Quadrature decoder running entirely in a PIO state machine. The first
+    # 15 instructions are a jump table indexed like TRANSITIONS, so the
+    # program is padded to 32 instructions to force it to load at offset 0.
+    # Y holds the position count and is pushed to the RX FIFO every pass.
+    @rp2.asm_pio(in_shiftdir=rp2.PIO.SHIFT_LEFT, out_shiftdir=rp2.PIO.SHIFT_RIGHT)
+    def quadrature_pio():
+        jmp("update")     # 00 -> 00
+        jmp("decrement")  # 00 -> 01
+        jmp("increment")  # 00 -> 10
+        jmp("update")     # 00 -> 11 (invalid)
+        jmp("increment")  # 01 -> 00
+        jmp("update")     # 01 -> 01
+        jmp("update")     # 01 -> 10 (invalid)
+        jmp("decrement")  # 01 -> 11
+        jmp("decrement")  # 10 -> 00
+        jmp("update")     # 10 -> 01 (invalid)
+        jmp("update")     # 10 -> 10
+        jmp("increment")  # 10 -> 11
+        jmp("update")     # 11 -> 00 (invalid)
+        jmp("increment")  # 11 -> 01
+        jmp("decrement")  # 11 -> 10
+        label("update")   # 11 -> 11
+        mov(isr, y)
+        push(noblock)
+        out(isr, 2)       # previous state from the saved index
+        in_(pins, 2)      # append current state
+        mov(osr, isr)
+        mov(pc, isr)
+        label("decrement")
+        jmp(y_dec, "changed")
+        label("changed")
+        irq(rel(0))       # wake Python; the count itself needs no CPU
+        jmp("update")
+        label("increment")
+        mov(y, invert(y))
+        jmp(y_dec, "increment_done")
+        label("increment_done")
+        mov(y, invert(y))
+        jmp("changed")
+        nop()
+        nop()
+        nop()
+        nop()
+
+class StepRing:
+    def __init__(self, size=32):
+        """Initialize a fixed-size ring of signed step deltas and their times.
+        
+        Written from the pin IRQ and read from check(), so it must never
+        allocate after construction. One slot is kept free to tell full from empty.
+        
+        Args:
+            size: Number of slots, must be a power of two
+        """
+        self.buf = array('b', bytes(size))
+        self.times = array('i', [0] * size)
+        self.time = 0  # ticks_ms of the step last popped
+        self.mask = size - 1
+        self.head = 0  # Only written by the producer (IRQ)
+        self.tail = 0  # Only written by the consumer (check)
+        self.dropped = 0
+    
+    def push(self, delta, ticks):
+        """Append a step delta made at ticks (ms), dropping it if the ring is full."""
+        head = self.head
+        nxt = (head + 1) & self.mask
+        if nxt == self.tail:
+            self.dropped += 1
+            return
+        self.buf[head] = delta
+        self.times[head] = ticks
+        self.head = nxt
+    
+    def pop(self):
+        """Remove and return the oldest step delta, or 0 if the ring is empty.
+        
+        The step's time is left in self.time.
+        """
+        tail = self.tail
+        if tail == self.head:
+            return 0
+        delta = self.buf[tail]
+        self.time = self.times[tail]
+        self.tail = (tail + 1) & self.mask
+        return delta
 
 class RotaryEncoder:
-    def __init__(self, clk_pin, dt_pin, sw_pin, on_rotate=None, on_press=None, on_double_press=None):
-        """Initialize the rotary encoder with the specified pins and callbacks."""
+    # Rotation decoding modes
+    POLL_MODE = 'poll'
+    IRQ_MODE = 'irq'
+    PIO_MODE = 'pio'
+    
+    def __init__(self, clk_pin, dt_pin, sw_pin, on_rotate=None, on_press=None, on_double_press=None, mode=POLL_MODE, ring_size=32, pio_sm=0, on_long_press=None):
+        """Initialize the rotary encoder with the specified pins and callbacks.
+        
+        Args:
+            on_rotate: Callback per detent (receives direction(int) and the
+                ticks_ms it was turned at, which may be before the call)
+            on_long_press: Callback for a press held LONG_PRESS_MS; when set,
+                a single press only fires once the switch is released
+            mode: POLL_MODE samples CLK in check(); IRQ_MODE decodes every
+                CLK/DT edge in a pin IRQ and queues detents for check();
+                PIO_MODE counts edges in a PIO state machine (CLK and DT
+                must be adjacent GPIOs)
+            ring_size: Slots in the IRQ step ring (power of two)
+            pio_sm: State machine ID used by PIO_MODE
+        """
         self.clk = Pin(clk_pin, Pin.IN, Pin.PULL_UP)
         self.dt = Pin(dt_pin, Pin.IN, Pin.PULL_UP)
         self.sw = Pin(sw_pin, Pin.IN, Pin.PULL_UP)
@@ -15,24 +134,150 @@ class RotaryEncoder:
         self.on_rotate = on_rotate
         self.on_press = on_press
         self.on_double_press = on_double_press
+        self.on_long_press = on_long_press
         
         # Double press detection
         self.last_press_time = 0
         self.press_count = 0
         self.pending_single_press = False
         self.pending_press_time = 0
+        
+        # Long press detection; armed while the switch is held
+        self.long_press_armed = False
+        
+        # IRQ decoding state
+        self.mode = mode
+        self.ring = None
+        self.sm = None
+        self._wake = None
+        if mode == self.IRQ_MODE:
+            self.ring = StepRing(ring_size)
+            self.quad_state = (self.clk.value() << 1) | self.dt.value()
+            self.quad_count = 0
+            # Bind once so the IRQ handler never allocates a bound method
+            self._edge_handler = self._on_edge
+            trigger = Pin.IRQ_FALLING | Pin.IRQ_RISING
+            self.clk.irq(handler=self._edge_handler, trigger=trigger, hard=True)
+            self.dt.irq(handler=self._edge_handler, trigger=trigger, hard=True)
+        elif mode == self.PIO_MODE:
+            self._start_pio(clk_pin, dt_pin, pio_sm)
     
-    def check(self):
-        """Check for rotation or button press events."""
-        current_time = time.ticks_ms()
+    def _start_pio(self, clk_pin, dt_pin, sm_id):
+        """Load the quadrature program and start counting."""
+        if rp2 is None:
+            raise ValueError("PIO encoder mode requires an RP2 port")
+        if abs(clk_pin - dt_pin) != 1:
+            raise ValueError("PIO encoder mode requires adjacent CLK and DT pins")
+        # The program reads two pins from in_base; TRANSITIONS expects CLK as
+        # the high bit, so a CLK below DT reverses the direction
+        self.pio_sign = 1 if clk_pin > dt_pin else -1
+        self.sm = rp2.StateMachine(sm_id, quadrature_pio, in_base=Pin(min(clk_pin, dt_pin)))
+        self.sm.active(1)
+        self.pio_position = self._read_pio_position()
+        self.pio_read_time = time.ticks_ms()
+    
+    def _on_edge(self, pin):
+        """Decode a CLK/DT edge and queue a step whenever a detent is reached."""
+        state = (self.clk.value() << 1) | self.dt.value()
+        count = self.quad_count + TRANSITIONS[(self.quad_state << 2) | state]
+        self.quad_state = state
+        if state == REST_STATE:
+            # A detent is four transitions; tolerate one lost to bounce
+            if count > 1:
+                self.ring.push(1, time.ticks_ms())
+            elif count < -1:
+                self.ring.push(-1, time.ticks_ms())
+            count = 0
+        self.quad_count = count
+        if self._wake:
+            self._wake(pin)
+    
+    def attach_irq(self, handler):
+        """Register a handler called from pin IRQs on any CLK or switch edge.
+        
+        Args:
+            handler: Called with the pin that fired; must not allocate
+        """
+        trigger = Pin.IRQ_FALLING | Pin.IRQ_RISING
+        if self.ring is None:
+            if self.sm is None:
+                self.clk.irq(handler=handler, trigger=trigger)
+        else:
+            # The decoder owns the CLK/DT IRQs and forwards to the handler
+            self._wake = handler
+        if self.sm is not None:
+            self.sm.irq(handler)
+        self.sw.irq(handler=handler, trigger=trigger)
+    
+    def prepare_dormant(self):
+        """Stop rotation decoding so only the switch IRQ wakes a deep sleep."""
+        if self.sm is not None:
+            self.sm.active(0)
+            self.sm.irq(None)
+        self.clk.irq(handler=None)
+        self.dt.irq(handler=None)
+    
+    def next_deadline_ms(self):
+        """Return ms until a pending press fires, or None if nothing is pending."""
+        elapsed = time.ticks_diff(time.ticks_ms(), self.pending_press_time)
+        if self.long_press_armed:
+            # A held switch fires either the long press or nothing until release
+            return max(0, LONG_PRESS_MS - elapsed)
+        if not self.pending_single_press:
+            return None
+        return max(0, DOUBLE_PRESS_TIMEOUT_MS - elapsed)
+    
+    def _read_pio_position(self):
+        """Return the PIO position in detents, modulo 2**30."""
+        sm = self.sm
+        # The program pushes every pass; drop stale values and take a fresh one
+        for _ in range(sm.rx_fifo()):
+            sm.get()
+        # Four transitions per detent; shifting also keeps the value a small int
+        return sm.get(None, 2)
+    
+    def _check_rotation(self):
+        """Deliver rotation events to the callback."""
+        if self.sm is not None:
+            position = self._read_pio_position()
+            delta = (position - self.pio_position) & 0x3FFFFFFF
+            if delta & 0x20000000:
+                delta -= 0x40000000
+            self.pio_position = position
+            direction = self.pio_sign if delta > 0 else -self.pio_sign
+            # The counter has no per-detent times; spread the detents over
+            # the time since the last read
+            now = time.ticks_ms()
+            elapsed = time.ticks_diff(now, self.pio_read_time)
+            self.pio_read_time = now
+            count = abs(delta)
+            for i in range(1, count + 1):
+                if self.on_rotate:
+                    self.on_rotate(direction, time.ticks_add(now, (i - count) * elapsed // count))
+            return
+        
+        if self.ring is not None:
+            # Drain every detent queued by the IRQ since the last check
+            direction = self.ring.pop()
+            while direction:
+                if self.on_rotate:
+                    self.on_rotate(direction, self.ring.time)
+                direction = self.ring.pop()
+            return
         
-        # Check for rotation
         current_clk = self.clk.value()
         if self.last_clk and not current_clk:
             direction = 1 if self.dt.value() != current_clk else -1
             if self.on_rotate:
-                self.on_rotate(direction)
+                self.on_rotate(direction, time.ticks_ms())
         self.last_clk = current_clk
+    
+    def check(self):
+        """Check for rotation or button press events."""
+        current_time = time.ticks_ms()
+        
+        # Check for rotation
+        self._check_rotation()
         
         # Check for button press
         current_sw = self.sw.value()
@@ -50,11 +295,24 @@ class RotaryEncoder:
                 self.press_count = 1
                 self.pending_single_press = True
                 self.pending_press_time = current_time
+                self.long_press_armed = self.on_long_press is not None
             
             self.last_press_time = current_time
-            
+        elif current_sw:
+            # Released before the long press time
+            self.long_press_armed = False
+        
         self.last_sw = current_sw
         
+        if self.long_press_armed:
+            if time.ticks_diff(current_time, self.pending_press_time) >= LONG_PRESS_MS:
+                # A long press replaces the single press
+                self.long_press_armed = False
+                self.pending_single_press = False
+                self.press_count = 0
+                self.on_long_press()
+            return
+        
         # Check if pending single press should be executed
         if self.pending_single_press:
             time_since_press = time.ticks_diff(current_time, self.pending_press_time)
@@ -62,4 +320,4 @@ class RotaryEncoder:
                 if self.on_press:
                     self.on_press()
                 self.pending_single_press = False
-                self.press_count = 0 
\ No newline at end of file
+                self.press_count = 0
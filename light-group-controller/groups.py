@@ -0,0 +1,151 @@
+from config import AVAILABLE_SCENES
+
+# Topics of a group, relative to its base topic
+STATE_SUFFIX = '/temp/state'
+COMMAND_SUFFIX = '/temp/set'
+SCENE_COMMAND_SUFFIX = '/scene/set'
+SCENE_STATE_SUFFIX = '/scene/state'
+AVAILABILITY_SUFFIX = '/availability'
+
+class LightGroup:
+    # Fixed attributes keep each group to a few words of heap
+    __slots__ = ('name', 'base_topic', 'command_topic', 'scene_command_topic',
+                 'on', 'color_temp', 'brightness', 'scene_index', 'confirmed_state', 'available')
+    
+    def __init__(self, name, base_topic, default_temp, default_brightness):
+        """Initialize a light group that isn't being controlled yet.
+        
+        Args:
+            name: Name shown in logs
+            base_topic: Topic prefix for the group's state and command topics
+            default_temp: Color temperature until HA reports the group's state
+            default_brightness: Brightness until HA reports the group's state,
+                or None to leave it out of commands until then
+        """
+        self.name = name
+        self.base_topic = base_topic
+        # Published on every command, so kept encoded
+        self.command_topic = (base_topic + COMMAND_SUFFIX).encode()
+        self.scene_command_topic = (base_topic + SCENE_COMMAND_SUFFIX).encode()
+        self.on = True
+        self.color_temp = default_temp
+        self.brightness = default_brightness
+        self.scene_index = 0
+        self.confirmed_state = None
+        self.available = True
+
+class GroupRegistry:
+    def __init__(self, groups, light_state, on_change=None):
+        """Initialize the registry of light groups driven by one knob.
+        
+        The active group's state lives in light_state; the others only keep
+        what HA last reported in their LightGroup.
+        
+        Args:
+            groups: (name, base topic) pairs
+            light_state: LightState the knob drives
+            on_change: Callback when the active group, or its availability,
+                changes (receives index(int), group(LightGroup))
+        """
+        self.light_state = light_state
+        self.on_change = on_change
+        self.groups = [LightGroup(name, base_topic, light_state.color_temp, None) for name, base_topic in groups]
+        self.active = 0
+        self.mqtt = None
+    
+    def active_group(self):
+        """Return the group the knob currently controls."""
+        return self.groups[self.active]
+    
+    def attach(self, mqtt):
+        """Register every group's topics on the shared MQTT connection."""
+        self.mqtt = mqtt
+        for index in range(len(self.groups)):
+            self._attach_group(mqtt, index)
+    
+    def _attach_group(self, mqtt, index):
+        """Register one group's topics with handlers bound to its index."""
+        group = self.groups[index]
+        mqtt.add_light(
+            group.base_topic + STATE_SUFFIX,
+            group.command_topic,
+            on_update=lambda on_state, color_temp, brightness: self._on_update(index, on_state, color_temp, brightness),
+            on_confirm=lambda on_state, color_temp, brightness: self._on_confirm(index, on_state, color_temp, brightness),
+            scene_state_topic=group.base_topic + SCENE_STATE_SUFFIX,
+            on_scene_update=lambda scene_name: self._on_scene_update(index, scene_name),
+            availability_topic=group.base_topic + AVAILABILITY_SUFFIX,
+            on_availability=lambda available: self._on_availability(index, available)
+        )
+    
+    def _on_update(self, index, on_state, color_temp, brightness):
+        """Apply a state report to the active LightState or the idle group."""
+        if index == self.active:
+            if self.light_state.update_from_external(on_state, color_temp, brightness):
+                print("HA State updated →", self.groups[index].name, "led_on:", on_state, "color_temp:", color_temp, "brightness:", brightness)
+            return
+        group = self.groups[index]
+        light_state = self.light_state
+        group.on = on_state
+        group.color_temp = max(light_state.min_temp, min(light_state.max_temp, color_temp))
+        if brightness is not None:
+            group.brightness = max(1, min(255, brightness))
+        group.confirmed_state = (group.on, group.color_temp, group.brightness)
+    
+    def _on_confirm(self, index, on_state, color_temp, brightness):
+        """Apply the echo of a sent state."""
+        if index == self.active:
+            self.light_state.confirm(on_state, color_temp, brightness)
+        else:
+            self.groups[index].confirmed_state = (on_state, color_temp, brightness)
+    
+    def _on_scene_update(self, index, scene_name):
+        """Apply a scene activated elsewhere."""
+        if index == self.active:
+            if self.light_state.update_scene_from_external(scene_name):
+                print("HA scene updated →", self.groups[index].name, scene_name)
+        elif scene_name in AVAILABLE_SCENES:
+            self.groups[index].scene_index = AVAILABLE_SCENES.index(scene_name)
+    
+    def _on_availability(self, index, available):
+        """Apply an availability report."""
+        if index == self.active:
+            if self.light_state.set_available(available):
+                print("HA availability →", self.groups[index].name, available)
+                if self.on_change:
+                    self.on_change(index, self.groups[index])
+        else:
+            self.groups[index].available = available
+    
+    def select(self, index):
+        """Hand the knob to another group, settling the current one first."""
+        index %= len(self.groups)
+        if index == self.active:
+            return self.groups[index]
+        light_state = self.light_state
+        group = self.groups[self.active]
+        
+        # Send whatever is still batched or previewed for the current group
+        light_state.flush()
+        on_state, color_temp, brightness = light_state.current_state()
+        if light_state.journal and self.mqtt:
+            # Offline changes can't be reconciled after switching away, so
+            # leave them queued for when the link is back
+            self.mqtt.publish_state(on_state, color_temp, brightness, group.command_topic)
+        group.on = on_state
+        group.color_temp = color_temp
+        group.brightness = brightness
+        group.scene_index = light_state.current_scene_index
+        group.confirmed_state = light_state.confirmed_state
+        group.available = light_state.available
+        
+        self.active = index
+        group = self.groups[index]
+        light_state.load_group(group.on, group.color_temp, group.brightness, group.scene_index, group.confirmed_state, group.available)
+        print("Controlling light group", group.name)
+        if self.on_change:
+            self.on_change(index, group)
+        return group
+    
+    def select_next(self):
+        """Hand the knob to the next group, wrapping around."""
+        return self.select(self.active + 1)
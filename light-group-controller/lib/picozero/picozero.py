@@ -1,6 +1,7 @@
 from machine import Pin, PWM, Timer, ADC
 from micropython import schedule
 from time import ticks_ms, ticks_us, sleep
+from array import array
 
 ###############################################################################
 # EXCEPTIONS
@@ -166,6 +167,104 @@ class ValueChange:
         self._running = False
         self._timer.deinit()
 
+class DutyCycleChange:
+    """
+    Internal class to replay a precompiled duty cycle table on a PWM
+    output device.
+
+    Unlike :class:`ValueChange` nothing is generated while running: each
+    step is a raw duty value and the number of frames it is held for, and
+    the timer callback only indexes into the arrays, so it never allocates.
+
+    :param PWMOutputDevice output_device:
+        The PWMOutputDevice object you wish to change the duty cycle of.
+
+    :param array duties:
+        An ``array('H')`` of duty values written with ``duty_u16``.
+
+    :param array frames:
+        An ``array('H')`` of the number of frames each duty value is held for.
+
+    :param int frame_ms:
+        The length of a frame in milliseconds.
+
+    :param int n:
+        The number of times to repeat the sequence. If None, the
+        sequence will repeat forever.
+
+    :param bool wait:
+        If True the DutyCycleChange object will block (wait) until
+        the sequence has completed.
+    """
+    def __init__(self, output_device, duties, frames, frame_ms, n, wait):
+        self._output_device = output_device
+        self._pwm = output_device._pwm
+        self._duties = duties
+        self._frames = frames
+        self._frame_ms = frame_ms
+        self._n = n
+
+        self._index = 0
+        self._remaining = 0
+
+        self._timer = Timer()
+        self._running = True
+
+        if wait:
+            self._run_blocking()
+        else:
+            # bind once, so each timer callback doesn't allocate a bound method
+            self._tick_callback = self._tick
+            self._tick()
+            if self._running:
+                self._timer.init(period=frame_ms, mode=Timer.PERIODIC, callback=self._tick_callback)
+
+    def _tick(self, timer_obj=None):
+        if self._remaining > 0:
+            # still holding the current duty value
+            self._remaining -= 1
+            return
+
+        index = self._index
+        if index == len(self._duties):
+            # the cycle has finished
+            if self._n is not None:
+                self._n -= 1
+                if self._n == 0:
+                    self._finish()
+                    return
+            index = 0
+
+        self._pwm.duty_u16(self._duties[index])
+        self._remaining = self._frames[index] - 1
+        self._index = index + 1
+
+    def _run_blocking(self):
+        while True:
+            for i in range(len(self._duties)):
+                self._pwm.duty_u16(self._duties[i])
+                sleep(self._frames[i] * self._frame_ms / 1000)
+
+            if self._n is not None:
+                self._n -= 1
+                if self._n == 0:
+                    break
+
+        self._finish()
+
+    def _finish(self):
+        # the sequence has finished, turn the device off
+        self._timer.deinit()
+        self._output_device.off()
+        self._running = False
+
+    def stop(self):
+        """
+        Stops the DutyCycleChange object running.
+        """
+        self._running = False
+        self._timer.deinit()
+
 ###############################################################################
 # OUTPUT DEVICES
 ###############################################################################
@@ -408,6 +507,8 @@ class PWMOutputDevice(OutputDevice, PinMixin):
         self._duty_factor = duty_factor
         self._pwm = PWM(Pin(pin))
         self._pwm.freq(freq)
+        # (parameters, (duties, frames, frame_ms)) of the last compiled blink
+        self._blink_table = None
         super().__init__(active_high, initial_value)
         
     def _check_pwm_channel(self, pin_num):
@@ -513,9 +614,51 @@ class PWMOutputDevice(OutputDevice, PinMixin):
                 yield (0, off_time)
         
         # is there anything to change?
-        if on_time > 0 or off_time > 0 or fade_in_time > 0 or fade_out_time > 0:
+        if fade_in_time > 0 or fade_out_time > 0:
+            # fades are replayed from a table compiled once, rather than
+            # generating a float value for every frame of every cycle
+            duties, frames, frame_ms = self._compile_blink(on_time, off_time, fade_in_time, fade_out_time, fps)
+            if len(duties) > 0:
+                self._value_changer = DutyCycleChange(self, duties, frames, frame_ms, n, wait)
+        elif on_time > 0 or off_time > 0:
             self._start_change(blink_generator, n, wait)
 
+    def _compile_blink(self, on_time, off_time, fade_in_time, fade_out_time, fps):
+        """
+        Returns a blink cycle as ``(duties, frames, frame_ms)``: the duty
+        values, the number of frames each is held for and the frame length.
+        The table is reused while the parameters stay the same.
+        """
+        key = (on_time, off_time, fade_in_time, fade_out_time, fps, self._duty_factor, self.active_high)
+        if self._blink_table is not None and self._blink_table[0] == key:
+            return self._blink_table[1]
+
+        duties = array('H')
+        frames = array('H')
+
+        def add(value, count):
+            if count > 0:
+                duties.append(self._value_to_state(value))
+                frames.append(min(count, 65535))
+
+        fade_in_frames = int(fps * fade_in_time)
+        for i in range(fade_in_frames):
+            add(i * (1 / fps) / fade_in_time, 1)
+
+        if on_time > 0:
+            add(1, max(1, round(on_time * fps)))
+
+        fade_out_frames = int(fps * fade_out_time)
+        for i in range(fade_out_frames):
+            add(1 - (i * (1 / fps) / fade_out_time), 1)
+
+        if off_time > 0:
+            add(0, max(1, round(off_time * fps)))
+
+        table = (duties, frames, max(1, round(1000 / fps)))
+        self._blink_table = (key, table)
+        return table
+
     def pulse(self, fade_in_time=1, fade_out_time=None, n=None, wait=False, fps=25):
         """
         Makes the device pulse on and off repeatedly.
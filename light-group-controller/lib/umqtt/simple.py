@@ -1,5 +1,8 @@
 import socket
+import select
+import errno
 import struct
+import time
 from binascii import hexlify
 
 
@@ -17,6 +20,9 @@ class MQTTClient:
         password=None,
         keepalive=0,
         ssl=None,
+        rx_buf_size=0,
+        tx_buf_size=0,
+        max_inflight=4,
     ):
         if port == 0:
             port = 8883 if ssl else 1883
@@ -34,10 +40,64 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        # Unacknowledged QoS 1 publishes: pid -> (topic, msg, retain)
+        self.inflight = {}
+        self.max_inflight = max_inflight
+        # Keepalive tracking (ticks_ms)
+        self.last_tx = 0
+        self.ping_sent = None
+        # Packet ID of the last SUBACK received
+        self.suback_pid = None
+        # Socket timeout for reads after the first byte of a packet and
+        # for writes; None blocks
+        self.timeout = None
+        # With a receive buffer, incoming PUBLISH packets are read in place
+        # and the callback gets memoryview slices that are only valid
+        # until it returns.
+        self.hdr = bytearray(1)
+        self.rxbuf = None
+        if rx_buf_size:
+            self.rxbuf = bytearray(rx_buf_size)
+            self.rxmv = memoryview(self.rxbuf)
+        # With a transmit buffer, outgoing packets are assembled in place
+        # and sent with a single write.
+        self.txbuf = None
+        if tx_buf_size:
+            self.txbuf = bytearray(tx_buf_size)
+            self.txmv = memoryview(self.txbuf)
 
-    def _send_str(self, s):
-        self.sock.write(struct.pack("!H", len(s)))
-        self.sock.write(s)
+    def _add_str(self, parts, s):
+        parts.append(struct.pack("!H", len(s)))
+        parts.append(s)
+
+    # Write parts of a packet. With a transmit buffer, parts are gathered
+    # and written together; only parts larger than the buffer are written
+    # on their own. Without one, each part is a separate write.
+    def _write_parts(self, parts):
+        self.last_tx = time.ticks_ms()
+        buf = self.txbuf
+        if buf is None:
+            for p in parts:
+                self.sock.write(p)
+            return
+        mv = self.txmv
+        cap = len(buf)
+        pos = 0
+        for p in parts:
+            if isinstance(p, str):
+                p = p.encode()
+            n = len(p)
+            if pos + n > cap:
+                if pos:
+                    self.sock.write(buf, pos)
+                    pos = 0
+                if n > cap:
+                    self.sock.write(p)
+                    continue
+            mv[pos:pos + n] = p
+            pos += n
+        if pos:
+            self.sock.write(buf, pos)
 
     def _recv_len(self):
         n = 0
@@ -49,6 +109,26 @@ class MQTTClient:
                 return n
             sh += 7
 
+    def _recv_len_into(self):
+        hdr = self.hdr
+        n = 0
+        sh = 0
+        while 1:
+            self.sock.readinto(hdr)
+            b = hdr[0]
+            n |= (b & 0x7F) << sh
+            if not b & 0x80:
+                return n
+            sh += 7
+
+    def _readinto_full(self, n):
+        got = self.sock.readinto(self.rxbuf, n)
+        while got < n:
+            r = self.sock.readinto(self.rxmv[got:n])
+            if not r:
+                raise OSError(-1)
+            got += r
+
     def set_callback(self, f):
         self.cb = f
 
@@ -62,11 +142,63 @@ class MQTTClient:
 
     def connect(self, clean_session=True, timeout=None):
         self.sock = socket.socket()
+        self.timeout = timeout
         self.sock.settimeout(timeout)
         addr = socket.getaddrinfo(self.server, self.port)[0][-1]
         self.sock.connect(addr)
         if self.ssl:
             self.sock = self.ssl.wrap_socket(self.sock, server_hostname=self.server)
+        self._send_connect(clean_session)
+        return self._check_connack(self.sock.read(4))
+
+    # Non-blocking connect: connect_start() opens the TCP connection
+    # without waiting, then connect_poll() is called repeatedly. It
+    # returns None while the connection is in progress and the session
+    # present flag once CONNACK has been received. Passing a resolved
+    # addr skips the DNS lookup.
+    def connect_start(self, clean_session=True, addr=None):
+        if addr is None:
+            addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+        self.sock = socket.socket()
+        self.sock.setblocking(False)
+        try:
+            self.sock.connect(addr)
+        except OSError as e:
+            if e.args[0] != errno.EINPROGRESS:
+                raise
+        self._clean_session = clean_session
+        self._connack = None
+        self._connack_len = 0
+        self._poller = select.poll()
+        self._poller.register(self.sock, select.POLLOUT)
+
+    def connect_poll(self, timeout=None):
+        if self._connack is None:
+            res = self._poller.poll(0)
+            if not res:
+                return None
+            if res[0][1] & (select.POLLERR | select.POLLHUP):
+                raise OSError(-1)
+            self._poller.unregister(self.sock)
+            self.sock.setblocking(True)
+            if self.ssl:
+                self.sock = self.ssl.wrap_socket(self.sock, server_hostname=self.server)
+            self._send_connect(self._clean_session)
+            self.sock.setblocking(False)
+            self._connack = bytearray(4)
+        n = self.sock.readinto(memoryview(self._connack)[self._connack_len:])
+        if n is None:
+            return None
+        if n == 0:
+            raise OSError(-1)
+        self._connack_len += n
+        if self._connack_len < 4:
+            return None
+        self.timeout = timeout
+        self.sock.settimeout(timeout)
+        return self._check_connack(self._connack)
+
+    def _send_connect(self, clean_session):
         premsg = bytearray(b"\x10\0\0\0\0\0")
         msg = bytearray(b"\x04MQTT\x04\x02\0\0")
 
@@ -91,17 +223,19 @@ class MQTTClient:
             i += 1
         premsg[i] = sz
 
-        self.sock.write(premsg, i + 2)
-        self.sock.write(msg)
+        parts = [memoryview(premsg)[:i + 2], msg]
         # print(hex(len(msg)), hexlify(msg, ":"))
-        self._send_str(self.client_id)
+        self._add_str(parts, self.client_id)
         if self.lw_topic:
-            self._send_str(self.lw_topic)
-            self._send_str(self.lw_msg)
+            self._add_str(parts, self.lw_topic)
+            self._add_str(parts, self.lw_msg)
         if self.user:
-            self._send_str(self.user)
-            self._send_str(self.pswd)
-        resp = self.sock.read(4)
+            self._add_str(parts, self.user)
+            self._add_str(parts, self.pswd)
+        self._write_parts(parts)
+        self.ping_sent = None
+
+    def _check_connack(self, resp):
         assert resp[0] == 0x20 and resp[1] == 0x02
         if resp[3] != 0:
             raise MQTTException(resp[3])
@@ -113,10 +247,41 @@ class MQTTClient:
 
     def ping(self):
         self.sock.write(b"\xc0\0")
+        self.last_tx = time.ticks_ms()
+        if self.ping_sent is None:
+            self.ping_sent = self.last_tx
+
+    # Sends PINGREQ once nothing has been sent for half the keepalive
+    # interval. Returns False if a PINGREQ has gone unanswered for that
+    # long as well, meaning the link is dead even if the socket is open.
+    def check_keepalive(self):
+        if not self.keepalive:
+            return True
+        now = time.ticks_ms()
+        interval = self.keepalive * 500
+        if self.ping_sent is not None:
+            return time.ticks_diff(now, self.ping_sent) < interval
+        if time.ticks_diff(now, self.last_tx) >= interval:
+            self.ping()
+        return True
 
-    def publish(self, topic, msg, retain=False, qos=0):
+    # Returns ms until check_keepalive() has something to do (send a
+    # PINGREQ or give up on one), or None without a keepalive.
+    def next_keepalive_ms(self):
+        if not self.keepalive:
+            return None
+        since = self.last_tx if self.ping_sent is None else self.ping_sent
+        elapsed = time.ticks_diff(time.ticks_ms(), since)
+        return max(0, self.keepalive * 500 - elapsed)
+
+    def _next_pid(self):
+        # Packet IDs are 1..65535; 0 is not allowed
+        self.pid = self.pid % 65535 + 1
+        return self.pid
+
+    def _send_publish(self, topic, msg, retain, qos, pid, dup=False):
         pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
+        pkt[0] |= dup << 3 | qos << 1 | retain
         sz = 2 + len(topic) + len(msg)
         if qos > 0:
             sz += 2
@@ -128,53 +293,100 @@ class MQTTClient:
             i += 1
         pkt[i] = sz
         # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
+        parts = [memoryview(pkt)[:i + 1]]
+        self._add_str(parts, topic)
         if qos > 0:
-            self.pid += 1
-            pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
+            parts.append(struct.pack("!H", pid))
+        parts.append(msg)
+        self._write_parts(parts)
+
+    # With qos=1 and wait=False, returns the packet ID straight away; the
+    # message stays in self.inflight until its PUBACK is processed by
+    # wait_msg()/check_msg(), and resend_inflight() retransmits it after
+    # a reconnect.
+    def publish(self, topic, msg, retain=False, qos=0, wait=True):
+        pid = 0
+        if qos > 0:
+            pid = self._next_pid()
+        if qos == 1:
+            self.inflight[pid] = (topic, msg, retain)
+        self._send_publish(topic, msg, retain, qos, pid)
         if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
+            if not wait:
+                return pid
+            while pid in self.inflight:
+                self.wait_msg()
         elif qos == 2:
             assert 0
 
+    def inflight_full(self):
+        return len(self.inflight) >= self.max_inflight
+
+    # Retransmits unacknowledged QoS 1 messages with the DUP flag set.
+    # Call after reconnecting with clean_session=False.
+    def resend_inflight(self):
+        for pid in sorted(self.inflight):
+            topic, msg, retain = self.inflight[pid]
+            self._send_publish(topic, msg, retain, 1, pid, dup=True)
+
     def subscribe(self, topic, qos=0):
         assert self.cb is not None, "Subscribe callback is not set"
+        pid = self._next_pid()
         pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
+        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, pid)
         # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt)
-        self._send_str(topic)
-        self.sock.write(qos.to_bytes(1, "little"))
-        while 1:
-            op = self.wait_msg()
-            if op == 0x90:
-                resp = self.sock.read(4)
-                # print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
-                return
+        parts = [pkt]
+        self._add_str(parts, topic)
+        parts.append(qos.to_bytes(1, "little"))
+        self._write_parts(parts)
+        while self.suback_pid != pid:
+            self.wait_msg()
+
+    # Subscribes to several (topic, qos) filters with one SUBSCRIBE packet.
+    # With wait=False, returns the packet ID straight away; the SUBACK is
+    # processed by wait_msg()/check_msg(), which set suback_pid to it.
+    def subscribe_many(self, topics, wait=True):
+        assert self.cb is not None, "Subscribe callback is not set"
+        pid = self._next_pid()
+        pkt = bytearray(b"\x82\0\0\0\0")
+        sz = 2
+        for topic, qos in topics:
+            sz += 2 + len(topic) + 1
+        i = 1
+        while sz > 0x7F:
+            pkt[i] = (sz & 0x7F) | 0x80
+            sz >>= 7
+            i += 1
+        pkt[i] = sz
+        parts = [memoryview(pkt)[:i + 1], struct.pack("!H", pid)]
+        for topic, qos in topics:
+            self._add_str(parts, topic)
+            parts.append(qos.to_bytes(1, "little"))
+        self._write_parts(parts)
+        if not wait:
+            return pid
+        while self.suback_pid != pid:
+            self.wait_msg()
+
+    # Reads the rest of a SUBACK; raises MQTTException if a filter was refused.
+    def _recv_suback(self):
+        resp = self.sock.read(self._recv_len())
+        self.suback_pid = resp[0] << 8 | resp[1]
+        for code in resp[2:]:
+            if code == 0x80:
+                raise MQTTException(code)
 
     # Wait for a single incoming MQTT message and process it.
     # Subscribed messages are delivered to a callback previously
     # set by .set_callback() method. Other (internal) MQTT
     # messages processed internally.
     def wait_msg(self):
+        if self.rxbuf is not None:
+            return self._wait_msg_into()
         res = self.sock.read(1)
-        self.sock.setblocking(True)
+        # The rest of the packet follows; wait for it, but no longer than
+        # the timeout, which check_msg()'s non-blocking read cleared
+        self.sock.settimeout(self.timeout)
         if res is None:
             return None
         if res == b"":
@@ -182,27 +394,86 @@ class MQTTClient:
         if res == b"\xd0":  # PINGRESP
             sz = self.sock.read(1)[0]
             assert sz == 0
+            self.ping_sent = None
             return None
         op = res[0]
+        if op == 0x40:  # PUBACK
+            resp = self.sock.read(3)
+            assert resp[0] == 0x02
+            self.inflight.pop(resp[1] << 8 | resp[2], None)
+            return op
+        if op == 0x90:  # SUBACK
+            self._recv_suback()
+            return op
         if op & 0xF0 != 0x30:
             return op
         sz = self._recv_len()
+        return self._recv_publish(op, sz)
+
+    def _recv_publish(self, op, sz):
         topic_len = self.sock.read(2)
         topic_len = (topic_len[0] << 8) | topic_len[1]
         topic = self.sock.read(topic_len)
         sz -= topic_len + 2
+        pid = 0
         if op & 6:
             pid = self.sock.read(2)
             pid = pid[0] << 8 | pid[1]
             sz -= 2
         msg = self.sock.read(sz)
         self.cb(topic, msg)
+        self._ack_publish(op, pid)
+        return op
+
+    def _ack_publish(self, op, pid):
         if op & 6 == 2:
             pkt = bytearray(b"\x40\x02\0\0")
             struct.pack_into("!H", pkt, 2, pid)
             self.sock.write(pkt)
         elif op & 6 == 4:
             assert 0
+
+    # Same as wait_msg, but reads into the preallocated receive buffer
+    # instead of allocating bytes objects for each field.
+    def _wait_msg_into(self):
+        hdr = self.hdr
+        n = self.sock.readinto(hdr)
+        self.sock.settimeout(self.timeout)
+        if n is None:
+            return None
+        if n == 0:
+            raise OSError(-1)
+        op = hdr[0]
+        if op == 0xD0:  # PINGRESP
+            self.sock.readinto(hdr)
+            assert hdr[0] == 0
+            self.ping_sent = None
+            return None
+        if op == 0x40:  # PUBACK
+            self._readinto_full(3)
+            buf = self.rxbuf
+            assert buf[0] == 0x02
+            self.inflight.pop(buf[1] << 8 | buf[2], None)
+            return op
+        if op == 0x90:  # SUBACK
+            self._recv_suback()
+            return op
+        if op & 0xF0 != 0x30:
+            return op
+        sz = self._recv_len_into()
+        if sz > len(self.rxbuf):
+            return self._recv_publish(op, sz)
+        self._readinto_full(sz)
+        buf = self.rxbuf
+        topic_len = (buf[0] << 8) | buf[1]
+        pos = 2 + topic_len
+        pid = 0
+        if op & 6:
+            pid = buf[pos] << 8 | buf[pos + 1]
+            pos += 2
+        mv = self.rxmv
+        self.cb(mv[2:2 + topic_len], mv[pos:sz])
+        self._ack_publish(op, pid)
         return op
 
     # Checks whether a pending message from server is available.
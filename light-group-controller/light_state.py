@@ -1,12 +1,16 @@
 import time
-from config import AVAILABLE_SCENES
+from config import AVAILABLE_SCENES, OFFLINE_RECONCILE_MS, OFFLINE_JOURNAL_MAX_AGE_MS
 
 class LightState:
     # Mode constants
     TEMPERATURE_MODE = 'temperature'
+    BRIGHTNESS_MODE = 'brightness'
     SCENES_MODE = 'scenes'
     
-    def __init__(self, min_temp=200, max_temp=454, default_temp=370, step=10, on_state_change=None, on_scene_change=None, batch_delay_ms=300):
+    # Order double presses cycle through the modes
+    MODE_CYCLE = (TEMPERATURE_MODE, BRIGHTNESS_MODE, SCENES_MODE)
+    
+    def __init__(self, min_temp=200, max_temp=454, default_temp=370, step=10, on_state_change=None, on_scene_change=None, batch_delay_ms=300, accel_curve=(), scene_settle_ms=None, on_scene_preview=None, batch_delay_min_ms=None, batch_delay_max_ms=None, brightness_steps=(255,)):
         """Initialize the light state with the specified parameters.
         
         Args:
@@ -14,9 +18,21 @@ class LightState:
             max_temp: Maximum color temperature value
             default_temp: Default color temperature
             step: Step size for temperature adjustments
-            on_state_change: Callback for state changes
+            on_state_change: Callback for state changes (receives on(bool),
+                color_temp(int), brightness(int, or None while unknown))
             on_scene_change: Callback for scene changes
             batch_delay_ms: Delay in ms before sending updates (for batching)
+            accel_curve: (max ms between detents, step multiplier) pairs, fastest first
+            scene_settle_ms: If set, rotation only previews scenes and the selected
+                scene is activated once rotation has been idle this long
+            on_scene_preview: Callback for previewed scenes (receives scene index,
+                or None once the previewed scene is activated)
+            batch_delay_min_ms: Lower bound for the adaptive batch delay
+            batch_delay_max_ms: Upper bound for the adaptive batch delay; the
+                delay only adapts to measured round-trip times if both are set
+            brightness_steps: Ascending brightness levels (1-255) a detent moves
+                between; spacing them perceptually keeps low levels fine and
+                high levels coarse
         """
         self.on = True
         self.color_temp = default_temp
@@ -26,60 +42,222 @@ class LightState:
         self.on_state_change = on_state_change
         self.on_scene_change = on_scene_change
         self.batch_delay_ms = batch_delay_ms
+        self.accel_curve = accel_curve
+        self.scene_settle_ms = scene_settle_ms
+        self.on_scene_preview = on_scene_preview
+        self.batch_delay_min_ms = batch_delay_min_ms
+        self.batch_delay_max_ms = batch_delay_max_ms
+        self.brightness_steps = brightness_steps
+        self.brightness_index = len(brightness_steps) - 1
+        self.brightness = brightness_steps[-1]
+        # Until HA reports a brightness or the knob sets one, commands
+        # leave it out so HA keeps whatever the lights are at
+        self.brightness_known = False
         
         # Mode and scene state
         self.current_mode = self.SCENES_MODE
         self.current_scene_index = 0
+        self.available = True
         
         # Batching state
         self.last_change_time = 0
         self.pending_update = False
-        self.last_notified_state = (self.on, self.color_temp)
+        self.last_notified_state = None
+        # Last state HA reported or confirmed, or None when unknown (like
+        # after a scene), and whether a sent state is still unconfirmed
+        self.confirmed_state = None
+        self.awaiting_confirm = False
+        self.last_scene_change_time = 0
+        self.pending_scene = False
+        
+        # Offline journal: field name -> ticks of its last local change while
+        # the link was down, reconciled against HA's state on reconnect;
+        # "toggle" is a press made before HA's on state was known
+        self.online = True
+        self.journal = {}
+        self.reconciling = False
+        self.reconcile_time = 0
+        
+        # Rotation velocity tracking
+        self.last_detent_time = 0
+        self.last_detent_direction = 0
+        
+        # Round-trip statistics (integer EWMAs, as in TCP's SRTT/RTTVAR);
+        # kept scaled by 8 and 4 so the shifts don't truncate them
+        self.srtt_scaled = None
+        self.rttvar_scaled = 0
+        self.rtt_samples = 0
     
     def toggle(self):
         """Toggle the light on/off state."""
         self.on = not self.on
+        if self.confirmed_state is None and (not self.online or self.reconciling):
+            # HA's state is unknown, as after a dormant wake, so the press
+            # flips whatever HA reports; a second press cancels it
+            if self.journal.pop("toggle", None) is None:
+                self.journal["toggle"] = time.ticks_ms()
+        else:
+            self._journal("on")
         # Toggle changes should be immediate, not batched
         self._notify_change(force=True)
         return self.on
     
     def toggle_mode(self):
-        """Toggle between temperature and scenes mode."""
+        """Cycle through temperature, brightness and scenes mode."""
         if self.current_mode == self.TEMPERATURE_MODE:
+            self.current_mode = self.BRIGHTNESS_MODE
+        elif self.current_mode == self.BRIGHTNESS_MODE:
             self.current_mode = self.SCENES_MODE
-            if self.on_scene_change:
-                self.on_scene_change(AVAILABLE_SCENES[self.current_scene_index])
+            self._activate_scene()
         else:
+            # Leaving scenes mode commits a previewed scene straight away
+            self._commit_scene()
             self.current_mode = self.TEMPERATURE_MODE
-            if self.on_state_change:
-                self.on_state_change(self.on, self.color_temp)
+            # Restore our state unless HA is known to be there already
+            self._publish_state()
         return self.current_mode
     
-    def adjust(self, direction):
-        """Adjust either temperature or scene based on current mode."""
+    def adjust(self, direction, when=None):
+        """Adjust temperature, brightness or scene based on current mode.
+        
+        Args:
+            direction: 1 or -1
+            when: ticks_ms the detent was turned at, or None for now
+        """
         if self.current_mode == self.TEMPERATURE_MODE:
-            return self.adjust_temp(direction)
+            return self.adjust_temp(direction, when)
+        elif self.current_mode == self.BRIGHTNESS_MODE:
+            return self.adjust_brightness(direction, when)
         else:
             return self.adjust_scene(direction)
     
-    def adjust_temp(self, direction):
-        """Adjust the color temperature by the step size in the given direction."""
-        self.color_temp += direction * self.step
+    def _step_multiplier(self, direction, when=None):
+        """Return the step multiplier for a detent based on rotation speed.
+        
+        Speed comes from the detents' own times, so detents queued while
+        we were busy and delivered together aren't mistaken for a fast turn.
+        """
+        if when is None:
+            when = time.ticks_ms()
+        interval = time.ticks_diff(when, self.last_detent_time)
+        same_direction = direction == self.last_detent_direction
+        self.last_detent_time = when
+        self.last_detent_direction = direction
+        
+        # Reversing always drops back to fine control, and so does a
+        # negative interval: the last detent was too long ago to compare
+        if same_direction and interval >= 0:
+            for max_interval, multiplier in self.accel_curve:
+                if interval <= max_interval:
+                    return multiplier
+        return 1
+    
+    def adjust_temp(self, direction, when=None):
+        """Adjust the color temperature by the step size in the given direction.
+        
+        Fast rotation scales the step according to the acceleration curve.
+        """
+        self.color_temp += direction * self.step * self._step_multiplier(direction, when)
         self.color_temp = max(self.min_temp, min(self.max_temp, self.color_temp))
+        self._journal("color_temp")
         # Mark as pending but don't send immediately
         self._notify_change(force=False)
         return self.color_temp
     
+    def adjust_brightness(self, direction, when=None):
+        """Move the brightness along the step table in the given direction.
+        
+        Fast rotation skips steps according to the acceleration curve.
+        """
+        index = self.brightness_index
+        if direction > 0 and self.brightness < self.brightness_steps[index]:
+            # Set from outside between steps; the first step up is the one above it
+            index -= 1
+        index += direction * self._step_multiplier(direction, when)
+        self.brightness_index = max(0, min(len(self.brightness_steps) - 1, index))
+        self.brightness = self.brightness_steps[self.brightness_index]
+        self.brightness_known = True
+        self._journal("brightness")
+        # Mark as pending but don't send immediately
+        self._notify_change(force=False)
+        return self.brightness
+    
+    def _set_brightness(self, brightness):
+        """Take a brightness from outside, moving the cursor to the nearest step at or above it."""
+        self.brightness = max(1, min(255, brightness))
+        self.brightness_known = True
+        steps = self.brightness_steps
+        index = 0
+        while index < len(steps) - 1 and steps[index] < self.brightness:
+            index += 1
+        self.brightness_index = index
+    
     def adjust_scene(self, direction):
-        """Adjust the scene selection."""
+        """Adjust the scene selection.
+        
+        With a settle time configured only the local cursor moves here; the
+        scene is activated by check_pending_updates once rotation stops.
+        """
         num_scenes = len(AVAILABLE_SCENES)
         self.current_scene_index = (self.current_scene_index + direction) % num_scenes
+        if self.scene_settle_ms is None:
+            self._activate_scene()
+        else:
+            self.last_scene_change_time = time.ticks_ms()
+            self.pending_scene = True
+            if self.on_scene_preview:
+                self.on_scene_preview(self.current_scene_index)
+        return AVAILABLE_SCENES[self.current_scene_index]
+    
+    def _commit_scene(self):
+        """Activate the previewed scene, if any."""
+        if not self.pending_scene:
+            return
+        self.pending_scene = False
+        self._activate_scene()
+        if self.on_scene_preview:
+            self.on_scene_preview(None)
+    
+    def _activate_scene(self):
+        """Send the selected scene; afterwards HA's light state is unknown."""
         if self.on_scene_change:
             self.on_scene_change(AVAILABLE_SCENES[self.current_scene_index])
-        return AVAILABLE_SCENES[self.current_scene_index]
+        self.confirmed_state = None
+        self.awaiting_confirm = False
     
-    def update_from_external(self, on_state, color_temp):
-        """Update state from external source (like MQTT)."""
+    def confirm(self, on_state, color_temp, brightness):
+        """Record that HA applied a state we sent (its echo arrived)."""
+        self.confirmed_state = (on_state, color_temp, brightness)
+        if self.confirmed_state == self.last_notified_state:
+            self.awaiting_confirm = False
+    
+    def update_from_external(self, on_state, color_temp, brightness=None):
+        """Update state from external source (like MQTT).
+        
+        A brightness of None (not reported, as while off) keeps the local one.
+        """
+        reported = brightness is not None
+        if not reported:
+            brightness = self.brightness
+        # HA is here now, whatever we sent before
+        self.confirmed_state = (on_state, max(self.min_temp, min(self.max_temp, color_temp)),
+                                brightness if reported or self.brightness_known else None)
+        self.awaiting_confirm = False
+        
+        # Fields changed while offline are newer than what HA queued for us
+        self._expire_journal()
+        toggled = self.journal.pop("toggle", None)
+        if toggled is not None:
+            # From here on the press is a change to a known state
+            on_state = not on_state
+            self.journal["on"] = toggled
+        elif "on" in self.journal:
+            on_state = self.on
+        if "color_temp" in self.journal:
+            color_temp = self.color_temp
+        if "brightness" in self.journal:
+            brightness = self.brightness
+        
         changed = False
         if self.on != on_state:
             self.on = on_state
@@ -89,28 +267,177 @@ class LightState:
             self.color_temp = max(self.min_temp, min(self.max_temp, color_temp))
             changed = True
         
+        if self.brightness != brightness:
+            self._set_brightness(brightness)
+            changed = True
+        elif reported:
+            self.brightness_known = True
+        
         if changed:
-            # Update last notified state to match current state
-            self.last_notified_state = (self.on, self.color_temp)
+            # Drop local changes HA has overridden
+            self.pending_update = False
+        
+        return changed
+    
+    def set_online(self, online):
+        """Record MQTT link changes; state changes made while offline are journaled."""
+        if online == self.online:
+            return
+        self.online = online
+        if not online:
+            self.reconciling = False
+        elif self.journal:
+            # Let HA's retained or queued state arrive before reconciling
+            self.reconciling = True
+            self.reconcile_time = time.ticks_ms()
+    
+    def _journal(self, field):
+        """Note a local change to field if it can't be sent yet."""
+        if not self.online or self.reconciling:
+            self.journal[field] = time.ticks_ms()
+    
+    def _expire_journal(self):
+        """Drop offline changes too old to override HA's state."""
+        now = time.ticks_ms()
+        for field in list(self.journal):
+            if time.ticks_diff(now, self.journal[field]) >= OFFLINE_JOURNAL_MAX_AGE_MS:
+                del self.journal[field]
+    
+    def _reconcile(self):
+        """Send the merge of offline changes and HA's state as a single publish."""
+        self.reconciling = False
+        if self.journal:
+            print("Reconciling offline changes:", list(self.journal))
+            self.journal.clear()
             self.pending_update = False
-            
+            self._publish_state()
+    
+    def update_scene_from_external(self, scene_name):
+        """Move the scene cursor to a scene activated elsewhere (like HA)."""
+        if self.pending_scene or scene_name not in AVAILABLE_SCENES:
+            # Don't yank the cursor away from a scene being previewed
+            return False
+        index = AVAILABLE_SCENES.index(scene_name)
+        changed = index != self.current_scene_index
+        self.current_scene_index = index
+        return changed
+    
+    def set_available(self, available):
+        """Record whether HA reports the light group as available."""
+        changed = available != self.available
+        self.available = available
         return changed
     
+    def snapshot(self):
+        """Return the user-visible state as a dict that can be saved across a deep sleep."""
+        return {
+            "on": self.on,
+            "color_temp": self.color_temp,
+            "brightness": self.brightness if self.brightness_known else None,
+            "mode": self.current_mode,
+            "scene_index": self.current_scene_index
+        }
+    
+    def restore(self, snapshot):
+        """Restore state saved by snapshot(); HA's state is unknown until it reports."""
+        self.on = snapshot["on"]
+        self.color_temp = max(self.min_temp, min(self.max_temp, snapshot["color_temp"]))
+        if snapshot.get("brightness") is not None:
+            self._set_brightness(snapshot["brightness"])
+        if snapshot["mode"] in self.MODE_CYCLE:
+            self.current_mode = snapshot["mode"]
+        self.current_scene_index = snapshot["scene_index"] % len(AVAILABLE_SCENES)
+    
+    def flush(self):
+        """Send any batched state or previewed scene now instead of waiting."""
+        self._commit_scene()
+        if self.pending_update:
+            self._publish_state()
+            self.pending_update = False
+    
+    def load_group(self, on_state, color_temp, brightness, scene_index, confirmed_state, available):
+        """Switch to controlling another light group, starting from its last known state.
+        
+        A brightness of None means the group's brightness isn't known yet.
+        """
+        self.on = on_state
+        self.color_temp = color_temp
+        if brightness is None:
+            self.brightness_known = False
+        else:
+            self._set_brightness(brightness)
+        self.current_scene_index = scene_index
+        self.confirmed_state = confirmed_state
+        self.available = available
+        self.last_notified_state = None
+        self.awaiting_confirm = False
+        self.pending_update = False
+        self.pending_scene = False
+        self.journal.clear()
+        self.reconciling = False
+    
+    def record_rtt(self, rtt_ms):
+        """Fold a command round-trip time into the stats and resize the batch window."""
+        self.rtt_samples += 1
+        if self.srtt_scaled is None:
+            self.srtt_scaled = rtt_ms << 3
+            self.rttvar_scaled = rtt_ms << 1
+        else:
+            error = rtt_ms - (self.srtt_scaled >> 3)
+            self.srtt_scaled += error
+            self.rttvar_scaled += abs(error) - (self.rttvar_scaled >> 2)
+        
+        if self.batch_delay_min_ms is None or self.batch_delay_max_ms is None:
+            return
+        # Batch for about one round trip so we don't outrun the link
+        window = (self.srtt_scaled >> 3) + (self.rttvar_scaled >> 1)
+        self.batch_delay_ms = max(self.batch_delay_min_ms, min(self.batch_delay_max_ms, window))
+    
+    def rtt_stats(self):
+        """Return the round-trip statistics and current batch window."""
+        return {
+            "srtt_ms": None if self.srtt_scaled is None else self.srtt_scaled >> 3,
+            "rttvar_ms": self.rttvar_scaled >> 2,
+            "samples": self.rtt_samples,
+            "batch_delay_ms": self.batch_delay_ms
+        }
+    
+    def next_flush_ms(self):
+        """Return ms until a batched update or scene is due, or None if nothing is pending."""
+        now = time.ticks_ms()
+        delay = None
+        if self.pending_update:
+            delay = max(0, self.batch_delay_ms - time.ticks_diff(now, self.last_change_time))
+        if self.pending_scene:
+            scene_delay = max(0, self.scene_settle_ms - time.ticks_diff(now, self.last_scene_change_time))
+            if delay is None or scene_delay < delay:
+                delay = scene_delay
+        if self.reconciling:
+            reconcile_delay = max(0, OFFLINE_RECONCILE_MS - time.ticks_diff(now, self.reconcile_time))
+            if delay is None or reconcile_delay < delay:
+                delay = reconcile_delay
+        return delay
+    
     def check_pending_updates(self):
         """Check if there are pending updates to be sent after the batch delay."""
+        if self.pending_scene:
+            elapsed = time.ticks_diff(time.ticks_ms(), self.last_scene_change_time)
+            if elapsed >= self.scene_settle_ms:
+                self._commit_scene()
+        
+        if self.reconciling:
+            if time.ticks_diff(time.ticks_ms(), self.reconcile_time) >= OFFLINE_RECONCILE_MS:
+                self._reconcile()
+        
         if not self.pending_update:
             return False
-            
+        
         current_time = time.ticks_ms()
         elapsed = time.ticks_diff(current_time, self.last_change_time)
         
         if elapsed >= self.batch_delay_ms:
             # If enough time has passed, send the update
-            current_state = (self.on, self.color_temp)
-            if current_state != self.last_notified_state:
-                if self.on_state_change:
-                    self.on_state_change(self.on, self.color_temp)
-                self.last_notified_state = current_state
+            self._publish_state()
             self.pending_update = False
             return True
         
@@ -126,9 +453,33 @@ class LightState:
         self.pending_update = True
         
         if force:
-            current_state = (self.on, self.color_temp)
-            if current_state != self.last_notified_state:
-                if self.on_state_change:
-                    self.on_state_change(self.on, self.color_temp)
-                self.last_notified_state = current_state
-                self.pending_update = False 
\ No newline at end of file
+            self._publish_state()
+            self.pending_update = False
+    
+    def current_state(self):
+        """Return (on, color_temp, brightness) as commands send it; brightness is None while unknown."""
+        return self.on, self.color_temp, self.brightness if self.brightness_known else None
+    
+    def _publish_state(self):
+        """Send the current state unless HA is already at, or heading to, it.
+        
+        Returns:
+            True if the state was sent
+        """
+        if not self.online or self.reconciling:
+            # The journal keeps the change until the link is back
+            return False
+        current_state = self.current_state()
+        # While a sent state is unconfirmed HA is heading there; otherwise
+        # it is wherever it last reported
+        if self.awaiting_confirm:
+            target = self.last_notified_state
+        else:
+            target = self.confirmed_state
+        if current_state == target:
+            return False
+        if self.on_state_change:
+            self.on_state_change(*current_state)
+        self.last_notified_state = current_state
+        self.awaiting_confirm = True
+        return True 
\ No newline at end of file
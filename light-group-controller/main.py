@@ -1,30 +1,161 @@
-import time
+import uasyncio as asyncio
 from wifi import WiFiManager
 from mqtt import MqttLightSync
 from encoder import RotaryEncoder
 from light_state import LightState
+from groups import GroupRegistry
 from led_controller import LedController
+from power import IdleManager, save_snapshot, load_snapshot, woke_from_dormant
 from secrets import MQTT_BROKER, MQTT_USER, MQTT_PASSWORD
 import config
 
-def main():
+async def encoder_task(encoder, wake, flush, idle):
+    """Run encoder callbacks on pin edges or when a pending press expires."""
+    while True:
+        timeout = encoder.next_deadline_ms()
+        if timeout is None:
+            await wake.wait()
+        else:
+            try:
+                await asyncio.wait_for_ms(wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        encoder.check()
+        idle.activity()
+        # Let the flusher pick up any new batch deadline
+        flush.set()
+
+class SocketReadable:
+    """Awaitable that resumes once a socket has data, or an error, to read.
+    
+    uasyncio has no public call for this. Its own streams wait the same
+    way, by queueing the task on the scheduler's IO queue and yielding;
+    this is the only place the controller relies on that internal.
+    """
+    
+    def __init__(self, sock):
+        self.sock = sock
+    
+    def __iter__(self):
+        yield asyncio.core._io_queue.queue_read(self.sock)
+    
+    __await__ = __iter__
+
+# Fail at startup, not in the MQTT task, on a uasyncio without the IO queue
+if not hasattr(asyncio.core, "_io_queue"):
+    raise ImportError("uasyncio.core._io_queue is required to wait on sockets")
+
+async def socket_task(mqtt, mqtt_wake, handled):
+    """Wake the MQTT task when the broker socket becomes readable."""
+    while True:
+        sock = mqtt.socket()
+        if sock is not None:
+            await SocketReadable(sock)
+            # Forget reads handled before this data arrived
+            handled.clear()
+            mqtt_wake.set()
+        # Watch again once the MQTT task has read it, or the link has changed
+        await handled.wait()
+        handled.clear()
+
+async def mqtt_task(mqtt, mqtt_wake, handled):
+    """Read MQTT messages, flush queued ones and keep the link up, only when there is work."""
+    while True:
+        mqtt.check()
+        mqtt.flush()
+        handled.set()
+        
+        # Sleep until the socket is readable, a message is queued, or a
+        # keepalive, flush window or reconnect attempt is due
+        timeout = mqtt.next_event_ms()
+        if timeout is None:
+            await mqtt_wake.wait()
+        else:
+            try:
+                await asyncio.wait_for_ms(mqtt_wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        mqtt_wake.clear()
+
+async def flush_task(light_state, flush):
+    """Send batched light updates once their batch delay has passed."""
+    while True:
+        delay = light_state.next_flush_ms()
+        if delay is None:
+            await flush.wait()
+            flush.clear()
+        else:
+            await asyncio.sleep_ms(delay)
+            light_state.check_pending_updates()
+
+async def led_task(led, mqtt, light_state, status):
+    """Blink on startup, then show scene previews and MQTT link status on the LED."""
+    # Signal that setup is complete by blinking the LED
+    for _ in range(6):
+        led.toggle()
+        await asyncio.sleep_ms(200)
+    
+    while True:
+        if light_state.pending_scene:
+            # Handled from here on; a cursor move during the flash sets it
+            # again, so the new scene is flashed next
+            status.clear()
+            # Flash the previewed scene number
+            led.off()
+            await asyncio.sleep_ms(config.LED_PREVIEW_MS)
+            for _ in range(light_state.current_scene_index + 1):
+                led.on()
+                await asyncio.sleep_ms(config.LED_PREVIEW_MS)
+                led.off()
+                await asyncio.sleep_ms(config.LED_PREVIEW_MS)
+            # Hold off until the scene is committed or the cursor moves again
+            await status.wait()
+            status.clear()
+        elif mqtt.is_connected() and light_state.available:
+            led.on()
+            await status.wait()
+            status.clear()
+        else:
+            # Blink while disconnected or the lights are unavailable
+            led.toggle()
+            try:
+                await asyncio.wait_for_ms(status.wait(), config.LED_BLINK_MS)
+                status.clear()
+            except asyncio.TimeoutError:
+                pass
+
+async def run():
     # Initialize LED controller
     led = LedController()
     
-    # Initialize WiFi connection
+    # WiFi connects once the controls are set up, so a press that woke
+    # us from dormant is applied before waiting on the network
     wifi = WiFiManager()
-    wifi.connect(max_wait=config.WIFI_MAX_WAIT, retry_count=config.WIFI_RETRY_COUNT)
     
     # Setup MQTT client and define callbacks
     mqtt = None
+    groups = None
     
-    def publish_state_change(on_state, color_temp):
+    # Event waking the MQTT task when a message is queued, the socket is
+    # readable or the Wi-Fi link changes
+    mqtt_wake = asyncio.Event()
+    
+    def publish_state_change(on_state, color_temp, brightness):
         if mqtt:
-            mqtt.publish_state(on_state, color_temp)
-            
+            mqtt.publish_state(on_state, color_temp, brightness, groups.active_group().command_topic)
+            mqtt_wake.set()
+    
     def publish_scene_change(scene_name):
         if mqtt:
-            mqtt.publish_scene(scene_name)
+            mqtt.publish_scene(scene_name, groups.active_group().scene_command_topic)
+            mqtt_wake.set()
+    
+    # Event signalling LED task about link changes and scene previews
+    status = asyncio.Event()
+    # Event waking the flush task when a new deadline may be due
+    flush = asyncio.Event()
+    # Event telling the socket watcher the MQTT task has read the socket
+    socket_handled = asyncio.Event()
     
     # Create light state controller with callback
     light_state = LightState(
@@ -34,51 +165,136 @@ def main():
         step=config.COLOR_TEMP_STEP,
         on_state_change=publish_state_change,
         on_scene_change=publish_scene_change,
-        batch_delay_ms=config.BATCH_DELAY_MS
+        batch_delay_ms=config.BATCH_DELAY_MS,
+        accel_curve=config.COLOR_TEMP_ACCEL_CURVE,
+        scene_settle_ms=config.SCENE_SETTLE_MS,
+        on_scene_preview=lambda index: status.set(),
+        batch_delay_min_ms=config.BATCH_DELAY_MIN_MS,
+        batch_delay_max_ms=config.BATCH_DELAY_MAX_MS,
+        brightness_steps=config.BRIGHTNESS_STEPS
     )
     
-    def on_mqtt_update(state, temp):
-        if light_state.update_from_external(state, temp):
-            print("HA State updated → led_on:", state, "color_temp:", temp)
+    # The knob drives one light group at a time; a long press selects the next
+    groups = GroupRegistry(
+        config.LIGHT_GROUPS,
+        light_state,
+        on_change=lambda index, group: status.set()
+    )
+    
+    snapshot = load_snapshot(config.DORMANT_SNAPSHOT_FILE)
+    # Only the switch wakes us from dormant, so a wake means a press; any
+    # other boot just resumes the saved state
+    woken = snapshot is not None and woke_from_dormant()
+    if snapshot:
+        groups.select(snapshot.get("group", 0))
+        light_state.restore(snapshot)
+        print("Resumed from dormant:", snapshot, "woken by switch" if woken else "after a reset")
+    
+    def on_connection_change(connected):
+        # Changes made while offline are reconciled shortly after reconnecting
+        light_state.set_online(connected)
+        flush.set()
+        status.set()
+    
+    def on_remote_config(name, value):
+        if name in config.REMOTE_CONFIG_KEYS:
+            setattr(light_state, name, value)
+            print("Remote config →", name, "=", value)
     
     # Initialize MQTT client after callbacks are defined
     mqtt = MqttLightSync(
         broker=MQTT_BROKER,
         username=MQTT_USER,
         password=MQTT_PASSWORD,
-        state_topic=config.MQTT_TOPIC_STATE,
-        on_update=on_mqtt_update
+        state_topic=None,
+        on_update=None,
+        on_connection_change=on_connection_change,
+        flush_interval_ms=config.MQTT_FLUSH_MS,
+        on_rtt=light_state.record_rtt,
+        config_topic=config.MQTT_TOPIC_CONFIG,
+        on_config=on_remote_config
     )
-    mqtt.connect()
+    # Every group shares this one connection
+    groups.attach(mqtt)
+    light_state.set_online(mqtt.is_connected())
     
     # Setup rotary encoder with callbacks
     encoder = RotaryEncoder(
         clk_pin=config.ENCODER_CLK_PIN,
         dt_pin=config.ENCODER_DT_PIN,
         sw_pin=config.ENCODER_SW_PIN,
-        on_rotate=lambda direction: light_state.adjust(direction) if light_state.on else None,
+        on_rotate=lambda direction, when: light_state.adjust(direction, when) if light_state.on else None,
         on_press=light_state.toggle,
-        on_double_press=light_state.toggle_mode
+        on_double_press=light_state.toggle_mode,
+        mode=config.ENCODER_MODE,
+        ring_size=config.ENCODER_RING_SIZE,
+        pio_sm=config.ENCODER_PIO_SM,
+        on_long_press=groups.select_next if len(config.LIGHT_GROUPS) > 1 else None
     )
     
-    # Signal that setup is complete by blinking the LED
-    for _ in range(3):
-        led.toggle()
-        time.sleep(0.2)
-        led.toggle()
-        time.sleep(0.2)
+    # Pin IRQs wake the encoder task; the flag is safe to set from an IRQ
+    wake = asyncio.ThreadSafeFlag()
+    encoder.attach_irq(lambda pin: wake.set())
+    
+    if woken:
+        # The press that woke us is the first action; it is queued until
+        # the link is up
+        light_state.toggle()
+    
+    wifi.connect(max_wait=config.WIFI_MAX_WAIT, retry_count=config.WIFI_RETRY_COUNT)
+    mqtt.network_changed(wifi.wlan.isconnected())
+    mqtt.connect()
+    
+    def network_changed(up):
+        mqtt.network_changed(up)
+        mqtt_wake.set()
+    
+    def enter_dormant():
+        snapshot = light_state.snapshot()
+        snapshot["group"] = groups.active
+        save_snapshot(config.DORMANT_SNAPSHOT_FILE, snapshot)
+        mqtt.disconnect()
+        encoder.prepare_dormant()
+        led.off()
+        wifi.wlan.disconnect()
+        wifi.wlan.active(False)
+    
+    def on_wake():
+        # The user is back; make sure the link can carry their commands
+        mqtt.wake()
+        mqtt_wake.set()
+    
+    def is_busy():
+        return (light_state.next_flush_ms() is not None
+                or encoder.next_deadline_ms() is not None
+                or not mqtt.is_idle())
+    
+    # PIO counters stop while the CPU lightsleeps, so only sleep with pin IRQs
+    idle = IdleManager(
+        wlan=wifi.wlan,
+        is_busy=is_busy,
+        on_wake=on_wake,
+        powersave_after_ms=config.POWERSAVE_AFTER_MS,
+        sleep_after_ms=None if config.ENCODER_MODE == 'pio' else config.LIGHTSLEEP_AFTER_MS,
+        max_sleep_ms=config.LIGHTSLEEP_MAX_MS,
+        dormant_after_ms=config.DORMANT_AFTER_MS,
+        on_dormant=enter_dormant
+    )
     
     print("Light controller ready!")
     
-    # Main loop
-    while True:
-        mqtt.check()
-        encoder.check()
-        
-        # Check if any batched updates need to be sent
-        light_state.check_pending_updates()
-        
-        time.sleep(0.01)
+    await asyncio.gather(
+        encoder_task(encoder, wake, flush, idle),
+        mqtt_task(mqtt, mqtt_wake, socket_handled),
+        socket_task(mqtt, mqtt_wake, socket_handled),
+        flush_task(light_state, flush),
+        led_task(led, mqtt, light_state, status),
+        wifi.supervise(on_link_change=network_changed),
+        idle.run(),
+    )
+
+def main():
+    asyncio.run(run())
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
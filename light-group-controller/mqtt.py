@@ -1,15 +1,204 @@
 import ubinascii
 import machine
+import random
+import socket
+import time
 from umqtt.simple import MQTTClient
 import ujson
 import config
-from led_controller import LedController
 
 # Generate unique client ID based on device ID
 CLIENT_ID = b"pico-client-" + ubinascii.hexlify(machine.unique_id())
 
+# Top-level keys read from HA light state payloads
+STATE_KEY = b"state"
+COLOR_TEMP_KEY = b"color_temp"
+BRIGHTNESS_KEY = b"brightness"
+
+def _skip_space(msg, i, n):
+    """Return the index of the first non-whitespace byte at or after i."""
+    while i < n and msg[i] <= 0x20:
+        i += 1
+    return i
+
+def _equals(msg, start, end, literal):
+    """Return True if msg[start:end] equals literal, without slicing msg."""
+    if end - start != len(literal) or end > len(msg):
+        return False
+    for j in range(len(literal)):
+        if msg[start + j] != literal[j]:
+            return False
+    return True
+
+def _int_value(msg, i):
+    """Return the plain non-negative integer at msg[i], or None for anything else."""
+    value = 0
+    start = i
+    n = len(msg)
+    while i < n and 0x30 <= msg[i] <= 0x39:
+        value = value * 10 + msg[i] - 0x30
+        i += 1
+    # Only plain integers followed by a separator; null, floats and the rest fall back
+    if i == start or i >= n or not (msg[i] == 0x2C or msg[i] == 0x7D or msg[i] <= 0x20):
+        return None
+    return value
+
+def parse_light_state(msg):
+    """Extract the on state, color temperature and brightness from an HA light state payload.
+    
+    Walks the payload once, reading just the top-level keys we use
+    instead of building a dict of everything HA reports (xy, hs, effect
+    lists, ...). A key only counts when it is a top-level string followed
+    by ':', so values like "color_mode": "color_temp" are skipped.
+    
+    Args:
+        msg: JSON payload (bytes or memoryview, e.g. a view into the receive buffer)
+    
+    Returns:
+        (on(bool), color_temp(int), brightness(int or None if not reported)),
+        or None if the payload needs the full JSON parser
+    """
+    n = len(msg)
+    i = _skip_space(msg, 0, n)
+    if i >= n or msg[i] != 0x7B:  # '{'
+        return None
+    
+    on = False
+    color_temp = config.DEFAULT_COLOR_TEMP
+    brightness = None
+    depth = 0
+    while i < n:
+        c = msg[i]
+        if c == 0x7B or c == 0x5B:  # '{' '['
+            depth += 1
+            i += 1
+            continue
+        if c == 0x7D or c == 0x5D:  # '}' ']'
+            depth -= 1
+            i += 1
+            if depth == 0:
+                # The object is closed; only whitespace may follow it
+                if _skip_space(msg, i, n) != n:
+                    return None
+                return on, color_temp, brightness
+            continue
+        if c != 0x22:  # '"'
+            i += 1
+            continue
+        
+        # A string: find its end, stepping over escapes
+        start = i + 1
+        i = start
+        escaped = False
+        while i < n and msg[i] != 0x22:
+            if msg[i] == 0x5C:  # '\'
+                escaped = True
+                i += 1
+            i += 1
+        if i >= n:
+            return None
+        end = i
+        i = _skip_space(msg, i + 1, n)
+        if depth != 1 or i >= n or msg[i] != 0x3A:  # ':'
+            # A value, or a key of a nested object
+            continue
+        if escaped:
+            # A top-level key spelled with escapes could be one of ours
+            return None
+        i = _skip_space(msg, i + 1, n)
+        
+        if _equals(msg, start, end, STATE_KEY):
+            if _equals(msg, i, i + 4, b'"ON"'):
+                on = True
+            elif _equals(msg, i, i + 5, b'"OFF"'):
+                on = False
+            else:
+                return None
+        elif _equals(msg, start, end, COLOR_TEMP_KEY):
+            color_temp = _int_value(msg, i)
+            if color_temp is None:
+                return None
+        elif _equals(msg, start, end, BRIGHTNESS_KEY):
+            if _equals(msg, i, i + 4, b"null"):
+                brightness = None
+            else:
+                brightness = _int_value(msg, i)
+                if brightness is None:
+                    return None
+    # Never closed
+    return None
+
+class BrokerAddressCache:
+    def __init__(self, host, port, path=None, ttl_ms=3600000):
+        """
+        Cache of the broker's resolved address so reconnects can skip DNS.
+        
+        Args:
+            host: Broker host name or IP
+            port: Broker port
+            path: File the last working address is persisted to, or None
+            ttl_ms: How long a resolved address is used before resolving again
+        """
+        self.host = host
+        self.port = port
+        self.path = path
+        self.ttl_ms = ttl_ms
+        self.addr = None
+        self.resolved_time = 0
+        self.saved_ip = None
+        self._load()
+
+    def _load(self):
+        """Load the last working address from flash so a cold boot can skip DNS."""
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                data = ujson.load(f)
+            if data["host"] == self.host and data["port"] == self.port:
+                self.saved_ip = data["ip"]
+                self.addr = (data["ip"], self.port)
+                self.resolved_time = time.ticks_ms()
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def get(self):
+        """Return the cached address, or None if there is none or it has expired."""
+        if self.addr is None:
+            return None
+        if time.ticks_diff(time.ticks_ms(), self.resolved_time) >= self.ttl_ms:
+            self.addr = None
+        return self.addr
+
+    def resolve(self):
+        """Look up the broker address and cache it."""
+        self.addr = socket.getaddrinfo(self.host, self.port)[0][-1]
+        self.resolved_time = time.ticks_ms()
+        return self.addr
+
+    def invalidate(self):
+        """Forget the cached address after a failed connection."""
+        self.addr = None
+
+    def confirm(self):
+        """Persist the cached address after a successful connection, if it changed."""
+        if not self.path or self.addr is None or self.addr[0] == self.saved_ip:
+            return
+        try:
+            with open(self.path, "w") as f:
+                ujson.dump({"host": self.host, "port": self.port, "ip": self.addr[0]}, f)
+            self.saved_ip = self.addr[0]
+        except OSError as e:
+            print("Could not save broker address:", e)
+
 class MqttLightSync:
-    def __init__(self, broker, username, password, state_topic, on_update):
+    # Link states
+    DISCONNECTED = 'disconnected'
+    CONNECTING = 'connecting'
+    SUBSCRIBING = 'subscribing'
+    CONNECTED = 'connected'
+    
+    def __init__(self, broker, username, password, state_topic, on_update, on_connection_change=None, flush_interval_ms=0, on_rtt=None, on_confirm=None, scene_state_topic=None, on_scene_update=None, availability_topic=None, on_availability=None, config_topic=None, on_config=None):
         """
         Initialize MQTT client for light synchronization.
         
@@ -17,114 +206,571 @@ class MqttLightSync:
             broker: MQTT broker address
             username: MQTT username
             password: MQTT password
-            state_topic: Topic to subscribe for light state updates
-            on_update: Callback for state updates (receives state(bool), color_temp(int))
+            state_topic: Topic to subscribe for light state updates, or None to
+                register lights with add_light() instead
+            on_update: Callback for state updates (receives state(bool), color_temp(int),
+                brightness(int or None))
+            on_connection_change: Callback for link status (receives connected(bool))
+            flush_interval_ms: Minimum time between flushes of queued messages
+            on_rtt: Callback for command round-trip times (receives rtt_ms(int))
+            on_confirm: Callback for echoes of sent states (receives the sent
+                state(bool), color_temp(int), brightness(int or None))
+            scene_state_topic: Topic reporting the active scene, or None
+            on_scene_update: Callback for scene updates (receives scene_name(str))
+            availability_topic: Topic reporting light group availability, or None
+            on_availability: Callback for availability (receives available(bool))
+            config_topic: Topic filter for remote settings, one setting per last level, or None
+            on_config: Callback for remote settings (receives name(str), value(int))
         """
         self.broker = broker
         self.username = username
         self.password = password
-        self.state_topic = state_topic.encode()
+        # Default topics for publish_state and publish_scene
         self.command_topic = config.MQTT_TOPIC_SET.encode()
         self.scene_command_topic = config.MQTT_TOPIC_SCENE_SET.encode()
-        self.on_update = on_update
         self.client = None
-        self.ignore_next = False
-        self.led = LedController()  # Initialize LED controller
-        self.led.off()  # Start with LED off
+        self.on_connection_change = on_connection_change
+        self.connected = False
+        
+        # Reconnect state machine
+        self.link_state = self.DISCONNECTED
+        self.retry_delay_ms = config.MQTT_RECONNECT_MIN_MS
+        self.next_attempt_time = 0
+        self.connect_start_time = 0
+        self.suback_pid = None
+        self.using_cached_addr = False
+        # Set once the broker has been looked up since the link was last up
+        self.resolved_this_outage = False
+        self.network_up = True
+        self.addr_cache = BrokerAddressCache(
+            broker,
+            config.MQTT_PORT,
+            path=config.MQTT_ADDR_CACHE_FILE,
+            ttl_ms=config.MQTT_DNS_TTL_S * 1000
+        )
+        
+        # Outbound commands keyed by topic, as fields serialised at flush
+        # time; newer ones replace unsent ones. Dicts don't keep insertion
+        # order, so the send order is kept separately.
+        self.outbox = {}
+        self.outbox_order = []
+        self.flush_interval_ms = flush_interval_ms
+        self.last_flush_time = time.ticks_add(time.ticks_ms(), -flush_interval_ms)
+        
+        # Recently sent states as (state_topic, on, color_temp, brightness,
+        # sent_time, timed), oldest first; only messages matching one are echoes
+        self.echoes = []
+        # Round-trip measurement from a state command to its echo
+        self.on_rtt = on_rtt
+        
+        # Per-light handlers keyed by topic, see add_light()
+        self.lights = {}
+        self.echo_topics = {}
+        self.scene_handlers = {}
+        self.availability_handlers = {}
+        
+        # Topic dispatch: exact topics hashed to their handler; wildcard
+        # filters matched once per topic and then cached the same way; all
+        # sent in one SUBSCRIBE
+        self.subscriptions = []
+        self.routes = {}
+        self.wildcard_routes = []
+        self.route_cache = {}
+        self.on_config = on_config
+        if state_topic:
+            self.add_light(state_topic, self.command_topic, on_update, on_confirm,
+                           scene_state_topic, on_scene_update, availability_topic, on_availability)
+        if config_topic:
+            self.route(config_topic, self._on_config)
+
+    def _set_connected(self, connected):
+        """Record link status and report changes to the registered callback."""
+        if connected == self.connected:
+            return
+        self.connected = connected
+        if self.on_connection_change:
+            self.on_connection_change(connected)
+
+    def is_connected(self):
+        """Return True if the MQTT client is connected."""
+        return self.connected
+
+    def route(self, topic_filter, handler, qos=config.MQTT_SUBSCRIBE_QOS):
+        """Subscribe handler to a topic filter, which may contain + and # wildcards.
+        
+        Args:
+            topic_filter: MQTT topic filter (str or bytes)
+            handler: Called with (topic(bytes), msg) for matching messages; msg
+                is a view into the receive buffer, valid only during the call
+            qos: Subscription QoS
+        """
+        if isinstance(topic_filter, str):
+            topic_filter = topic_filter.encode()
+        self.subscriptions.append((topic_filter, qos))
+        if b"+" in topic_filter or b"#" in topic_filter:
+            self.wildcard_routes.append((tuple(topic_filter.split(b"/")), handler))
+            self.route_cache.clear()
+        else:
+            self.routes[topic_filter] = handler
+        if self.connected:
+            try:
+                self.client.subscribe(topic_filter, qos)
+            except Exception as e:
+                print("MQTT subscribe error:", e)
+                self._link_lost()
+        elif self.link_state == self.SUBSCRIBING:
+            # Missed the pending SUBSCRIBE; the broker acknowledges in
+            # order, so waiting for this one covers both
+            try:
+                self.suback_pid = self.client.subscribe_many([(topic_filter, qos)], wait=False)
+            except Exception as e:
+                print("MQTT subscribe error:", e)
+                self._connect_failed()
+
+    def add_light(self, state_topic, command_topic, on_update, on_confirm=None, scene_state_topic=None, on_scene_update=None, availability_topic=None, on_availability=None):
+        """Register a light group's topics on the shared connection.
+        
+        Args:
+            state_topic: Topic the group's state is reported on
+            command_topic: Topic its state commands are published to; echoes
+                of those commands on state_topic are suppressed
+            on_update: Callback for state updates (receives state(bool), color_temp(int),
+                brightness(int or None))
+            on_confirm: Callback for echoes of sent states (receives the sent
+                state(bool), color_temp(int), brightness(int or None))
+            scene_state_topic: Topic reporting the group's active scene, or None
+            on_scene_update: Callback for scene updates (receives scene_name(str))
+            availability_topic: Topic reporting the group's availability, or None
+            on_availability: Callback for availability (receives available(bool))
+        """
+        if isinstance(state_topic, str):
+            state_topic = state_topic.encode()
+        if isinstance(command_topic, str):
+            command_topic = command_topic.encode()
+        self.lights[state_topic] = (on_update, on_confirm)
+        self.echo_topics[command_topic] = state_topic
+        self.route(state_topic, self._on_state)
+        if scene_state_topic:
+            if isinstance(scene_state_topic, str):
+                scene_state_topic = scene_state_topic.encode()
+            self.scene_handlers[scene_state_topic] = on_scene_update
+            self.route(scene_state_topic, self._on_scene_state)
+        if availability_topic:
+            if isinstance(availability_topic, str):
+                availability_topic = availability_topic.encode()
+            self.availability_handlers[availability_topic] = on_availability
+            self.route(availability_topic, self._on_availability)
+
+    def _match_wildcard(self, topic):
+        """Return the handler of the first wildcard filter matching topic, or None."""
+        levels = topic.split(b"/")
+        for pattern, handler in self.wildcard_routes:
+            for i, level in enumerate(pattern):
+                if level == b"#":
+                    return handler
+                if i >= len(levels) or (level != b"+" and level != levels[i]):
+                    break
+            else:
+                if len(pattern) == len(levels):
+                    return handler
+        return None
 
     def _callback(self, topic, msg):
-        """Process incoming MQTT messages."""
-        print("MQTT Received:", topic, msg)
-        if self.ignore_next:
-            self.ignore_next = False
+        """Dispatch incoming MQTT messages to the handler registered for their topic.
+        
+        topic and msg are views into the client's receive buffer and are
+        only valid until this returns. The topic is copied once so it can
+        be hashed; handlers get that copy and the msg view.
+        """
+        topic = bytes(topic)
+        handler = self.routes.get(topic)
+        if handler is None:
+            if topic in self.route_cache:
+                handler = self.route_cache[topic]
+            else:
+                # Wildcard matches are resolved once per topic and cached
+                handler = self._match_wildcard(topic)
+                if len(self.route_cache) >= config.MQTT_ROUTE_CACHE_SIZE:
+                    self.route_cache.clear()
+                self.route_cache[topic] = handler
+        if handler is None:
+            print("MQTT unrouted message on", topic)
             return
+        handler(topic, msg)
 
+    def _on_state(self, topic, msg):
+        """Handle a light state message, parsing the receive buffer in place."""
         try:
-            data = ujson.loads(msg)
-            state = data.get("state", "OFF")
-            color_temp = int(data.get("color_temp", config.DEFAULT_COLOR_TEMP))
-            self.on_update(state == "ON", color_temp)
+            parsed = parse_light_state(msg)
+            if parsed is None:
+                # Only unusual payloads are copied for the full parser
+                data = ujson.loads(bytes(msg))
+                state = data.get("state", "OFF")
+                color_temp = int(data.get("color_temp", config.DEFAULT_COLOR_TEMP))
+                brightness = data.get("brightness")
+                if brightness is not None:
+                    brightness = int(brightness)
+                parsed = (state == "ON", color_temp, brightness)
+            print("MQTT Received:", topic, parsed)
+            on_update, on_confirm = self.lights[topic]
+            confirmed = self._match_echo(topic, *parsed)
+            if confirmed:
+                if on_confirm:
+                    on_confirm(*confirmed)
+                return
+            on_update(*parsed)
         except Exception as e:
             print("MQTT parse error:", e)
 
-    def connect(self):
-        """Connect to MQTT broker and subscribe to state topic."""
-        print(f"Connecting to MQTT @ {self.broker} as {CLIENT_ID.decode()}")
+    def _match_echo(self, topic, on, color_temp, brightness):
+        """Return the sent (on, color_temp, brightness) if a state message echoes a command we sent, else None.
+        
+        The matching entry and every older one for the same topic are
+        dropped; those commands were superseded, so their echoes would
+        only be stale.
+        """
+        now = time.ticks_ms()
+        echoes = self.echoes
+        # Forget commands HA never confirmed
+        while echoes and time.ticks_diff(now, echoes[0][4]) >= config.MQTT_ECHO_TIMEOUT_MS:
+            echoes.pop(0)
+        for i in range(len(echoes) - 1, -1, -1):
+            echo_topic, sent_on, sent_temp, sent_brightness, sent_time, timed = echoes[i]
+            if echo_topic != topic or sent_on != on:
+                continue
+            # HA's colour temperature and brightness aren't meaningful while off
+            if on and abs(sent_temp - color_temp) > config.MQTT_ECHO_TEMP_TOLERANCE:
+                continue
+            # A command without brightness leaves HA's as it was
+            if (on and brightness is not None and sent_brightness is not None
+                    and abs(sent_brightness - brightness) > config.MQTT_ECHO_BRIGHTNESS_TOLERANCE):
+                continue
+            self.echoes = [e for j, e in enumerate(echoes) if j > i or e[0] != topic]
+            if timed and self.on_rtt:
+                self.on_rtt(time.ticks_diff(now, sent_time))
+            return sent_on, sent_temp, sent_brightness
+        return None
+
+    def _on_scene_state(self, topic, msg):
+        """Handle an active scene message, either JSON or a bare scene name."""
+        try:
+            if len(msg) and msg[0] == 0x7B:  # '{'
+                scene_name = ujson.loads(bytes(msg))["scene"]
+            else:
+                scene_name = str(msg, "utf-8")
+            on_scene_update = self.scene_handlers[topic]
+            if on_scene_update:
+                on_scene_update(scene_name)
+        except Exception as e:
+            print("MQTT scene parse error:", e)
+
+    def _on_availability(self, topic, msg):
+        """Handle a light group availability message."""
+        on_availability = self.availability_handlers[topic]
+        if on_availability:
+            on_availability(_equals(msg, 0, len(msg), b"online"))
+
+    def _on_config(self, topic, msg):
+        """Handle a remote setting; the setting name is the last topic level."""
         try:
-            temp_client = MQTTClient(
+            name = topic[topic.rfind(b"/") + 1:].decode()
+            value = int(bytes(msg))
+            if self.on_config:
+                self.on_config(name, value)
+        except Exception as e:
+            print("MQTT config parse error:", e)
+
+    def connect(self):
+        """Start connecting to the MQTT broker; check() completes the connection."""
+        if self.client is None:
+            self.client = MQTTClient(
                 client_id=CLIENT_ID,
                 server=self.broker,
                 user=self.username,
                 password=self.password,
-                keepalive=config.MQTT_KEEPALIVE
+                port=config.MQTT_PORT,
+                keepalive=config.MQTT_KEEPALIVE,
+                max_inflight=config.MQTT_INFLIGHT_WINDOW,
+                rx_buf_size=config.MQTT_RX_BUFFER_SIZE,
+                tx_buf_size=config.MQTT_TX_BUFFER_SIZE
             )
-            temp_client.set_callback(self._callback)
-            temp_client.connect()
-            temp_client.subscribe(self.state_topic)
-            self.client = temp_client
-            print("Connected to MQTT and subscribed to", self.state_topic.decode())
-            self.led.on()  # Turn on LED to indicate successful connection
-        except Exception as e:
-            import sys
-            print("MQTT connection failed:")
-            sys.print_exception(e)
-            self.led.off()
+            self.client.set_callback(self._callback)
+        self.link_state = self.DISCONNECTED
+        self.next_attempt_time = time.ticks_ms()
+        self._step_reconnect()
 
     def check(self):
-        """Check for new MQTT messages."""
-        if self.client:
+        """Check for new MQTT messages, keep the link alive and advance reconnection."""
+        if self.link_state != self.CONNECTED:
+            self._step_reconnect()
+            return
+        try:
+            self.client.check_msg()
+            # Ping while idle so the broker keeps us, and catch a dead
+            # link before the next knob turn has to find out
+            if not self.client.check_keepalive():
+                raise OSError("no PINGRESP from broker")
+        except Exception as e:
+            print("MQTT check error:", e)
+            self._link_lost()
+
+    def _step_reconnect(self):
+        """Advance the reconnect state machine without blocking."""
+        now = time.ticks_ms()
+        if self.link_state == self.DISCONNECTED:
+            if self.client is None or not self.network_up:
+                return
+            if time.ticks_diff(now, self.next_attempt_time) < 0:
+                return
+            print(f"Connecting to MQTT @ {self.broker} as {CLIENT_ID.decode()}")
             try:
-                self.client.check_msg()
+                addr = self.addr_cache.get()
+                self.using_cached_addr = addr is not None
+                if addr is None:
+                    addr = self.addr_cache.resolve()
+                    self.resolved_this_outage = True
+                self.client.connect_start(clean_session=config.MQTT_CLEAN_SESSION, addr=addr)
             except Exception as e:
-                print("MQTT check error:", e)
-                self.led.off()  # Indicate connection issue
-                self._try_reconnect()
-
-    def _try_reconnect(self):
-        """Try to reconnect to MQTT broker."""
+                print("MQTT connection failed:", e)
+                self._connect_failed()
+                return
+            self.link_state = self.CONNECTING
+            self.connect_start_time = now
+            return
+        
         try:
-            self.client.disconnect()
-        except:
-            pass
+            if self.link_state == self.CONNECTING:
+                session_present = self.client.connect_poll(config.MQTT_SOCKET_TIMEOUT)
+                if session_present is None:
+                    self._check_connect_timeout(now)
+                    return
+                # Commands the broker never acknowledged go out again before anything new
+                self.client.resend_inflight()
+                # A resumed session still holds our subscriptions
+                if not session_present and self.subscriptions:
+                    # The SUBACK is collected by the reads below, like any message
+                    self.suback_pid = self.client.subscribe_many(self.subscriptions, wait=False)
+                    self.link_state = self.SUBSCRIBING
+            if self.link_state == self.SUBSCRIBING:
+                while self.client.suback_pid != self.suback_pid:
+                    if self.client.check_msg() is None:
+                        self._check_connect_timeout(now)
+                        return
+        except Exception as e:
+            print("MQTT connection failed:", e)
+            self._connect_failed()
+            return
+        
+        self.addr_cache.confirm()
+        elapsed = time.ticks_diff(time.ticks_ms(), self.connect_start_time)
+        print("Connected to MQTT in", elapsed, "ms with", len(self.subscriptions), "subscriptions")
+        self.link_state = self.CONNECTED
+        self.resolved_this_outage = False
+        self.retry_delay_ms = config.MQTT_RECONNECT_MIN_MS
+        self._set_connected(True)
+
+    def _check_connect_timeout(self, now):
+        """Raise OSError if the connection attempt has taken too long."""
+        if time.ticks_diff(now, self.connect_start_time) >= config.MQTT_CONNECT_TIMEOUT_MS:
+            raise OSError("connect timed out")
+
+    def socket(self):
+        """Return the socket incoming data arrives on, or None while not connected."""
+        if self.link_state != self.CONNECTED and self.link_state != self.SUBSCRIBING:
+            return None
+        return self.client.sock
+
+    def next_event_ms(self):
+        """Return ms until check() or flush() has work other than reading the socket.
+
+        Returns None if only socket data, a queued message or a Wi-Fi
+        change can give them work.
+        """
+        delay = self.next_flush_ms()
+        if self.link_state == self.CONNECTED:
+            pending = self.client.next_keepalive_ms()
+        elif self.link_state == self.CONNECTING:
+            # The TCP handshake can't be waited on; poll until it completes
+            pending = config.MQTT_POLL_MS
+        elif self.link_state == self.SUBSCRIBING:
+            # The SUBACK wakes us through the socket; otherwise give up in time
+            elapsed = time.ticks_diff(time.ticks_ms(), self.connect_start_time)
+            pending = max(0, config.MQTT_CONNECT_TIMEOUT_MS - elapsed)
+        elif self.client is not None and self.network_up:
+            pending = max(0, time.ticks_diff(self.next_attempt_time, time.ticks_ms()))
+        else:
+            pending = None
+        if delay is None or (pending is not None and pending < delay):
+            delay = pending
+        return delay
+
+    def is_idle(self):
+        """Return True if a lightsleep would hold up nothing in progress.
+        
+        A connection handshake is never idle. While disconnected the
+        link waits out its backoff, which may as well be spent asleep; the
+        next attempt follows the wake. Connected, the link is idle once
+        nothing is queued or awaiting acknowledgement.
+        """
+        if self.link_state == self.DISCONNECTED:
+            return True
+        if self.link_state != self.CONNECTED:
+            return False
+        return not self.outbox and not self.client.inflight
+
+    def wake(self):
+        """Get the link ready for commands when the user returns after an idle spell.
+        
+        Pings a connected broker so a session that died while we slept is
+        found straight away, and brings the next reconnect attempt forward.
+        """
+        if self.link_state == self.DISCONNECTED:
+            if self.network_up:
+                self.next_attempt_time = time.ticks_ms()
+            return
+        if self.link_state != self.CONNECTED:
+            return
         try:
-            self.connect()
-        except:
-            print("Reconnection failed")
+            self.client.ping()
+        except Exception as e:
+            print("MQTT ping error:", e)
+            self._link_lost()
+
+    def disconnect(self):
+        """Close the session cleanly and stay disconnected until connect() is called again."""
+        if self.link_state == self.CONNECTED:
+            try:
+                self.client.disconnect()
+            except Exception as e:
+                print("MQTT disconnect error:", e)
+        else:
+            self._close()
+        self.link_state = self.DISCONNECTED
+        self.network_up = False
+        self._set_connected(False)
+
+    def network_changed(self, up):
+        """React to Wi-Fi link changes reported by the supervisor."""
+        self.network_up = up
+        if not up:
+            if self.link_state != self.DISCONNECTED:
+                print("MQTT link down with WiFi")
+                self._link_lost()
+        elif self.link_state == self.DISCONNECTED:
+            # Reconnect straight away instead of waiting out the backoff
+            self.retry_delay_ms = config.MQTT_RECONNECT_MIN_MS
+            self.next_attempt_time = time.ticks_ms()
 
-    def publish_state(self, state, color_temp):
-        """Publish light state update to MQTT."""
-        if not self.client:
+    def _connect_failed(self):
+        """Clean up a failed attempt and decide when to try again."""
+        self._close()
+        if self.using_cached_addr and not self.resolved_this_outage:
+            # The broker may have moved; retry straight away with a fresh
+            # lookup, once per outage. A freshly resolved address is kept
+            # through the backoff so later attempts skip DNS.
+            print("Cached broker address failed, resolving again")
+            self.addr_cache.invalidate()
+            self.using_cached_addr = False
+            self.link_state = self.DISCONNECTED
+            self.next_attempt_time = time.ticks_ms()
             return
+        self._schedule_retry()
+
+    def _schedule_retry(self):
+        """Back off exponentially, with jitter, before the next connection attempt."""
+        self.link_state = self.DISCONNECTED
+        delay = self.retry_delay_ms
+        # Wait between half and all of the current delay so devices don't retry in lockstep
+        delay -= random.getrandbits(16) % (delay // 2 + 1)
+        self.next_attempt_time = time.ticks_add(time.ticks_ms(), delay)
+        self.retry_delay_ms = min(self.retry_delay_ms * 2, config.MQTT_RECONNECT_MAX_MS)
+        print("MQTT retry in", delay, "ms")
+
+    def _close(self):
+        """Close the client socket, ignoring errors from a dead link."""
+        try:
+            if self.client.sock:
+                self.client.sock.close()
+        except Exception:
+            pass
+
+    def _link_lost(self):
+        """Drop the connection and schedule a reconnect; queued messages are kept."""
+        self._close()
+        # Unacknowledged commands are resent after reconnecting, so their
+        # echoes may still come; restart their timeout but don't time them
+        now = time.ticks_ms()
+        self.echoes = [echo[:4] + (now, False) for echo in self.echoes]
+        self._set_connected(False)
+        self._schedule_retry()
+
+    def _queue(self, topic, fields):
+        """Queue fields for topic after everything already queued, replacing an unsent command."""
+        if topic in self.outbox:
+            self.outbox_order.remove(topic)
+        self.outbox[topic] = fields
+        self.outbox_order.append(topic)
+
+    def publish_state(self, state, color_temp, brightness, command_topic=None):
+        """Queue a light state update; replaces any unsent state update for the topic."""
+        self._queue(command_topic or self.command_topic, (state, color_temp, brightness))
             
-        payload = ujson.dumps({
+    def publish_scene(self, scene_name, command_topic=None):
+        """Queue a scene activation; replaces any unsent scene activation for the topic."""
+        self._queue(command_topic or self.scene_command_topic, scene_name)
+
+    def _payload(self, fields):
+        """Serialise queued fields: a scene name or an (on, color_temp, brightness) state."""
+        if isinstance(fields, str):
+            return ujson.dumps({"scene": fields})
+        state, color_temp, brightness = fields
+        payload = {
             "state": "ON" if state else "OFF",
             "color_temp": color_temp
-        })
-        
-        try:
-            # Ignore the next message since we'll receive our own update
-            self.ignore_next = True
-            self.client.publish(self.command_topic, payload)
-            print("Published: ", payload)
-        except Exception as e:
-            print("MQTT publish error:", e)
-            self.led.off()  # Indicate connection issue
-            self._try_reconnect()
-            
-    def publish_scene(self, scene_name):
-        """Publish scene activation to MQTT."""
-        if not self.client:
+        }
+        # Left out while unknown, so HA keeps the lights' brightness
+        if brightness is not None:
+            payload["brightness"] = brightness
+        return ujson.dumps(payload)
+
+    def next_flush_ms(self):
+        """Return ms until queued messages may be sent, or None if nothing can be sent."""
+        if not self.outbox or not self.connected or self.client.inflight_full():
+            # PUBACKs picked up by check() reopen a full in-flight window
+            return None
+        elapsed = time.ticks_diff(time.ticks_ms(), self.last_flush_time)
+        if elapsed < 0:
+            # Idle long enough for the tick counter to wrap past us
+            return 0
+        return max(0, self.flush_interval_ms - elapsed)
+
+    def flush(self):
+        """Send the latest queued message per topic, at most once per flush window."""
+        if self.next_flush_ms() != 0:
             return
-            
-        payload = ujson.dumps({
-            "scene": scene_name
-        })
+        self.last_flush_time = time.ticks_ms()
         
-        try:
-            self.ignore_next = True
-            self.client.publish(self.scene_command_topic, payload)
-            print("Published scene: ", payload)
-        except Exception as e:
-            print("MQTT scene publish error:", e)
-            self.led.off()
-            self._try_reconnect()
+        # Oldest first, so a scene and the state restored after it arrive in order
+        while self.outbox_order:
+            if self.client.inflight_full():
+                # Leave the rest queued; newer values keep replacing them
+                return
+            topic = self.outbox_order[0]
+            fields = self.outbox[topic]
+            payload = self._payload(fields)
+            try:
+                self.client.publish(topic, payload, qos=config.MQTT_COMMAND_QOS, wait=False)
+                if topic in self.echo_topics:
+                    # Remember the state so its echo can be recognised
+                    on, color_temp, brightness = fields
+                    self.echoes.append((self.echo_topics[topic], on, color_temp, brightness, time.ticks_ms(), True))
+                    if len(self.echoes) > config.MQTT_ECHO_SLOTS:
+                        self.echoes.pop(0)
+                del self.outbox[topic]
+                self.outbox_order.pop(0)
+                print("Published:", topic.decode(), payload)
+            except Exception as e:
+                # Unsent messages stay queued until the link is back
+                print("MQTT publish error:", e)
+                self._link_lost()
+                return
@@ -0,0 +1,163 @@
+import machine
+import network
+import time
+import uasyncio as asyncio
+import ujson
+import os
+import config
+
+def save_snapshot(path, snapshot):
+    """Write a state snapshot to flash before a deep sleep."""
+    try:
+        with open(path, "w") as f:
+            ujson.dump(snapshot, f)
+        return True
+    except OSError as e:
+        print("Could not save snapshot:", e)
+        return False
+
+def load_snapshot(path):
+    """Read and remove a snapshot left by a deep sleep, or return None."""
+    try:
+        with open(path) as f:
+            snapshot = ujson.load(f)
+    except (OSError, ValueError):
+        return None
+    try:
+        # Only the boot right after the deep sleep may use it
+        os.remove(path)
+    except OSError:
+        pass
+    return snapshot
+
+def woke_from_dormant():
+    """Return True if this boot is the wake from a dormant deep sleep.
+    
+    machine.deepsleep() ends in a reset: DEEPSLEEP_RESET on ports that
+    have it, a watchdog reset on the RP2040. Anything else, like a
+    power-on after the battery ran flat while dormant, isn't a wake.
+    """
+    return machine.reset_cause() == getattr(machine, "DEEPSLEEP_RESET", machine.WDT_RESET)
+
+class IdleManager:
+    # Power states
+    ACTIVE = 'active'
+    POWERSAVE = 'powersave'
+    SLEEP = 'sleep'
+    
+    def __init__(self, wlan, is_busy=None, on_wake=None, powersave_after_ms=10000, sleep_after_ms=None, max_sleep_ms=10000, dormant_after_ms=None, on_dormant=None):
+        """Initialize the idle manager.
+        
+        After powersave_after_ms without user activity the CYW43 radio is put
+        in power-save mode. After sleep_after_ms the CPU also lightsleeps
+        between wakes; the encoder and switch pin IRQs wake it early.
+        
+        Args:
+            wlan: WLAN interface whose power management is controlled
+            is_busy: Callable returning True while work is pending that must
+                not be frozen by a lightsleep (batches, connection handshakes,
+                unacknowledged commands, ...)
+            on_wake: Callback run when user activity ends an idle spell, in
+                power-save or lightsleep; timer wakes don't run it
+            powersave_after_ms: Idle time before the radio enters power-save
+            sleep_after_ms: Idle time before lightsleeping, or None to never sleep
+            max_sleep_ms: Longest single lightsleep; must stay well below half
+                the MQTT keepalive so pings still go out in time
+            dormant_after_ms: Idle time before deep sleeping until a pin wake,
+                or None to never go dormant
+            on_dormant: Callback run before the deep sleep, to save state and
+                shut down links and wake sources that shouldn't wake us
+        """
+        self.wlan = wlan
+        self.is_busy = is_busy
+        self.on_wake = on_wake
+        self.powersave_after_ms = powersave_after_ms
+        self.sleep_after_ms = sleep_after_ms
+        self.max_sleep_ms = max_sleep_ms
+        self.dormant_after_ms = dormant_after_ms
+        self.on_dormant = on_dormant
+        
+        self.state = self.ACTIVE
+        self.last_activity_time = time.ticks_ms()
+        
+        # Time spent in each state, for the current estimate
+        self.state_ms = {self.ACTIVE: 0, self.POWERSAVE: 0, self.SLEEP: 0}
+        self.state_start_time = self.last_activity_time
+        self.sleep_count = 0
+    
+    def _enter(self, state):
+        """Switch power state, accounting the time spent in the previous one."""
+        now = time.ticks_ms()
+        self.state_ms[self.state] += time.ticks_diff(now, self.state_start_time)
+        self.state_start_time = now
+        self.state = state
+    
+    def _set_radio_powersave(self, enabled):
+        """Switch the radio between power-save and full performance."""
+        try:
+            self.wlan.config(pm=network.WLAN.PM_POWERSAVE if enabled else network.WLAN.PM_PERFORMANCE)
+        except Exception as e:
+            print("WiFi power mode error:", e)
+    
+    def activity(self):
+        """Record user activity, leaving power-save straight away."""
+        self.last_activity_time = time.ticks_ms()
+        if self.state != self.ACTIVE:
+            self._set_radio_powersave(False)
+            self._enter(self.ACTIVE)
+            if self.on_wake:
+                self.on_wake()
+    
+    def _lightsleep(self):
+        """Lightsleep until a pin IRQ or max_sleep_ms."""
+        self._enter(self.SLEEP)
+        self.sleep_count += 1
+        machine.lightsleep(self.max_sleep_ms)
+        # Pin IRQs that woke us are handled once the other tasks run, and
+        # report the activity; a timer wake just lets due work run
+        self._enter(self.POWERSAVE)
+    
+    def _dormant(self):
+        """Deep sleep until a pin wake; the board resets and boots on wake."""
+        print("Going dormant", self.stats())
+        if self.on_dormant:
+            self.on_dormant()
+        machine.deepsleep()
+    
+    async def run(self):
+        """Step down the power state as idle time grows."""
+        while True:
+            idle_ms = time.ticks_diff(time.ticks_ms(), self.last_activity_time)
+            if self.state == self.ACTIVE and idle_ms >= self.powersave_after_ms:
+                self._set_radio_powersave(True)
+                self._enter(self.POWERSAVE)
+                print("Idle, radio power-save on", self.stats())
+            
+            if not (self.is_busy and self.is_busy()):
+                if self.dormant_after_ms is not None and idle_ms >= self.dormant_after_ms:
+                    self._dormant()
+                elif self.sleep_after_ms is not None and idle_ms >= self.sleep_after_ms:
+                    self._lightsleep()
+            # Let the other tasks run (keepalive, wakes) before sleeping again
+            await asyncio.sleep_ms(config.POWER_CHECK_MS)
+    
+    def stats(self):
+        """Return time per power state and the estimated current and battery life."""
+        self._enter(self.state)
+        state_ms = self.state_ms
+        total_ms = state_ms[self.ACTIVE] + state_ms[self.POWERSAVE] + state_ms[self.SLEEP]
+        if total_ms == 0:
+            return None
+        # Integer mA*ms keeps the estimate float-free
+        charge = (state_ms[self.ACTIVE] * config.CURRENT_ACTIVE_MA
+                  + state_ms[self.POWERSAVE] * config.CURRENT_POWERSAVE_MA
+                  + state_ms[self.SLEEP] * config.CURRENT_SLEEP_MA)
+        average_ma = charge // total_ms
+        return {
+            "active_ms": state_ms[self.ACTIVE],
+            "powersave_ms": state_ms[self.POWERSAVE],
+            "sleep_ms": state_ms[self.SLEEP],
+            "sleeps": self.sleep_count,
+            "average_ma": average_ma,
+            "battery_hours": config.BATTERY_MAH // max(1, average_ma)
+        }
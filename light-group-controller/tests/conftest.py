@@ -0,0 +1,125 @@
+import os
+import sys
+import time
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(TESTS_DIR)
+# Stand-ins for the MicroPython-only modules and the models behind them, then
+# the project and its lib directory, as they're laid out on the board
+sys.path[:0] = [os.path.join(TESTS_DIR, "stubs"), TESTS_DIR, PROJECT_DIR, os.path.join(PROJECT_DIR, "lib")]
+
+# MicroPython's tick counters wrap at 2**30 on the RP2
+TICKS_PERIOD = 1 << 30
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) % TICKS_PERIOD
+
+def ticks_diff(ticks1, ticks2):
+    half = TICKS_PERIOD // 2
+    return (ticks1 - ticks2 + half) % TICKS_PERIOD - half
+
+class FakeClock:
+    """Millisecond tick counter that only moves when a test advances it."""
+    
+    def __init__(self):
+        self.now = 0
+    
+    def ticks_ms(self):
+        return self.now
+    
+    def ticks_us(self):
+        return self.now * 1000 % TICKS_PERIOD
+    
+    def advance(self, ms):
+        self.now = ticks_add(self.now, ms)
+
+# Installed for imports that read the clock; each test gets its own below
+time.ticks_add = ticks_add
+time.ticks_diff = ticks_diff
+time.ticks_ms = FakeClock().ticks_ms
+time.ticks_us = FakeClock().ticks_us
+
+class FakeSocket:
+    """In-memory socket: reads come from feed(), writes collect in sent."""
+    
+    def __init__(self):
+        self.incoming = bytearray()
+        self.sent = bytearray()
+        self.timeout = None
+        self.closed = False
+    
+    def feed(self, data):
+        self.incoming += data
+    
+    def settimeout(self, timeout):
+        self.timeout = timeout
+    
+    def setblocking(self, flag):
+        self.timeout = None if flag else 0
+    
+    def _take(self, n):
+        if not self.incoming:
+            if self.timeout == 0:
+                return None
+            # A blocking read on the board would wait; nothing will arrive here
+            raise OSError(110)  # ETIMEDOUT
+        data = bytes(self.incoming[:n])
+        del self.incoming[:n]
+        return data
+    
+    def read(self, n):
+        return self._take(n)
+    
+    def readinto(self, buf, n=None):
+        data = self._take(len(buf) if n is None else n)
+        if data is None:
+            return None
+        buf[:len(data)] = data
+        return len(data)
+    
+    def write(self, data, n=None):
+        data = bytes(data[:n] if n is not None else data)
+        self.sent += data
+        return len(data)
+    
+    def close(self):
+        self.closed = True
+
+@pytest.fixture(autouse=True)
+def pins():
+    """Start each test with every GPIO unconfigured."""
+    import machine
+    machine.Pin.levels.clear()
+    machine.Pin.handlers.clear()
+    return machine.Pin.levels
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch, tmp_path):
+    """Give each test a fresh clock, and a scratch directory for cache files."""
+    fake = FakeClock()
+    monkeypatch.setattr(time, "ticks_ms", fake.ticks_ms)
+    monkeypatch.setattr(time, "ticks_us", fake.ticks_us, raising=False)
+    monkeypatch.setattr(time, "sleep_ms", fake.advance, raising=False)
+    monkeypatch.chdir(tmp_path)
+    return fake
+
+@pytest.fixture
+def connected_mqtt(clock):
+    """Return an MqttLightSync whose client is connected to a FakeSocket."""
+    import config
+    from mqtt import MqttLightSync, CLIENT_ID
+    from umqtt.simple import MQTTClient
+    
+    sync = MqttLightSync("broker", "user", "password", state_topic=None, on_update=None,
+                         flush_interval_ms=config.MQTT_FLUSH_MS)
+    client = MQTTClient(CLIENT_ID, "broker", keepalive=config.MQTT_KEEPALIVE,
+                        rx_buf_size=config.MQTT_RX_BUFFER_SIZE, tx_buf_size=config.MQTT_TX_BUFFER_SIZE)
+    client.set_callback(sync._callback)
+    client.sock = FakeSocket()
+    client.last_tx = clock.now
+    sync.client = client
+    sync.link_state = sync.CONNECTED
+    sync.connected = True
+    return sync
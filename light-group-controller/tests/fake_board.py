@@ -0,0 +1,244 @@
+"""Host model of what surrounds the board: an MQTT broker, the encoder's hands and the credentials file.
+
+install() points the socket and select calls of umqtt.simple and mqtt at
+a Broker, puts a fake secrets module in place for main and wifi, and
+makes sleeps move the fake clock, so a test can boot main.run() or drive
+its tasks with the uasyncio stub's run_for(). Import main and wifi only
+after install(); the stdlib has a secrets module of its own.
+"""
+import sys
+import time
+import types
+
+import machine
+import uasyncio
+from conftest import FakeSocket
+
+# Gray code states, (clk << 1) | dt, for one detent each way from rest
+CLOCKWISE = (0b01, 0b00, 0b10, 0b11)
+COUNTER_CLOCKWISE = (0b10, 0b00, 0b01, 0b11)
+
+POLLOUT = 0x0004
+POLLERR = 0x0008
+POLLHUP = 0x0010
+
+def encode_length(n):
+    """Return the MQTT variable-length encoding of n."""
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        out.append(byte | 0x80 if n else byte)
+        if not n:
+            return bytes(out)
+
+def publish_packet(topic, payload, retain=False):
+    """Return a QoS 0 PUBLISH packet as the broker sends it."""
+    body = len(topic).to_bytes(2, "big") + topic + payload
+    return bytes([0x31 if retain else 0x30]) + encode_length(len(body)) + body
+
+def topic_matches(topic_filter, topic):
+    """Return True if topic matches an MQTT topic filter with + and # wildcards."""
+    levels = topic.split(b"/")
+    filter_levels = topic_filter.split(b"/")
+    for i, level in enumerate(filter_levels):
+        if level == b"#":
+            return True
+        if i >= len(levels) or (level != b"+" and level != levels[i]):
+            return False
+    return len(levels) == len(filter_levels)
+
+class BrokerSocket(FakeSocket):
+    """Client end of a TCP connection to a Broker; writes are read as MQTT packets."""
+    
+    def __init__(self, broker):
+        super().__init__()
+        self.broker = broker
+        self.addr = None
+        self.unparsed = bytearray()
+        self.subscriptions = []
+        # Packets written, one entry per write() call
+        self.writes = []
+    
+    def connect(self, addr):
+        self.addr = addr
+    
+    def write(self, data, n=None):
+        written = super().write(data, n)
+        chunk = bytes(self.sent[len(self.sent) - written:])
+        self.writes.append(chunk)
+        self.unparsed += chunk
+        self._parse()
+        return written
+    
+    def _parse(self):
+        """Hand every complete packet written so far to the broker."""
+        while len(self.unparsed) >= 2:
+            length = 0
+            shift = 0
+            i = 1
+            while True:
+                if i >= len(self.unparsed):
+                    return
+                byte = self.unparsed[i]
+                length |= (byte & 0x7F) << shift
+                shift += 7
+                i += 1
+                if not byte & 0x80:
+                    break
+            if len(self.unparsed) < i + length:
+                return
+            kind = self.unparsed[0]
+            body = bytes(self.unparsed[i:i + length])
+            del self.unparsed[:i + length]
+            self.broker.receive(self, kind, body)
+    
+    def reply(self, data):
+        """Deliver data to the client after the broker's latency."""
+        uasyncio.call_later(self.broker.latency_ms, self._arrive, data)
+    
+    def _arrive(self, data):
+        if not self.closed:
+            self.feed(data)
+
+class Broker:
+    """Stand-in MQTT broker, answering each packet after latency_ms of simulated time.
+    
+    Records every PUBLISH it receives in published as (ticks_ms, topic,
+    payload) and keeps retained ones, which it sends on to new matching
+    subscriptions like a real broker.
+    """
+    
+    def __init__(self, ip="192.168.1.10", latency_ms=20, dns_ms=150):
+        self.ip = ip
+        self.latency_ms = latency_ms
+        # Time a blocking getaddrinfo() takes
+        self.dns_ms = dns_ms
+        self.retained = {}
+        self.published = []
+        self.sockets = []
+        self.lookups = 0
+        self.session_present = False
+        self.answer_pings = True
+        self.answer_publishes = True
+        # False leaves TCP handshakes pending, as for a host that is down
+        self.reachable = True
+    
+    def getaddrinfo(self, host, port, *args):
+        self.lookups += 1
+        time.sleep_ms(self.dns_ms)
+        return [(2, 1, 0, "", (self.ip, port))]
+    
+    def socket(self, *args):
+        sock = BrokerSocket(self)
+        self.sockets.append(sock)
+        return sock
+    
+    def receive(self, sock, kind, body):
+        packet_type = kind & 0xF0
+        if packet_type == 0x10:
+            sock.reply(bytes([0x20, 2, 1 if self.session_present else 0, 0]))
+        elif packet_type == 0x80:
+            pid = body[:2]
+            filters = []
+            i = 2
+            while i < len(body):
+                n = (body[i] << 8) | body[i + 1]
+                filters.append(body[i + 2:i + 2 + n])
+                i += 3 + n
+            sock.subscriptions += filters
+            sock.reply(bytes([0x90, 2 + len(filters)]) + pid + bytes([1] * len(filters)))
+            for topic, payload in self.retained.items():
+                if any(topic_matches(topic_filter, topic) for topic_filter in filters):
+                    sock.reply(publish_packet(topic, payload, retain=True))
+        elif packet_type == 0xC0:
+            if self.answer_pings:
+                sock.reply(b"\xd0\x00")
+        elif packet_type == 0x30:
+            n = (body[0] << 8) | body[1]
+            topic = body[2:2 + n]
+            i = 2 + n
+            if kind & 0x06:
+                if not self.answer_publishes:
+                    return
+                sock.reply(b"\x40\x02" + body[i:i + 2])
+                i += 2
+            self.published.append((time.ticks_ms(), topic, body[i:]))
+            if kind & 0x01:
+                self.retained[topic] = body[i:]
+    
+    def deliver(self, topic, payload, retain=False):
+        """Publish to every connected client subscribed to topic, as Home Assistant would."""
+        if retain:
+            self.retained[topic] = payload
+        for sock in self.sockets:
+            if not sock.closed and any(topic_matches(f, topic) for f in sock.subscriptions):
+                sock.reply(publish_packet(topic, payload))
+    
+    def commands(self):
+        """Return (ticks_ms, topic, payload) of every command published to a .../set topic."""
+        return [entry for entry in self.published if entry[1].endswith(b"/set")]
+
+class Poller:
+    """select.poll() over broker sockets: the TCP handshake completes at once if the broker is up."""
+    
+    def __init__(self, broker):
+        self.broker = broker
+        self.registered = []
+    
+    def register(self, sock, mask=POLLOUT):
+        self.registered.append(sock)
+    
+    def unregister(self, sock):
+        self.registered.remove(sock)
+    
+    def poll(self, timeout=-1):
+        if not self.broker.reachable:
+            return []
+        return [(sock, POLLOUT) for sock in self.registered]
+
+def lightsleep(ms=None):
+    """Sleep the fake clock for ms, or until the next scripted pin edge wakes the CPU."""
+    wake = uasyncio.next_call_ms()
+    if ms is None or (wake is not None and wake < ms):
+        ms = wake or 0
+    time.sleep_ms(ms)
+
+def install(monkeypatch, **broker_settings):
+    """Wire the controller's modules to a new Broker on a fresh event loop, and return it."""
+    import umqtt.simple
+    import mqtt
+    broker = Broker(**broker_settings)
+    net = types.SimpleNamespace(socket=broker.socket, getaddrinfo=broker.getaddrinfo)
+    select = types.SimpleNamespace(poll=lambda: Poller(broker), POLLOUT=POLLOUT, POLLERR=POLLERR, POLLHUP=POLLHUP)
+    monkeypatch.setattr(umqtt.simple, "socket", net)
+    monkeypatch.setattr(umqtt.simple, "select", select)
+    monkeypatch.setattr(mqtt, "socket", net)
+    
+    secrets = types.ModuleType("secrets")
+    secrets.MQTT_BROKER = "broker.local"
+    secrets.MQTT_USER = "controller"
+    secrets.MQTT_PASSWORD = "password"
+    secrets.WIFI_SSID = "<your-wifi-ssid>"
+    secrets.WIFI_PASSWORD = "password"
+    monkeypatch.setitem(sys.modules, "secrets", secrets)
+    
+    monkeypatch.setattr(time, "sleep", lambda seconds: time.sleep_ms(int(seconds * 1000)))
+    monkeypatch.setattr(machine, "lightsleep", lightsleep)
+    uasyncio.new_event_loop()
+    return broker
+
+def set_pins(clk_pin, dt_pin, state):
+    machine.Pin.drive(clk_pin, state >> 1)
+    machine.Pin.drive(dt_pin, state & 1)
+
+def turn(delay_ms, detents=1, clk_pin=13, dt_pin=12, edge_ms=2):
+    """Script a turn of the knob by detents, starting delay_ms from now."""
+    states = (CLOCKWISE if detents > 0 else COUNTER_CLOCKWISE) * abs(detents)
+    for i, state in enumerate(states):
+        uasyncio.call_later(delay_ms + i * edge_ms, set_pins, clk_pin, dt_pin, state)
+
+def press(delay_ms, hold_ms=80, sw_pin=14):
+    """Script a press and release of the switch, starting delay_ms from now."""
+    uasyncio.call_later(delay_ms, machine.Pin.drive, sw_pin, 0)
+    uasyncio.call_later(delay_ms + hold_ms, machine.Pin.drive, sw_pin, 1)
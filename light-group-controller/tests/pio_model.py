@@ -0,0 +1,185 @@
+"""Instruction-level model of an RP2 PIO state machine.
+
+Covers the subset of the instruction set the encoder's programs use:
+jmp (always, !x, !y, x--, y--), mov (with invert), in, out, push,
+irq and nop. There is no autopush/autopull, no side-set and no delays;
+each instruction takes one step.
+"""
+import types
+
+from machine import Pin
+
+MASK = 0xFFFFFFFF
+SHIFT_LEFT = 0
+SHIFT_RIGHT = 1
+RX_FIFO_DEPTH = 4
+
+class Program:
+    def __init__(self, instructions, labels, in_shiftdir, out_shiftdir):
+        self.instructions = instructions
+        self.labels = labels
+        self.in_shiftdir = in_shiftdir
+        self.out_shiftdir = out_shiftdir
+
+def assemble(program, in_shiftdir=SHIFT_LEFT, out_shiftdir=SHIFT_LEFT, **settings):
+    """Run an asm_pio function body, recording its instructions and labels."""
+    instructions = []
+    labels = {}
+    
+    def jmp(cond, target=None):
+        if target is None:
+            cond, target = None, cond
+        instructions.append(("jmp", cond, target))
+    
+    def label(name):
+        labels[name] = len(instructions)
+    
+    def mov(dest, src):
+        inverted = isinstance(src, tuple)
+        instructions.append(("mov", dest, src[1] if inverted else src, inverted))
+    
+    def in_(src, count):
+        instructions.append(("in", src, count))
+    
+    def out(dest, count):
+        instructions.append(("out", dest, count))
+    
+    def push(block="block"):
+        instructions.append(("push", block))
+    
+    def irq(index):
+        instructions.append(("irq", index))
+    
+    def nop():
+        instructions.append(("nop",))
+    
+    env = {
+        "__builtins__": __builtins__,
+        "jmp": jmp, "label": label, "mov": mov, "in_": in_, "out": out,
+        "push": push, "irq": irq, "nop": nop,
+        "invert": lambda src: ("invert", src),
+        "rel": lambda index: index,
+        "noblock": "noblock", "block": "block",
+        "x": "x", "y": "y", "isr": "isr", "osr": "osr", "pins": "pins",
+        "pc": "pc", "null": "null",
+        "x_dec": "x_dec", "y_dec": "y_dec", "not_x": "not_x", "not_y": "not_y",
+    }
+    types.FunctionType(program.__code__, env)()
+    resolved = []
+    for instruction in instructions:
+        if instruction[0] == "jmp":
+            instruction = ("jmp", instruction[1], labels[instruction[2]])
+        resolved.append(instruction)
+    return Program(resolved, labels, in_shiftdir, out_shiftdir)
+
+class StateMachine:
+    """Runs a Program one instruction at a time, only when asked to."""
+    
+    def __init__(self, sm_id, program, in_base=None, **settings):
+        if len(program.instructions) > 32:
+            raise ValueError("program too long")
+        self.program = program
+        self.in_base = in_base.id if in_base is not None else 0
+        self.pc = 0
+        self.x = 0
+        self.y = 0
+        self.isr = 0
+        self.osr = 0
+        self.rx = []
+        self.running = False
+        self.irq_handler = None
+        self.irqs = 0
+        self.steps = 0
+    
+    def active(self, value=None):
+        if value is None:
+            return self.running
+        self.running = bool(value)
+    
+    def irq(self, handler):
+        self.irq_handler = handler
+    
+    def rx_fifo(self):
+        return len(self.rx)
+    
+    def get(self, buf=None, shift=0):
+        # The hardware blocks until the program pushes
+        for _ in range(1000):
+            if self.rx:
+                return self.rx.pop(0) >> shift
+            self.step()
+        raise RuntimeError("program never pushed")
+    
+    def _read(self, src):
+        if src == "pins":
+            return Pin(self.in_base).value() | Pin(self.in_base + 1).value() << 1
+        if src == "null":
+            return 0
+        return getattr(self, src)
+    
+    def _write(self, dest, value):
+        if dest == "pc":
+            self.pc = value & 31
+        elif dest != "null":
+            setattr(self, dest, value & MASK)
+    
+    def step(self):
+        """Execute the instruction at pc."""
+        instruction = self.program.instructions[self.pc]
+        op = instruction[0]
+        self.pc = (self.pc + 1) % len(self.program.instructions)
+        self.steps += 1
+        if op == "jmp":
+            cond, target = instruction[1], instruction[2]
+            if cond is None:
+                taken = True
+            elif cond in ("x_dec", "y_dec"):
+                reg = cond[0]
+                taken = getattr(self, reg) != 0
+                setattr(self, reg, (getattr(self, reg) - 1) & MASK)
+            elif cond in ("not_x", "not_y"):
+                taken = getattr(self, cond[-1]) == 0
+            else:
+                raise NotImplementedError(cond)
+            if taken:
+                self.pc = target
+        elif op == "mov":
+            value = self._read(instruction[2])
+            if instruction[3]:
+                value = ~value & MASK
+            self._write(instruction[1], value)
+        elif op == "in":
+            count = instruction[2]
+            data = self._read(instruction[1]) & ((1 << count) - 1)
+            if self.program.in_shiftdir == SHIFT_LEFT:
+                self.isr = (self.isr << count | data) & MASK
+            else:
+                self.isr = self.isr >> count | data << (32 - count)
+        elif op == "out":
+            count = instruction[2]
+            if self.program.out_shiftdir == SHIFT_RIGHT:
+                data = self.osr & ((1 << count) - 1)
+                self.osr >>= count
+            else:
+                data = self.osr >> (32 - count)
+                self.osr = (self.osr << count) & MASK
+            self._write(instruction[1], data)
+        elif op == "push":
+            # A full FIFO drops a noblock push; the ISR is cleared either way
+            if len(self.rx) < RX_FIFO_DEPTH:
+                self.rx.append(self.isr)
+            self.isr = 0
+        elif op == "irq":
+            self.irqs += 1
+            if self.irq_handler:
+                self.irq_handler(self)
+        elif op != "nop":
+            raise NotImplementedError(op)
+    
+    def run_until(self, address, limit=1000):
+        """Step until pc reaches address again, having left it first."""
+        for _ in range(limit):
+            self.step()
+            if self.pc == address:
+                return
+        raise RuntimeError("program never reached", address)
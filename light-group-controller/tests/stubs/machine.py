@@ -0,0 +1,123 @@
+"""Host stand-in for the parts of MicroPython's machine module the tests touch."""
+
+PWRON_RESET = 1
+WDT_RESET = 3
+
+class Pin:
+    """GPIO whose level is shared by every Pin object for the same id."""
+    
+    IN = 0
+    OUT = 1
+    PULL_UP = 1
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+    
+    # Pin id -> level
+    levels = {}
+    # Pin id -> (pin, IRQ handler)
+    handlers = {}
+    
+    def __init__(self, id, mode=-1, pull=-1):
+        self.id = id
+        if id not in Pin.levels:
+            Pin.levels[id] = 1 if pull == Pin.PULL_UP else 0
+        self.handler = None
+    
+    def value(self, value=None):
+        if value is None:
+            return Pin.levels[self.id]
+        Pin.levels[self.id] = value
+    
+    def on(self):
+        self.value(1)
+    
+    def off(self):
+        self.value(0)
+    
+    def toggle(self):
+        self.value(self.value() ^ 1)
+    
+    def irq(self, handler=None, trigger=0, hard=False):
+        self.handler = handler
+        Pin.handlers[self.id] = (self, handler)
+    
+    @classmethod
+    def drive(cls, id, level):
+        """Set an input from outside, running its IRQ handler if the level changes."""
+        if cls.levels.get(id) == level:
+            return
+        cls.levels[id] = level
+        pin, handler = cls.handlers.get(id, (None, None))
+        if handler:
+            handler(pin)
+
+class PWM:
+    """PWM slice output; duty_u16 writes collect in duties."""
+    
+    def __init__(self, pin):
+        self.pin = pin
+        self.frequency = 0
+        self.duty = 0
+        self.duties = []
+    
+    def freq(self, value=None):
+        if value is None:
+            return self.frequency
+        self.frequency = value
+    
+    def duty_u16(self, value=None):
+        if value is None:
+            return self.duty
+        self.duty = value
+        self.duties.append(value)
+    
+    def deinit(self):
+        pass
+
+class Timer:
+    """Hardware timer that only fires when a test calls fire()."""
+    
+    ONE_SHOT = 0
+    PERIODIC = 1
+    
+    def __init__(self, id=-1):
+        self.mode = None
+        self.period = None
+        self.callback = None
+    
+    def init(self, mode=PERIODIC, period=-1, callback=None):
+        self.mode = mode
+        self.period = period
+        self.callback = callback
+    
+    def deinit(self):
+        self.callback = None
+    
+    def fire(self):
+        """Run the callback as the timer expiring would; a one-shot timer is then spent."""
+        callback = self.callback
+        if self.mode == Timer.ONE_SHOT:
+            self.callback = None
+        callback(self)
+
+class ADC:
+    def __init__(self, pin):
+        self.pin = pin
+    
+    def read_u16(self):
+        return 0
+
+def unique_id():
+    return b"\xe6\x61\x41\x04\x03\x2f\x5a\x2c"
+
+def reset_cause():
+    return PWRON_RESET
+
+def lightsleep(ms=None):
+    pass
+
+def deepsleep(ms=None):
+    pass
+
+def reset():
+    raise SystemExit("machine.reset()")
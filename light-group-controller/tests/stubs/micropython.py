@@ -0,0 +1,8 @@
+"""Host stand-in for MicroPython's micropython module."""
+
+def const(value):
+    return value
+
+def schedule(function, arg):
+    """Run function(arg) at once; the host has no IRQs to defer it from."""
+    function(arg)
@@ -0,0 +1,85 @@
+"""Host stand-in for MicroPython's network module: a CYW43 STA interface and one access point.
+
+The access point's behaviour is set through WLAN class attributes, which
+tests change to script joins; every interface sees the same one.
+"""
+import time
+
+STA_IF = 0
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_NO_AP_FOUND = -2
+STAT_GOT_IP = 3
+
+class WLAN:
+    PM_NONE = 0x10
+    PM_PERFORMANCE = 0xA11140
+    PM_POWERSAVE = 0x111022
+    
+    # The access point
+    ssid = "<your-wifi-ssid>"
+    bssid = b"\x02\x00\x00\x00\x00\x01"
+    # ms from connect() to an IP: association plus DHCP, or association only
+    dhcp_join_ms = 2500
+    static_join_ms = 400
+    # Whether a join pinned to a BSSID finds it
+    bssid_reachable = True
+    # Address DHCP hands out
+    lease = ("192.168.1.50", "255.255.255.0", "192.168.1.1", "192.168.1.1")
+    
+    def __init__(self, interface=STA_IF):
+        self.pm = self.PM_PERFORMANCE
+        self.is_active = False
+        self.dhcp = True
+        self.address = ("0.0.0.0", "0.0.0.0", "0.0.0.0", "0.0.0.0")
+        self.join_time = None
+        self.join_bssid = None
+        # (dhcp, bssid) of every connect()
+        self.joins = []
+        self.scans = 0
+    
+    def active(self, state=None):
+        if state is None:
+            return self.is_active
+        self.is_active = bool(state)
+        if not state:
+            self.join_time = None
+    
+    def config(self, pm=None):
+        self.pm = pm
+    
+    def connect(self, ssid, key, bssid=None):
+        self.joins.append((self.dhcp, bssid))
+        self.join_time = time.ticks_ms()
+        self.join_bssid = bssid
+    
+    def disconnect(self):
+        self.join_time = None
+    
+    def status(self):
+        if self.join_time is None:
+            return STAT_IDLE
+        if self.join_bssid is not None and not (self.bssid_reachable and self.join_bssid == self.bssid):
+            return STAT_CONNECTING
+        join_ms = self.dhcp_join_ms if self.dhcp else self.static_join_ms
+        if time.ticks_diff(time.ticks_ms(), self.join_time) < join_ms:
+            return STAT_CONNECTING
+        if self.dhcp:
+            self.address = WLAN.lease
+        return STAT_GOT_IP
+    
+    def isconnected(self):
+        return self.status() == STAT_GOT_IP
+    
+    def ifconfig(self, config=None):
+        if config is None:
+            return self.address
+        if config == "dhcp":
+            self.dhcp = True
+        else:
+            self.dhcp = False
+            self.address = tuple(config)
+    
+    def scan(self):
+        self.scans += 1
+        return [(self.ssid.encode(), self.bssid, 6, -55, 3, False)]
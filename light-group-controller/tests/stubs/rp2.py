@@ -0,0 +1,11 @@
+"""Host stand-in for rp2: asm_pio programs are assembled for pio_model."""
+from pio_model import assemble, StateMachine
+
+class PIO:
+    SHIFT_LEFT = 0
+    SHIFT_RIGHT = 1
+
+def asm_pio(**settings):
+    def decorator(program):
+        return assemble(program, **settings)
+    return decorator
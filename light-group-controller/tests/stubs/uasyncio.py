@@ -0,0 +1,275 @@
+"""Host stand-in for uasyncio: a single-threaded scheduler on the fake tick clock.
+
+As in uasyncio, a task blocks by registering itself with what it waits on
+(a timer, an Event, a socket on the IO queue) and then yielding. When no
+task is ready the scheduler wakes tasks whose socket has data, and
+otherwise moves the clock straight to the next timer, so tests can run
+the real tasks through simulated hours.
+
+Beyond the uasyncio API, tests use new_event_loop() to start afresh,
+run_for() to run the scheduler for a stretch of simulated time, and
+call_later() to script the outside world (broker replies, pin edges).
+"""
+import heapq
+import time
+from collections import deque
+
+class TimeoutError(Exception):
+    pass
+
+class CancelledError(BaseException):
+    pass
+
+class _Suspend:
+    """Awaitable that yields to the scheduler once."""
+    
+    def __await__(self):
+        yield
+    
+    __iter__ = __await__
+
+_SUSPEND = _Suspend()
+
+class Task:
+    def __init__(self, coro):
+        self.coro = coro
+        self.name = getattr(coro, "__name__", "task")
+        self.done = False
+        self.result = None
+        self.exception = None
+        # Bumped on every wake, so older registrations go stale
+        self.token = 0
+        self.waiters = []
+        # ticks_ms of every run, for wake accounting
+        self.runs = []
+    
+    def cancel(self):
+        if self.done:
+            return
+        self.token += 1
+        self.coro.close()
+        self._finish(exception=CancelledError())
+    
+    def _finish(self, result=None, exception=None):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        for waiter in self.waiters:
+            _wake(waiter)
+        self.waiters = []
+    
+    def __await__(self):
+        if not self.done:
+            self.waiters.append(_register())
+            yield
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+    
+    __iter__ = __await__
+
+class _IOQueue:
+    def __init__(self):
+        self.readers = []
+    
+    def queue_read(self, sock):
+        self.readers.append((sock, _register()))
+    
+    def poll(self):
+        """Wake tasks whose socket has data, or was closed, to read."""
+        waiting = []
+        for sock, waiter in self.readers:
+            if sock.incoming or sock.closed:
+                _wake(waiter)
+            elif waiter[0].token == waiter[1]:
+                waiting.append((sock, waiter))
+        self.readers = waiting
+
+class core:
+    _io_queue = None
+
+_ready = deque()
+# Heap of (deadline, sequence, waiter or (callback, args)); deadlines are
+# ms on the loop's own clock, which doesn't wrap like ticks_ms
+_timers = []
+_sequence = 0
+_current = None
+# (ticks_ms, loop ms) when the loop clock was last read
+_clock_state = [0, 0]
+
+def new_event_loop():
+    """Drop every task, timer and socket watch."""
+    global _current
+    _ready.clear()
+    del _timers[:]
+    _current = None
+    _clock_state[:] = [time.ticks_ms(), 0]
+    core._io_queue = _IOQueue()
+
+def _register():
+    """Return the running task's wake registration."""
+    return (_current, _current.token)
+
+def _wake(waiter):
+    task, token = waiter
+    if task.token == token and not task.done:
+        task.token += 1
+        _ready.append(task)
+
+def _clock():
+    """Return ms since new_event_loop()."""
+    now = time.ticks_ms()
+    _clock_state[1] += time.ticks_diff(now, _clock_state[0])
+    _clock_state[0] = now
+    return _clock_state[1]
+
+def _add_timer(ms, target):
+    global _sequence
+    _sequence += 1
+    heapq.heappush(_timers, (_clock() + max(0, ms), _sequence, target))
+
+def _live(target):
+    return callable(target[0]) or (target[0].token == target[1] and not target[0].done)
+
+def _fire(target):
+    if callable(target[0]):
+        target[0](*target[1])
+    else:
+        _wake(target)
+
+def call_later(ms, callback, *args):
+    """Run callback(*args) from the scheduler ms from now (test helper)."""
+    _add_timer(ms, (callback, args))
+
+def next_call_ms():
+    """Return ms until the next call_later() callback, or None (test helper)."""
+    delays = [deadline for deadline, sequence, target in _timers if callable(target[0])]
+    return max(0, min(delays) - _clock()) if delays else None
+
+def block_ms(ms):
+    """Hold the CPU for ms like a blocking call, running call_later() callbacks as they come due (test helper).
+    
+    Callbacks stand in for pin IRQs, which still fire while a task blocks;
+    tasks whose timers expire meanwhile run once the block is over.
+    """
+    end = _clock() + ms
+    held = []
+    while _timers and _timers[0][0] <= end:
+        entry = heapq.heappop(_timers)
+        if not callable(entry[2][0]):
+            held.append(entry)
+            continue
+        if entry[0] > _clock():
+            time.sleep_ms(entry[0] - _clock())
+        _fire(entry[2])
+    for entry in held:
+        heapq.heappush(_timers, entry)
+    if end > _clock():
+        time.sleep_ms(end - _clock())
+
+def create_task(coro):
+    task = Task(coro)
+    _ready.append(task)
+    return task
+
+async def sleep_ms(ms):
+    _add_timer(ms, _register())
+    await _SUSPEND
+
+async def sleep(seconds):
+    await sleep_ms(int(seconds * 1000))
+
+async def wait_for_ms(awaitable, timeout):
+    task = awaitable if isinstance(awaitable, Task) else create_task(awaitable)
+    waiter = _register()
+    task.waiters.append(waiter)
+    _add_timer(timeout, waiter)
+    await _SUSPEND
+    if not task.done:
+        task.cancel()
+        raise TimeoutError
+    return await task
+
+async def wait_for(awaitable, timeout):
+    return await wait_for_ms(awaitable, int(timeout * 1000))
+
+async def gather(*awaitables):
+    tasks = [create_task(awaitable) for awaitable in awaitables]
+    return [await task for task in tasks]
+
+class Event:
+    def __init__(self):
+        self.state = False
+        self.waiting = []
+    
+    def is_set(self):
+        return self.state
+    
+    def set(self):
+        self.state = True
+        for waiter in self.waiting:
+            _wake(waiter)
+        self.waiting = []
+    
+    def clear(self):
+        self.state = False
+    
+    async def wait(self):
+        if not self.state:
+            self.waiting.append(_register())
+            await _SUSPEND
+        return True
+
+class ThreadSafeFlag(Event):
+    async def wait(self):
+        if not self.state:
+            self.waiting.append(_register())
+            await _SUSPEND
+        self.state = False
+
+def _run_ready():
+    global _current
+    while _ready:
+        task = _ready.popleft()
+        if task.done:
+            continue
+        _current = task
+        task.runs.append(time.ticks_ms())
+        try:
+            task.coro.send(None)
+        except StopIteration as e:
+            task._finish(result=e.value)
+        except CancelledError:
+            task._finish(exception=CancelledError())
+        finally:
+            _current = None
+
+def run_for(ms):
+    """Run tasks until the clock has moved on by ms (test helper).
+    
+    Exceptions raised by tasks propagate to the caller.
+    """
+    end = _clock() + ms
+    while True:
+        _run_ready()
+        core._io_queue.poll()
+        if _ready:
+            continue
+        # Idle: the board would sleep until the next timer
+        while _timers and not _live(_timers[0][2]):
+            heapq.heappop(_timers)
+        if not _timers or _timers[0][0] > end:
+            break
+        if _timers[0][0] > _clock():
+            time.sleep_ms(_timers[0][0] - _clock())
+        now = _clock()
+        while _timers and _timers[0][0] <= now:
+            _fire(heapq.heappop(_timers)[2])
+    if end > _clock():
+        time.sleep_ms(end - _clock())
+
+def run(coro):
+    """Start coro; tests drive it with run_for()."""
+    return create_task(coro)
+
+new_event_loop()
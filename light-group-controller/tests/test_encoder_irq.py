@@ -0,0 +1,124 @@
+import config
+import network
+import uasyncio
+
+import fake_board
+from encoder import RotaryEncoder, StepRing, REST_STATE
+from power import IdleManager
+
+# Gray code states, (clk << 1) | dt, for one detent each way from rest
+CLOCKWISE = (0b01, 0b00, 0b10, 0b11)
+COUNTER_CLOCKWISE = (0b10, 0b00, 0b01, 0b11)
+
+def make_encoder(**kwargs):
+    return RotaryEncoder(clk_pin=13, dt_pin=12, sw_pin=14, mode=RotaryEncoder.IRQ_MODE, **kwargs)
+
+def replay(encoder, states):
+    """Set the pins to each state in turn and run the edge IRQ handler."""
+    for state in states:
+        encoder.clk.value(state >> 1)
+        encoder.dt.value(state & 1)
+        encoder._on_edge(encoder.clk)
+
+def drain(ring):
+    deltas = []
+    delta = ring.pop()
+    while delta:
+        deltas.append(delta)
+        delta = ring.pop()
+    return deltas
+
+def test_full_detents_queue_one_step_each():
+    encoder = make_encoder()
+    assert encoder.quad_state == REST_STATE
+    replay(encoder, CLOCKWISE * 3 + COUNTER_CLOCKWISE)
+    assert drain(encoder.ring) == [1, 1, 1, -1]
+
+def test_bounce_and_lost_edges():
+    encoder = make_encoder()
+    # Contact bounce on one pin cancels out
+    replay(encoder, (0b01, 0b11, 0b01, 0b00, 0b10, 0b11))
+    assert drain(encoder.ring) == [1]
+    # One transition lost to bounce is tolerated, two are not
+    replay(encoder, (0b00, 0b10, 0b11))
+    assert drain(encoder.ring) == [1]
+    replay(encoder, (0b00, 0b11))
+    assert drain(encoder.ring) == []
+
+def test_turning_back_before_the_detent_queues_nothing():
+    encoder = make_encoder()
+    replay(encoder, (0b01, 0b00, 0b01, 0b11))
+    assert drain(encoder.ring) == []
+    assert encoder.quad_count == 0
+
+def test_check_delivers_queued_detents_in_order():
+    steps = []
+    encoder = make_encoder(on_rotate=lambda direction, *when: steps.append(direction))
+    replay(encoder, CLOCKWISE + CLOCKWISE + COUNTER_CLOCKWISE)
+    encoder.check()
+    assert steps == [1, 1, -1]
+    encoder.check()
+    assert steps == [1, 1, -1]
+
+def test_wake_handler_runs_on_every_edge():
+    encoder = make_encoder()
+    woken = []
+    encoder.attach_irq(woken.append)
+    replay(encoder, CLOCKWISE)
+    assert woken == [encoder.clk] * 4
+
+def test_full_ring_drops_and_counts():
+    ring = StepRing(4)
+    for _ in range(5):
+        ring.push(1, 0)
+    # One slot stays free to tell full from empty
+    assert ring.dropped == 2
+    assert drain(ring) == [1, 1, 1]
+    ring.push(-1, 25)
+    assert drain(ring) == [-1]
+    assert ring.time == 25
+
+def replay_timed(monkeypatch, edge_hz, duration_ms, block_every_ms, block_ms):
+    """Turn clockwise at edge_hz edges per second, draining the ring from main's encoder task.
+    
+    Another task blocks the CPU for block_ms every block_every_ms, as a
+    socket write or message parse would; pin IRQs keep firing meanwhile.
+    Edges are scheduled at ms resolution, several per ms above 1 kHz.
+    
+    Returns:
+        (encoder, detents delivered to on_rotate)
+    """
+    fake_board.install(monkeypatch)
+    import main
+    steps = []
+    encoder = make_encoder(ring_size=config.ENCODER_RING_SIZE, on_rotate=lambda direction, when: steps.append(direction))
+    wake = uasyncio.ThreadSafeFlag()
+    encoder.attach_irq(lambda pin: wake.set())
+    
+    edges = edge_hz * duration_ms // 1000
+    for i in range(edges):
+        state = CLOCKWISE[i % 4]
+        uasyncio.call_later(i * 1000 // edge_hz, fake_board.set_pins, 13, 12, state)
+    
+    async def blocking_task():
+        while True:
+            await uasyncio.sleep_ms(block_every_ms - block_ms)
+            uasyncio.block_ms(block_ms)
+    
+    uasyncio.create_task(main.encoder_task(encoder, wake, uasyncio.Event(), IdleManager(network.WLAN())))
+    uasyncio.create_task(blocking_task())
+    uasyncio.run_for(duration_ms + 100)
+    return encoder, steps
+
+def test_ring_keeps_up_with_fast_turns(monkeypatch):
+    # The ring holds ENCODER_RING_SIZE - 1 detents, four edges each: about
+    # 25 ms of blocking at 5 kHz, well above a 10 ms stall
+    for edge_hz in (1000, 5000):
+        encoder, steps = replay_timed(monkeypatch, edge_hz, 2000, block_every_ms=50, block_ms=10)
+        assert encoder.ring.dropped == 0
+        assert steps == [1] * (edge_hz * 2000 // 1000 // 4)
+
+def test_ring_drops_when_stalled_past_its_size(monkeypatch):
+    encoder, steps = replay_timed(monkeypatch, 5000, 2000, block_every_ms=100, block_ms=40)
+    assert encoder.ring.dropped > 0
+    assert len(steps) + encoder.ring.dropped == 5000 * 2000 // 1000 // 4
@@ -0,0 +1,96 @@
+import pytest
+from machine import Pin
+
+import rp2
+from encoder import RotaryEncoder, TRANSITIONS, quadrature_pio
+
+MASK = 0xFFFFFFFF
+
+CLOCKWISE = (0b01, 0b00, 0b10, 0b11)
+COUNTER_CLOCKWISE = (0b10, 0b00, 0b01, 0b11)
+
+def set_pins(low_pin, state):
+    """Drive the two input pins; bit 0 is the lower GPIO, as the program reads them."""
+    Pin(low_pin).value(state & 1)
+    Pin(low_pin + 1).value(state >> 1)
+
+def settle(sm):
+    """Run two passes so the program has seen the current pin state."""
+    update = quadrature_pio.labels["update"]
+    sm.run_until(update)
+    sm.run_until(update)
+
+def test_program_fills_the_instruction_memory():
+    # Padded to 32 instructions so it loads at offset 0 and the jump table
+    # indices are absolute addresses
+    assert len(quadrature_pio.instructions) == 32
+    assert quadrature_pio.labels["update"] == 15
+
+@pytest.mark.parametrize("previous", range(4))
+@pytest.mark.parametrize("state", range(4))
+def test_jump_table_matches_transitions(previous, state):
+    sm = rp2.StateMachine(0, quadrature_pio, in_base=Pin(12))
+    set_pins(12, previous)
+    settle(sm)
+    y, irqs = sm.y, sm.irqs
+    
+    set_pins(12, state)
+    sm.run_until(quadrature_pio.labels["update"])
+    delta = (sm.y - y) & MASK
+    if delta & 0x80000000:
+        delta -= 1 << 32
+    assert delta == TRANSITIONS[previous << 2 | state]
+    # Python is only woken when the count moves
+    assert sm.irqs - irqs == (delta != 0)
+
+def test_pushes_the_count_every_pass():
+    sm = rp2.StateMachine(0, quadrature_pio, in_base=Pin(12))
+    set_pins(12, 0b11)
+    settle(sm)
+    for state in CLOCKWISE:
+        set_pins(12, state)
+        settle(sm)
+    # A full FIFO keeps its oldest values; a fresh one follows a drain
+    assert len(sm.rx) == 4
+    sm.rx.clear()
+    assert sm.get() == 4
+
+def make_encoder(clk_pin, dt_pin, steps):
+    Pin(clk_pin, Pin.IN, Pin.PULL_UP)
+    Pin(dt_pin, Pin.IN, Pin.PULL_UP)
+    encoder = RotaryEncoder(clk_pin=clk_pin, dt_pin=dt_pin, sw_pin=14, mode=RotaryEncoder.PIO_MODE,
+                            on_rotate=lambda direction, *when: steps.append(direction))
+    # The hardware keeps running after the first read; the model only runs when asked
+    settle(encoder.sm)
+    return encoder
+
+def turn(encoder, clk_pin, dt_pin, states):
+    for state in states:
+        Pin(clk_pin).value(state >> 1)
+        Pin(dt_pin).value(state & 1)
+        settle(encoder.sm)
+
+@pytest.mark.parametrize("clk_pin,dt_pin", [(13, 12), (12, 13)])
+def test_encoder_reads_detents_with_either_pin_order(clk_pin, dt_pin):
+    steps = []
+    encoder = make_encoder(clk_pin, dt_pin, steps)
+    turn(encoder, clk_pin, dt_pin, CLOCKWISE * 2)
+    encoder.check()
+    assert steps == [1, 1]
+    
+    # Going below the start wraps the 32-bit count
+    turn(encoder, clk_pin, dt_pin, COUNTER_CLOCKWISE * 3)
+    encoder.check()
+    assert steps == [1, 1, -1, -1, -1]
+
+def test_encoder_wakes_python_on_count_changes():
+    steps = []
+    encoder = make_encoder(13, 12, steps)
+    woken = []
+    encoder.attach_irq(woken.append)
+    turn(encoder, 13, 12, CLOCKWISE)
+    assert len(woken) == 4
+
+def test_encoder_rejects_pins_that_are_not_adjacent():
+    with pytest.raises(ValueError):
+        make_encoder(13, 11, [])
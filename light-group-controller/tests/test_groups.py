@@ -0,0 +1,85 @@
+import tracemalloc
+
+import config
+from groups import GroupRegistry
+from test_light_state import make_light_state
+from test_mqtt_connect import connecting
+from test_mqtt_dispatch import deliver
+
+GROUP_COUNT = 36
+# Heap a group may cost on the host, topics included
+GROUP_BYTES = 512
+
+def group_config(count=GROUP_COUNT):
+    return tuple(("room_%d" % i, "home/room_%d" % i) for i in range(count))
+
+def attached(sync, clock, count=GROUP_COUNT):
+    """Return a registry of count groups attached to sync before it connects."""
+    light_state, sent = make_light_state()
+    registry = GroupRegistry(group_config(count), light_state)
+    connecting(sync, clock)
+    registry.attach(sync)
+    sync.check()
+    return registry, sent
+
+def test_groups_share_one_subscribe(connected_mqtt, clock):
+    sync = connected_mqtt
+    attached(sync, clock)
+    sent = bytes(sync.client.sock.sent)
+    # One SUBSCRIBE packet carrying every group's three filters
+    size = 0
+    i = 1
+    while True:
+        size |= (sent[i] & 0x7F) << 7 * (i - 1)
+        i += 1
+        if not sent[i - 1] & 0x80:
+            break
+    assert sent[0] == 0x82 and len(sent) == i + size
+    assert len(sync.subscriptions) == 3 * GROUP_COUNT
+    
+    sync.client.sock.feed(bytes([0x90, 2 + 3 * GROUP_COUNT, 0, sync.suback_pid]) + b"\x01" * 3 * GROUP_COUNT)
+    sync.check()
+    assert sync.is_connected()
+
+def test_messages_reach_their_group(connected_mqtt, clock):
+    sync = connected_mqtt
+    registry, _ = attached(sync, clock)
+    sync.link_state = sync.CONNECTED
+    sync.connected = True
+    deliver(sync, b"home/room_17/temp/state", b'{"state": "OFF", "color_temp": 300, "brightness": 40}')
+    deliver(sync, b"home/room_17/scene/state", config.AVAILABLE_SCENES[2].encode())
+    deliver(sync, b"home/room_30/availability", b"offline")
+    deliver(sync, b"home/room_0/temp/state", b'{"state": "ON", "color_temp": 250, "brightness": 90}')
+    
+    group = registry.groups[17]
+    assert (group.on, group.color_temp, group.brightness, group.scene_index) == (False, 300, 40, 2)
+    assert not registry.groups[30].available
+    light_state = registry.light_state
+    assert (light_state.on, light_state.color_temp, light_state.brightness) == (True, 250, 90)
+    
+    # Selecting the group hands its state to the knob
+    registry.select(17)
+    assert (light_state.on, light_state.color_temp, light_state.brightness) == (False, 300, 40)
+    assert light_state.current_scene_index == 2
+    assert registry.groups[0].color_temp == 250
+
+def test_commands_go_to_the_active_group(connected_mqtt, clock):
+    sync = connected_mqtt
+    registry, _ = attached(sync, clock)
+    sync.link_state = sync.CONNECTED
+    sync.connected = True
+    registry.select(5)
+    sync.publish_state(True, 300, 128, registry.active_group().command_topic)
+    assert list(sync.outbox) == [b"home/room_5/temp/set"]
+
+def test_group_memory(clock):
+    light_state, _ = make_light_state()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        registry = GroupRegistry(group_config(), light_state)
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    assert not hasattr(registry.groups[0], "__dict__")
+    assert used // GROUP_COUNT <= GROUP_BYTES
@@ -0,0 +1,319 @@
+import config
+from encoder import RotaryEncoder
+from light_state import LightState
+from test_encoder_irq import CLOCKWISE, replay
+
+def make_light_state(**kwargs):
+    sent = []
+    light_state = LightState(
+        min_temp=config.MIN_COLOR_TEMP,
+        max_temp=config.MAX_COLOR_TEMP,
+        default_temp=config.DEFAULT_COLOR_TEMP,
+        step=config.COLOR_TEMP_STEP,
+        on_state_change=lambda *state: sent.append(state),
+        batch_delay_ms=config.BATCH_DELAY_MS,
+        accel_curve=config.COLOR_TEMP_ACCEL_CURVE,
+        brightness_steps=config.BRIGHTNESS_STEPS,
+        **kwargs
+    )
+    light_state.current_mode = LightState.TEMPERATURE_MODE
+    return light_state, sent
+
+def make_encoder(light_state):
+    return RotaryEncoder(clk_pin=13, dt_pin=12, sw_pin=14, mode=RotaryEncoder.IRQ_MODE,
+                         on_rotate=light_state.adjust)
+
+def turn(encoder, clock, detents, interval_ms):
+    """Turn clockwise by detents, one every interval_ms, without running check()."""
+    for _ in range(detents):
+        clock.advance(interval_ms)
+        replay(encoder, CLOCKWISE)
+
+def test_slow_detents_drained_together_step_once_each(clock):
+    light_state, _ = make_light_state()
+    encoder = make_encoder(light_state)
+    # The encoder task is late, say behind a blocking Wi-Fi connect
+    turn(encoder, clock, 3, 300)
+    clock.advance(2000)
+    encoder.check()
+    assert light_state.color_temp == config.DEFAULT_COLOR_TEMP + 3 * config.COLOR_TEMP_STEP
+
+def test_fast_detents_accelerate_even_when_drained_late(clock):
+    light_state, _ = make_light_state()
+    encoder = make_encoder(light_state)
+    turn(encoder, clock, 3, 20)
+    clock.advance(500)
+    encoder.check()
+    # The first detent has nothing to compare with; the rest were 20 ms apart
+    fastest = config.COLOR_TEMP_ACCEL_CURVE[0][1]
+    assert light_state.color_temp == min(config.MAX_COLOR_TEMP, config.DEFAULT_COLOR_TEMP + (1 + 2 * fastest) * config.COLOR_TEMP_STEP)
+
+def test_acceleration_follows_the_curve(clock):
+    light_state, _ = make_light_state()
+    light_state.color_temp = config.MIN_COLOR_TEMP
+    for max_interval, multiplier in config.COLOR_TEMP_ACCEL_CURVE:
+        light_state.adjust(1)
+        before = light_state.color_temp
+        clock.advance(max_interval)
+        light_state.adjust(1)
+        assert light_state.color_temp - before == multiplier * config.COLOR_TEMP_STEP
+    clock.advance(1000)
+    before = light_state.color_temp
+    light_state.adjust(1)
+    assert light_state.color_temp - before == config.COLOR_TEMP_STEP
+
+def test_reversing_drops_back_to_fine_steps(clock):
+    light_state, _ = make_light_state()
+    light_state.adjust(1)
+    clock.advance(10)
+    light_state.adjust(-1)
+    assert light_state.color_temp == config.DEFAULT_COLOR_TEMP
+
+def test_first_detent_after_a_long_idle_is_slow(clock):
+    light_state, _ = make_light_state()
+    light_state.adjust(-1)
+    # Long enough for ticks_diff to wrap negative (about 6.2 days)
+    clock.advance((1 << 29) + 10)
+    before = light_state.color_temp
+    light_state.adjust(-1)
+    assert before - light_state.color_temp == config.COLOR_TEMP_STEP
+
+def test_scene_preview_signals_moves_and_the_commit(clock):
+    previews = []
+    scenes = []
+    light_state, _ = make_light_state(scene_settle_ms=config.SCENE_SETTLE_MS, on_scene_preview=previews.append,
+                                      on_scene_change=scenes.append)
+    light_state.current_mode = LightState.SCENES_MODE
+    light_state.adjust(1)
+    light_state.adjust(1)
+    assert previews == [1, 2]
+    assert scenes == []
+    
+    clock.advance(config.SCENE_SETTLE_MS)
+    light_state.check_pending_updates()
+    assert scenes == [config.AVAILABLE_SCENES[2]]
+    # The LED stops showing the preview once it is activated
+    assert previews == [1, 2, None]
+    assert not light_state.pending_scene
+
+def settle(light_state, clock):
+    """Let the batch delay pass and send whatever is pending."""
+    clock.advance(light_state.batch_delay_ms)
+    light_state.check_pending_updates()
+
+def test_turn_reaching_a_state_ha_already_has_is_not_sent(clock):
+    light_state, sent = make_light_state()
+    light_state.update_from_external(True, 310, 200)
+    light_state.adjust(1)
+    light_state.adjust(-1)
+    settle(light_state, clock)
+    assert sent == []
+
+def test_remote_change_to_our_pending_target_is_not_sent_again(clock):
+    light_state, sent = make_light_state()
+    light_state.update_from_external(True, 300, 200)
+    light_state.adjust(1)
+    # Another controller gets there before our batch goes out
+    light_state.update_from_external(True, 300 + config.COLOR_TEMP_STEP, 200)
+    settle(light_state, clock)
+    assert sent == []
+
+def test_turning_back_to_an_unconfirmed_state_is_not_sent_again(clock):
+    light_state, sent = make_light_state()
+    light_state.update_from_external(True, 300, 200)
+    light_state.adjust(1)
+    settle(light_state, clock)
+    clock.advance(1000)
+    light_state.adjust(1)
+    clock.advance(1000)
+    light_state.adjust(-1)
+    settle(light_state, clock)
+    assert sent == [(True, 300 + config.COLOR_TEMP_STEP, 200)]
+
+def test_returning_to_temperature_mode_only_restores_an_unknown_state(clock):
+    light_state, sent = make_light_state(on_scene_change=lambda name: None)
+    light_state.update_from_external(True, 300, 200)
+    light_state.toggle_mode()
+    light_state.toggle_mode()
+    # Only the scene commit makes HA's state unknown
+    light_state.toggle_mode()
+    assert sent == [(True, 300, 200)]
+    light_state.confirm(True, 300, 200)
+    light_state.toggle_mode()
+    light_state.toggle_mode()
+    assert light_state.current_mode == LightState.SCENES_MODE
+    light_state.update_from_external(True, 300, 200)
+    light_state.toggle_mode()
+    assert sent == [(True, 300, 200)]
+
+def test_mixed_local_and_remote_script_publish_count(clock):
+    light_state, sent = make_light_state()
+    light_state.update_from_external(True, 300, 200)
+    step = config.COLOR_TEMP_STEP
+    script = [
+        ("detents", 3), ("settle", None), ("echo", None),
+        ("remote", (True, 400, 200)),
+        # Another controller gets to our target before the batch goes out
+        ("detents", 2), ("remote", (True, 400 + 2 * step, 200)), ("settle", None),
+        ("toggle", None), ("echo", None),
+        ("remote", (True, 400 + 2 * step, 200)), ("toggle", None),
+        # There and back within one batch
+        ("detents", 1), ("detents", -1), ("settle", None),
+    ]
+    for event, argument in script:
+        if event == "detents":
+            for _ in range(abs(argument)):
+                clock.advance(500)
+                light_state.adjust(1 if argument > 0 else -1)
+        elif event == "settle":
+            settle(light_state, clock)
+        elif event == "echo":
+            light_state.confirm(*light_state.last_notified_state)
+        elif event == "remote":
+            light_state.update_from_external(*argument)
+        else:
+            light_state.toggle()
+    assert sent == [
+        (True, 300 + 3 * step, 200),
+        (False, 400 + 2 * step, 200),
+        (False, 400 + 2 * step, 200),
+    ]
+
+def test_brightness_is_left_out_until_known(clock):
+    light_state, sent = make_light_state()
+    light_state.toggle()
+    # HA reports no brightness while off
+    light_state.update_from_external(False, 300, None)
+    light_state.toggle()
+    assert sent == [(False, config.DEFAULT_COLOR_TEMP, None), (True, 300, None)]
+    
+    light_state.update_from_external(True, 300, 120)
+    light_state.toggle()
+    assert sent[-1] == (False, 300, 120)
+
+def test_brightness_turn_makes_it_known(clock):
+    light_state, sent = make_light_state()
+    light_state.current_mode = LightState.BRIGHTNESS_MODE
+    light_state.adjust(-1)
+    settle(light_state, clock)
+    assert sent == [(True, config.DEFAULT_COLOR_TEMP, config.BRIGHTNESS_STEPS[-2])]
+
+def test_unknown_brightness_survives_snapshot_and_group_switch(clock):
+    light_state, sent = make_light_state()
+    snapshot = light_state.snapshot()
+    assert snapshot["brightness"] is None
+    restored, sent = make_light_state()
+    restored.restore(snapshot)
+    restored.toggle()
+    assert sent == [(False, config.DEFAULT_COLOR_TEMP, None)]
+    
+    restored.load_group(True, 300, 90, 0, None, True)
+    assert restored.current_state() == (True, 300, 90)
+    restored.load_group(True, 300, None, 0, None, True)
+    assert restored.current_state() == (True, 300, None)
+
+def test_rtt_average_converges_without_drift():
+    light_state, sent = make_light_state()
+    light_state.record_rtt(40)
+    for _ in range(100):
+        light_state.record_rtt(47)
+    # Unscaled, (47 - 40) >> 3 rounds to zero and SRTT would stay at 40
+    stats = light_state.rtt_stats()
+    assert stats["srtt_ms"] == 47 and stats["rttvar_ms"] <= 1
+    assert stats["samples"] == 101
+    for _ in range(100):
+        light_state.record_rtt(33)
+    assert light_state.rtt_stats()["srtt_ms"] == 33
+
+def test_batch_delay_follows_rtt_within_its_bounds():
+    light_state, sent = make_light_state(batch_delay_min_ms=config.BATCH_DELAY_MIN_MS,
+                                         batch_delay_max_ms=config.BATCH_DELAY_MAX_MS)
+    assert light_state.rtt_stats()["srtt_ms"] is None
+    for _ in range(50):
+        light_state.record_rtt(120)
+    assert 120 <= light_state.batch_delay_ms <= 124
+    for _ in range(50):
+        light_state.record_rtt(5)
+    assert light_state.batch_delay_ms == config.BATCH_DELAY_MIN_MS
+    for _ in range(50):
+        light_state.record_rtt(2000)
+    assert light_state.batch_delay_ms == config.BATCH_DELAY_MAX_MS
+
+def test_batch_delay_stays_fixed_without_bounds():
+    light_state, sent = make_light_state()
+    light_state.record_rtt(300)
+    assert light_state.batch_delay_ms == config.BATCH_DELAY_MS
+
+def test_presses_before_ha_reports_toggle_its_state(clock):
+    light_state, sent = make_light_state()
+    light_state.restore({"on": True, "color_temp": 300, "brightness": 128,
+                         "mode": LightState.TEMPERATURE_MODE, "scene_index": 0})
+    light_state.set_online(False)
+    # Two presses cancel out whatever HA reports
+    light_state.toggle()
+    light_state.toggle()
+    assert light_state.journal == {}
+    
+    light_state.toggle()
+    light_state.set_online(True)
+    light_state.update_from_external(False, 300, 128)
+    assert light_state.on
+    # Later reports before the reconcile don't flip it again
+    light_state.update_from_external(False, 300, 128)
+    assert light_state.on
+    clock.advance(config.OFFLINE_RECONCILE_MS)
+    light_state.check_pending_updates()
+    assert sent == [(True, 300, 128)]
+    
+    # Once HA's state is known an offline press is the state the user saw
+    light_state.set_online(False)
+    light_state.toggle()
+    light_state.set_online(True)
+    light_state.update_from_external(True, 300, 128)
+    assert not light_state.on
+
+def go_offline_from(light_state, clock, state=(True, 300, 128)):
+    """Have HA report state, then drop the link."""
+    light_state.update_from_external(*state)
+    light_state.set_online(False)
+    clock.advance(1000)
+
+def test_offline_changes_override_ha_and_the_rest_take_its_state(clock):
+    light_state, sent = make_light_state()
+    go_offline_from(light_state, clock)
+    light_state.adjust_temp(1)
+    assert sent == []
+    
+    light_state.set_online(True)
+    # HA's retained state: brightness changed elsewhere, temperature not
+    light_state.update_from_external(True, 300, 200)
+    assert light_state.color_temp == 300 + config.COLOR_TEMP_STEP
+    assert light_state.brightness == 200
+    
+    assert light_state.next_flush_ms() == config.OFFLINE_RECONCILE_MS
+    clock.advance(config.OFFLINE_RECONCILE_MS - 1)
+    light_state.check_pending_updates()
+    assert sent == []
+    clock.advance(1)
+    light_state.check_pending_updates()
+    # One publish of the merge, and nothing left to send
+    assert sent == [(True, 300 + config.COLOR_TEMP_STEP, 200)]
+    assert not light_state.journal and not light_state.reconciling
+    clock.advance(10000)
+    light_state.check_pending_updates()
+    assert light_state.next_flush_ms() is None
+    assert len(sent) == 1
+
+def test_offline_changes_expire(clock):
+    light_state, sent = make_light_state()
+    go_offline_from(light_state, clock)
+    light_state.adjust_temp(1)
+    clock.advance(config.OFFLINE_JOURNAL_MAX_AGE_MS)
+    
+    light_state.set_online(True)
+    light_state.update_from_external(True, 300, 128)
+    assert light_state.color_temp == 300
+    clock.advance(config.OFFLINE_RECONCILE_MS)
+    light_state.check_pending_updates()
+    # HA already has the state it reported
+    assert sent == []
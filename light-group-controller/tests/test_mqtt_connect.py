@@ -0,0 +1,208 @@
+import json
+
+import config
+import uasyncio
+
+import fake_board
+from mqtt import BrokerAddressCache, MqttLightSync
+
+def connecting(sync, clock, session_present=False):
+    """Put sync where the broker's CONNACK is about to be read."""
+    client = sync.client
+    
+    def connect_poll(timeout):
+        client.timeout = timeout
+        client.sock.settimeout(timeout)
+        return session_present
+    client.connect_poll = connect_poll
+    sync.link_state = sync.CONNECTING
+    sync.connected = False
+    sync.connect_start_time = clock.now
+    return client.sock
+
+def suback(pid, code=1):
+    return bytes([0x90, 3, pid >> 8, pid & 0xFF, code])
+
+def test_suback_is_collected_without_blocking(connected_mqtt, clock):
+    sync = connected_mqtt
+    sock = connecting(sync, clock)
+    sync.route(b"home/lamps/state", lambda topic, msg: None)
+    sync.check()
+    assert sock.sent[0] == 0x82
+    assert sync.link_state == sync.SUBSCRIBING and not sync.is_connected()
+    
+    # Sleep on the socket until the SUBACK arrives, or the attempt times out
+    assert sync.socket() is sock
+    assert sync.next_event_ms() == config.MQTT_CONNECT_TIMEOUT_MS
+    clock.advance(30)
+    sync.check()
+    assert sync.link_state == sync.SUBSCRIBING
+    sock.feed(suback(sync.suback_pid))
+    sync.check()
+    assert sync.is_connected()
+
+def test_missing_suback_fails_the_attempt(connected_mqtt, clock):
+    sync = connected_mqtt
+    sock = connecting(sync, clock)
+    sync.route(b"home/lamps/state", lambda topic, msg: None)
+    sync.check()
+    clock.advance(config.MQTT_CONNECT_TIMEOUT_MS)
+    sync.check()
+    assert sync.link_state == sync.DISCONNECTED and sock.closed
+
+def test_refused_subscription_fails_the_attempt(connected_mqtt, clock):
+    sync = connected_mqtt
+    sock = connecting(sync, clock)
+    sync.route(b"home/lamps/state", lambda topic, msg: None)
+    sync.check()
+    sock.feed(suback(sync.suback_pid, 0x80))
+    sync.check()
+    assert sync.link_state == sync.DISCONNECTED
+
+def test_route_added_while_subscribing_is_waited_for(connected_mqtt, clock):
+    sync = connected_mqtt
+    sock = connecting(sync, clock)
+    sync.route(b"home/lamps/state", lambda topic, msg: None)
+    sync.check()
+    first = sync.suback_pid
+    sync.route(b"home/other/state", lambda topic, msg: None)
+    sock.feed(suback(first))
+    sync.check()
+    assert sync.link_state == sync.SUBSCRIBING
+    sock.feed(suback(sync.suback_pid))
+    sync.check()
+    assert sync.is_connected()
+
+def test_resumed_session_connects_straight_away(connected_mqtt, clock):
+    sync = connected_mqtt
+    sock = connecting(sync, clock, session_present=True)
+    sync.route(b"home/lamps/state", lambda topic, msg: None)
+    sync.check()
+    assert sync.is_connected() and not sock.sent
+
+def test_reads_keep_the_socket_timeout(connected_mqtt, clock):
+    sync = connected_mqtt
+    sock = connecting(sync, clock, session_present=True)
+    sync.check()
+    sock.feed(b"\xd0\x00")  # PINGRESP
+    sync.check()
+    # check_msg() polls without blocking, then the timeout is back for writes
+    assert sock.timeout == config.MQTT_SOCKET_TIMEOUT
+
+def test_outage_resolves_the_broker_once(connected_mqtt, clock, monkeypatch):
+    sync = connected_mqtt
+    sync.addr_cache.addr = ("10.0.0.5", config.MQTT_PORT)
+    sync.addr_cache.resolved_time = clock.now
+    lookups = []
+    attempts = []
+    
+    def resolve():
+        lookups.append(clock.now)
+        sync.addr_cache.addr = ("10.0.0.6", config.MQTT_PORT)
+        return sync.addr_cache.addr
+    
+    def connect_start(clean_session=True, addr=None):
+        attempts.append(addr)
+        raise OSError(113)  # EHOSTUNREACH
+    monkeypatch.setattr(sync.addr_cache, "resolve", resolve)
+    monkeypatch.setattr(sync.client, "connect_start", connect_start)
+    
+    sync._link_lost()
+    for _ in range(6):
+        clock.advance(sync.next_event_ms())
+        sync.check()
+    
+    # The old address, the looked up one, then one attempt per backoff
+    # step on the looked up address
+    assert len(lookups) == 1
+    assert attempts[0] == ("10.0.0.5", config.MQTT_PORT)
+    assert attempts[1:] == [("10.0.0.6", config.MQTT_PORT)] * 5
+    
+    # Once the link has been up again, a failing cached address is looked up again
+    connecting(sync, clock, session_present=True)
+    sync.check()
+    assert sync.is_connected()
+    sync._link_lost()
+    clock.advance(sync.next_event_ms())
+    sync.check()
+    clock.advance(sync.next_event_ms())
+    sync.check()
+    assert len(lookups) == 2
+
+def test_broker_address_is_kept_across_boots(monkeypatch, clock):
+    broker = fake_board.install(monkeypatch)
+    cache = BrokerAddressCache("broker.local", config.MQTT_PORT, path="broker_addr.json")
+    assert cache.get() is None
+    addr = cache.resolve()
+    cache.confirm()
+    with open("broker_addr.json") as f:
+        assert json.load(f) == {"host": "broker.local", "port": config.MQTT_PORT, "ip": broker.ip}
+    
+    # The next boot finds it without a lookup
+    booted = BrokerAddressCache("broker.local", config.MQTT_PORT, path="broker_addr.json")
+    assert booted.get() == addr and broker.lookups == 1
+    # A file for another broker is ignored
+    assert BrokerAddressCache("other.local", config.MQTT_PORT, path="broker_addr.json").get() is None
+    assert BrokerAddressCache("broker.local", 8883, path="broker_addr.json").get() is None
+    
+    # The address is only written again if it changes
+    with open("broker_addr.json", "w") as f:
+        f.write("garbled")
+    booted.confirm()
+    with open("broker_addr.json") as f:
+        assert f.read() == "garbled"
+    # and an unreadable file is ignored too
+    assert BrokerAddressCache("broker.local", config.MQTT_PORT, path="broker_addr.json").get() is None
+
+def test_cached_broker_address_expires(monkeypatch, clock):
+    fake_board.install(monkeypatch)
+    cache = BrokerAddressCache("broker.local", config.MQTT_PORT, ttl_ms=60000)
+    addr = cache.resolve()
+    clock.advance(59999)
+    assert cache.get() == addr
+    clock.advance(1)
+    assert cache.get() is None
+    cache.resolve()
+    cache.invalidate()
+    assert cache.get() is None
+
+def connect_time(sync, clock, step_ms=5):
+    """Run check() until connected, letting broker replies arrive; return ms taken by the attempt."""
+    for _ in range(1000):
+        sync.check()
+        if sync.is_connected():
+            return clock.now - sync.connect_start_time
+        uasyncio.run_for(step_ms)
+    raise AssertionError("never connected")
+
+def test_cold_boot_connects_without_dns(monkeypatch, clock):
+    broker = fake_board.install(monkeypatch)
+    with open(config.MQTT_ADDR_CACHE_FILE, "w") as f:
+        json.dump({"host": "broker.local", "port": config.MQTT_PORT, "ip": broker.ip}, f)
+    sync = MqttLightSync("broker.local", "user", "password", state_topic=None, on_update=None)
+    sync.connect()
+    connect_time(sync, clock)
+    assert broker.lookups == 0
+    assert broker.sockets[0].addr == (broker.ip, config.MQTT_PORT)
+
+def reconnect_times(monkeypatch, clock, dns_ttl_s, count=10):
+    """Return how long each of count reconnects takes with the given DNS TTL."""
+    monkeypatch.setattr(config, "MQTT_DNS_TTL_S", dns_ttl_s)
+    broker = fake_board.install(monkeypatch, dns_ms=150)
+    sync = MqttLightSync("broker.local", "user", "password", state_topic=None, on_update=None)
+    sync.connect()
+    connect_time(sync, clock)
+    times = []
+    for _ in range(count):
+        sync._link_lost()
+        clock.advance(sync.next_event_ms())
+        times.append(connect_time(sync, clock))
+    return times, broker.lookups
+
+def test_address_cache_saves_a_lookup_per_reconnect(monkeypatch, clock):
+    cached, cached_lookups = reconnect_times(monkeypatch, clock, config.MQTT_DNS_TTL_S)
+    uncached, uncached_lookups = reconnect_times(monkeypatch, clock, 0)
+    assert cached_lookups == 1 and uncached_lookups == 11
+    # Each reconnect skips the lookup's 150 ms; the handshake takes the same
+    saved = sum(uncached) // len(uncached) - sum(cached) // len(cached)
+    assert 150 <= saved < 150 + 10
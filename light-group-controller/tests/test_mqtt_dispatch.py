@@ -0,0 +1,121 @@
+import tracemalloc
+
+import config
+
+LIGHT_TOPIC = b"home/lamps/state"
+COMMAND_TOPIC = b"home/lamps/set"
+AVAILABILITY_TOPIC = b"home/lamps/availability"
+SCENE_STATE_TOPIC = b"home/lamps/scene"
+
+def publish_packet(topic, payload):
+    """Return a QoS 0 PUBLISH packet as the broker sends it."""
+    body = bytes([len(topic) >> 8, len(topic) & 0xFF]) + topic + payload
+    assert len(body) < 128
+    return bytes([0x30, len(body)]) + body
+
+def deliver(sync, topic, payload):
+    sync.client.sock.feed(publish_packet(topic, payload))
+    sync.check()
+
+def offline(sync, register, *args, **kwargs):
+    """Register routes as if before connecting, so no SUBSCRIBE goes out."""
+    sync.connected = False
+    register(*args, **kwargs)
+    sync.connected = True
+
+def add_light(sync):
+    updates = []
+    availability = []
+    scenes = []
+    offline(sync, sync.add_light, LIGHT_TOPIC, COMMAND_TOPIC, lambda *state: updates.append(state),
+            scene_state_topic=SCENE_STATE_TOPIC, on_scene_update=scenes.append,
+            availability_topic=AVAILABILITY_TOPIC, on_availability=availability.append)
+    return updates, availability, scenes
+
+def test_state_is_parsed_from_the_receive_buffer(connected_mqtt):
+    updates, _, _ = add_light(connected_mqtt)
+    deliver(connected_mqtt, LIGHT_TOPIC, b'{"state":"ON","color_mode":"color_temp","color_temp":300,"brightness":90}')
+    deliver(connected_mqtt, LIGHT_TOPIC, b'{"state": "OFF", "brightness": null}')
+    assert updates == [(True, 300, 90), (False, config.DEFAULT_COLOR_TEMP, None)]
+
+def test_handlers_get_the_registered_topic(connected_mqtt):
+    seen = []
+    offline(connected_mqtt, connected_mqtt.route, b"home/other", lambda topic, msg: seen.append((topic, bytes(msg))))
+    deliver(connected_mqtt, b"home/other", b"x")
+    topic, msg = seen[0]
+    assert type(topic) is bytes and topic == b"home/other" and msg == b"x"
+
+def test_same_length_topics_reach_their_own_handler(connected_mqtt):
+    seen = []
+    offline(connected_mqtt, connected_mqtt.route, b"home/a/state", lambda topic, msg: seen.append(b"a"))
+    offline(connected_mqtt, connected_mqtt.route, b"home/b/state", lambda topic, msg: seen.append(b"b"))
+    deliver(connected_mqtt, b"home/b/state", b"1")
+    deliver(connected_mqtt, b"home/a/state", b"1")
+    deliver(connected_mqtt, b"home/c/state", b"1")
+    assert seen == [b"b", b"a"]
+
+def test_availability_and_scene_messages(connected_mqtt):
+    _, availability, scenes = add_light(connected_mqtt)
+    deliver(connected_mqtt, AVAILABILITY_TOPIC, b"online")
+    deliver(connected_mqtt, AVAILABILITY_TOPIC, b"offline")
+    deliver(connected_mqtt, SCENE_STATE_TOPIC, b"scene.reading")
+    deliver(connected_mqtt, SCENE_STATE_TOPIC, b'{"scene": "scene.tv_time"}')
+    assert availability == [True, False]
+    assert scenes == ["scene.reading", "scene.tv_time"]
+
+def test_wildcard_matches_are_cached(connected_mqtt, monkeypatch):
+    settings = []
+    connected_mqtt.on_config = lambda name, value: settings.append((name, value))
+    offline(connected_mqtt, connected_mqtt.route, b"home/controller/config/+", connected_mqtt._on_config)
+    deliver(connected_mqtt, b"home/controller/config/batch_delay_ms", b"80")
+    
+    # Later messages on the topic don't match the filter again
+    monkeypatch.setattr(connected_mqtt, "_match_wildcard", None)
+    deliver(connected_mqtt, b"home/controller/config/batch_delay_ms", b"60")
+    assert settings == [("batch_delay_ms", 80), ("batch_delay_ms", 60)]
+
+def test_route_cache_is_bounded(connected_mqtt):
+    offline(connected_mqtt, connected_mqtt.route, b"home/+", lambda topic, msg: None)
+    for i in range(config.MQTT_ROUTE_CACHE_SIZE * 2 + 1):
+        deliver(connected_mqtt, b"home/%d" % i, b"")
+    assert len(connected_mqtt.route_cache) <= config.MQTT_ROUTE_CACHE_SIZE
+
+def dispatch_peak_bytes(sync, topic, payload, count=21):
+    """Return the median, over count messages, of the most memory allocated at once while reading and dispatching one.
+    
+    Measured with tracemalloc on the host, so it counts CPython objects,
+    but a copy of the payload shows up in it as it would on the board.
+    """
+    sock = sync.client.sock
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(count):
+            sock.feed(publish_packet(topic, payload))
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            sync.check()
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return sorted(peaks)[count // 2]
+
+def test_dispatch_allocations_per_message(connected_mqtt, clock):
+    updates = []
+    offline(connected_mqtt, connected_mqtt.add_light, LIGHT_TOPIC, COMMAND_TOPIC, lambda *state: updates.append(state))
+    short = b'{"state":"ON","color_temp":300,"brightness":90}'
+    long = short[:-1] + b',"effect_list":["' + b'x' * 40 + b'"]}'
+    short_peak = dispatch_peak_bytes(connected_mqtt, LIGHT_TOPIC, short)
+    long_peak = dispatch_peak_bytes(connected_mqtt, LIGHT_TOPIC, long)
+    assert len(updates) == 42
+    # Nothing grows with the payload: it is parsed where it was received
+    assert long_peak - short_peak < len(long) - len(short)
+
+def test_exact_topics_are_hashed(connected_mqtt):
+    seen = []
+    for i in range(36):
+        offline(connected_mqtt, connected_mqtt.route, b"home/lamps_%02d/state" % i, lambda topic, msg: seen.append(topic))
+    # One dict entry per topic, found by hash however many share a length
+    assert connected_mqtt.routes[b"home/lamps_17/state"] is not None
+    deliver(connected_mqtt, b"home/lamps_17/state", b"")
+    assert seen == [b"home/lamps_17/state"]
@@ -0,0 +1,161 @@
+import json
+
+import pytest
+
+import config
+from test_mqtt_connect import connecting
+from test_mqtt_dispatch import COMMAND_TOPIC, LIGHT_TOPIC, deliver, offline
+
+OTHER_LIGHT_TOPIC = b"home/desk/state"
+OTHER_COMMAND_TOPIC = b"home/desk/set"
+
+class Light:
+    """Records what MqttLightSync reports for one light group."""
+    
+    def __init__(self, sync, state_topic, command_topic):
+        self.sync = sync
+        self.state_topic = state_topic
+        self.command_topic = command_topic
+        self.updates = []
+        self.confirms = []
+        offline(sync, sync.add_light, state_topic, command_topic, self._update, self._confirm)
+    
+    def _update(self, *state):
+        self.updates.append(state)
+    
+    def _confirm(self, *state):
+        self.confirms.append(state)
+    
+    def send(self, clock, on, color_temp, brightness=128):
+        clock.advance(config.MQTT_FLUSH_MS)
+        self.sync.publish_state(on, color_temp, brightness, self.command_topic)
+        self.sync.flush()
+        assert not self.sync.outbox
+    
+    def report(self, on, color_temp, brightness=128):
+        payload = {"state": "ON" if on else "OFF", "color_mode": "color_temp", "color_temp": color_temp,
+                   "brightness": brightness}
+        deliver(self.sync, self.state_topic, json.dumps(payload).encode())
+
+@pytest.fixture
+def light(connected_mqtt):
+    return Light(connected_mqtt, LIGHT_TOPIC, COMMAND_TOPIC)
+
+@pytest.fixture
+def rtts(connected_mqtt):
+    measured = []
+    connected_mqtt.on_rtt = measured.append
+    return measured
+
+def test_echo_is_confirmed_not_applied(light, clock, rtts):
+    light.send(clock, True, 300)
+    clock.advance(40)
+    light.report(True, 300)
+    assert light.updates == []
+    assert light.confirms == [(True, 300, 128)]
+    assert rtts == [40]
+
+def test_echoes_of_batched_commands_in_order(light, clock):
+    light.send(clock, True, 300)
+    light.send(clock, True, 310)
+    light.send(clock, True, 320)
+    light.report(True, 300)
+    light.report(True, 310)
+    light.report(True, 320)
+    assert light.updates == []
+    assert [state[1] for state in light.confirms] == [300, 310, 320]
+
+def test_coalesced_echo_confirms_the_latest_command(light, clock):
+    light.send(clock, True, 300)
+    light.send(clock, True, 310)
+    # HA only reports where the lights ended up
+    light.report(True, 310)
+    assert light.updates == []
+    assert light.confirms == [(True, 310, 128)]
+    # ... and the older command's slot went with it
+    assert light.sync.echoes == []
+
+def test_remote_change_before_the_echo_is_applied(light, clock):
+    light.send(clock, True, 300)
+    # Another controller's change lands first, then our echo
+    light.report(True, 450)
+    light.report(True, 300)
+    assert light.updates == [(True, 450, 128)]
+    assert light.confirms == [(True, 300, 128)]
+
+def test_remote_change_between_echoes_is_applied(light, clock):
+    light.send(clock, True, 300)
+    light.send(clock, True, 310)
+    light.report(True, 300)
+    light.report(False, 300)
+    light.report(True, 310)
+    assert light.updates == [(False, 300, 128)]
+    assert [state[1] for state in light.confirms] == [300, 310]
+
+def test_remote_change_repeating_an_echoed_value_is_applied(light, clock):
+    light.send(clock, True, 300)
+    light.report(True, 300)
+    # The same value again is a real change once its echo has been seen
+    light.report(True, 300)
+    assert light.updates == [(True, 300, 128)]
+
+def test_echo_after_the_timeout_is_applied(light, clock):
+    light.send(clock, True, 300)
+    clock.advance(config.MQTT_ECHO_TIMEOUT_MS)
+    light.report(True, 300)
+    assert light.updates == [(True, 300, 128)]
+    assert light.confirms == []
+
+@pytest.mark.parametrize("color_temp, brightness, echoed", [
+    (300 + config.MQTT_ECHO_TEMP_TOLERANCE, 128 - config.MQTT_ECHO_BRIGHTNESS_TOLERANCE, True),
+    (300 + config.MQTT_ECHO_TEMP_TOLERANCE + 1, 128, False),
+    (300, 128 + config.MQTT_ECHO_BRIGHTNESS_TOLERANCE + 1, False),
+    (300, None, True),
+])
+def test_echo_allows_ha_rounding(light, clock, color_temp, brightness, echoed):
+    light.send(clock, True, 300)
+    light.report(True, color_temp, brightness)
+    assert bool(light.confirms) == echoed
+    assert bool(light.updates) != echoed
+
+def test_off_echo_ignores_color_temp_and_brightness(light, clock):
+    light.send(clock, False, 300)
+    light.report(False, 370, None)
+    assert light.updates == []
+    assert light.confirms == [(False, 300, 128)]
+
+def test_echo_only_matches_its_own_group(connected_mqtt, light, clock):
+    other = Light(connected_mqtt, OTHER_LIGHT_TOPIC, OTHER_COMMAND_TOPIC)
+    light.send(clock, True, 300)
+    other.report(True, 300)
+    light.report(True, 300)
+    assert other.updates == [(True, 300, 128)] and other.confirms == []
+    assert light.updates == [] and light.confirms == [(True, 300, 128)]
+
+def test_echo_of_a_command_resent_after_reconnecting_is_not_timed(connected_mqtt, light, clock, rtts):
+    light.send(clock, True, 300)
+    clock.advance(config.MQTT_ECHO_TIMEOUT_MS - 100)
+    connected_mqtt._link_lost()
+    # The timeout restarts from the link loss
+    clock.advance(200)
+    connecting(connected_mqtt, clock, session_present=True)
+    connected_mqtt.check()
+    light.report(True, 300)
+    assert light.confirms == [(True, 300, 128)]
+    assert rtts == []
+
+def test_echo_ring_keeps_the_newest_commands(light, clock):
+    for i in range(config.MQTT_ECHO_SLOTS + 1):
+        light.send(clock, True, 300 + 10 * i)
+        # Acknowledge so the in-flight window stays open
+        light.sync.client.inflight.pop(light.sync.client.pid)
+    light.report(True, 300)
+    light.report(True, 300 + 10 * config.MQTT_ECHO_SLOTS)
+    assert light.updates == [(True, 300, 128)]
+    assert light.confirms == [(True, 300 + 10 * config.MQTT_ECHO_SLOTS, 128)]
+
+def test_echo_of_a_command_without_brightness_matches_any_brightness(light, clock):
+    light.send(clock, True, 300, None)
+    light.report(True, 300, 80)
+    assert light.updates == []
+    assert light.confirms == [(True, 300, None)]
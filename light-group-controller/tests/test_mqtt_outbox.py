@@ -0,0 +1,134 @@
+import json
+
+import config
+import mqtt
+from conftest import FakeSocket
+from test_mqtt_connect import connecting
+
+STATE_TOPIC = b"home/living_room_lamps/temp/set"
+SCENE_TOPIC = b"home/living_room_lamps/scene/set"
+
+def published(sock):
+    """Return (topic, payload) of every PUBLISH written to sock."""
+    data = bytes(sock.sent)
+    messages = []
+    i = 0
+    while i < len(data):
+        op = data[i]
+        size = 0
+        shift = 0
+        i += 1
+        while True:
+            byte = data[i]
+            i += 1
+            size |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        body = data[i:i + size]
+        i += size
+        if op & 0xF0 == 0x30:
+            topic_len = body[0] << 8 | body[1]
+            start = 2 + topic_len + (2 if op & 6 else 0)
+            messages.append((body[2:2 + topic_len], json.loads(body[start:])))
+    return messages
+
+def test_commands_go_out_in_the_order_they_were_last_queued(connected_mqtt):
+    sync = connected_mqtt
+    sync.publish_state(True, 300, 128)
+    # Leaving scenes mode: the scene commit, then the state restore
+    sync.publish_scene("scene.tv_time")
+    sync.publish_state(True, 310, 128)
+    sync.flush()
+    assert published(sync.client.sock) == [
+        (SCENE_TOPIC, {"scene": "scene.tv_time"}),
+        (STATE_TOPIC, {"state": "ON", "color_temp": 310, "brightness": 128}),
+    ]
+    assert not sync.outbox and not sync.outbox_order
+
+def test_payloads_are_serialised_once_per_flush(connected_mqtt, monkeypatch):
+    sync = connected_mqtt
+    calls = []
+    dumps = mqtt.ujson.dumps
+    monkeypatch.setattr(mqtt.ujson, "dumps", lambda obj: calls.append(obj) or dumps(obj))
+    for temp in range(300, 400, 5):
+        sync.publish_state(True, temp, 128)
+    assert calls == []
+    sync.flush()
+    assert len(calls) == 1
+    assert published(sync.client.sock) == [(STATE_TOPIC, {"state": "ON", "color_temp": 395, "brightness": 128})]
+
+def test_full_window_leaves_the_rest_queued_in_order(connected_mqtt):
+    sync = connected_mqtt
+    sync.client.max_inflight = 1
+    sync.publish_scene("scene.bright_day")
+    sync.publish_state(False, 300, 128)
+    sync.flush()
+    assert [topic for topic, _ in published(sync.client.sock)] == [SCENE_TOPIC]
+    assert sync.outbox_order == [STATE_TOPIC]
+
+def test_unknown_brightness_is_not_sent(connected_mqtt):
+    sync = connected_mqtt
+    sync.publish_state(True, 300, None)
+    sync.flush()
+    assert published(sync.client.sock) == [(STATE_TOPIC, {"state": "ON", "color_temp": 300})]
+
+def acknowledge(sync, pids):
+    """Feed a PUBACK for each packet ID and read it."""
+    for pid in list(pids):
+        sync.client.sock.feed(bytes([0x40, 2, pid >> 8, pid & 0xFF]))
+        sync.check()
+
+def test_unacknowledged_command_is_resent_with_dup_after_reconnecting(connected_mqtt, clock):
+    sync = connected_mqtt
+    sync.publish_state(True, 300, 128)
+    sync.flush()
+    first = bytes(sync.client.sock.sent)
+    assert first[0] == 0x32
+    pid = sync.client.pid
+    
+    sync._link_lost()
+    # Queued while the link is down, never sent
+    sync.publish_scene("scene.tv_time")
+    sync.client.sock = FakeSocket()
+    connecting(sync, clock, session_present=True)
+    sync.check()
+    assert sync.is_connected()
+    resent = bytes(sync.client.sock.sent)
+    # Same packet, with DUP set and the same packet ID
+    assert resent[0] == 0x3A and resent == bytes([0x3A]) + first[1:]
+    topic_len = resent[2] << 8 | resent[3]
+    assert resent[4 + topic_len:6 + topic_len] == bytes([pid >> 8, pid & 0xFF])
+    
+    # New commands follow under new packet IDs
+    clock.advance(config.MQTT_FLUSH_MS)
+    sync.flush()
+    assert published(sync.client.sock)[-1] == (SCENE_TOPIC, {"scene": "scene.tv_time"})
+    assert sync.client.pid != pid and len(sync.client.inflight) == 2
+
+def test_in_flight_window_reopens_on_puback(connected_mqtt, clock):
+    sync = connected_mqtt
+    window = config.MQTT_INFLIGHT_WINDOW
+    topics = [b"home/group_%d/temp/set" % i for i in range(window + 2)]
+    for topic in topics:
+        sync.publish_state(True, 300, 128, topic)
+    sync.flush()
+    assert [topic for topic, _ in published(sync.client.sock)] == topics[:window]
+    assert len(sync.client.inflight) == window and sync.outbox_order == topics[window:]
+    # Nothing more can go until the broker acknowledges something
+    assert sync.next_flush_ms() is None and not sync.is_idle()
+    
+    first_pid = min(sync.client.inflight)
+    acknowledge(sync, [first_pid])
+    assert first_pid not in sync.client.inflight
+    clock.advance(config.MQTT_FLUSH_MS)
+    sync.flush()
+    assert [topic for topic, _ in published(sync.client.sock)] == topics[:window + 1]
+    
+    acknowledge(sync, sync.client.inflight)
+    assert not sync.client.inflight
+    clock.advance(config.MQTT_FLUSH_MS)
+    sync.flush()
+    acknowledge(sync, sync.client.inflight)
+    assert [topic for topic, _ in published(sync.client.sock)] == topics
+    assert not sync.client.inflight and not sync.outbox and sync.is_idle()
@@ -0,0 +1,242 @@
+import config
+import network
+import uasyncio
+
+import fake_board
+from groups import GroupRegistry
+from light_state import LightState
+from mqtt import MqttLightSync
+from encoder import RotaryEncoder
+from power import IdleManager
+
+PINGREQ = b"\xc0\x00"
+PINGRESP = b"\xd0\x00"
+
+STATE_TOPIC = b"home/living_room_lamps/temp/state"
+# Tasks that replaced the 10 ms loop; the LED, Wi-Fi and idle tasks wake on their own timers
+LOOP_TASKS = ("encoder_task", "mqtt_task", "socket_task", "flush_task", "polling_loop")
+
+class Controller:
+    """The parts main.run() wires between the knob and the broker, on a fake board.
+    
+    start() runs them with main's tasks; start_polling() with the 10 ms
+    loop those tasks replaced.
+    """
+    
+    def __init__(self, monkeypatch):
+        self.broker = fake_board.install(monkeypatch)
+        self.broker.retained[STATE_TOPIC] = b'{"state":"ON","color_temp":300,"brightness":128}'
+        # Only importable once the fake secrets are in place
+        import main
+        self.main = main
+        self.mqtt_wake = uasyncio.Event()
+        self.flush = uasyncio.Event()
+        self.handled = uasyncio.Event()
+        self.wake = uasyncio.ThreadSafeFlag()
+        self.light_state = LightState(
+            min_temp=config.MIN_COLOR_TEMP,
+            max_temp=config.MAX_COLOR_TEMP,
+            default_temp=config.DEFAULT_COLOR_TEMP,
+            step=config.COLOR_TEMP_STEP,
+            on_state_change=self.publish_state_change,
+            batch_delay_ms=config.BATCH_DELAY_MS
+        )
+        self.light_state.current_mode = LightState.TEMPERATURE_MODE
+        self.groups = GroupRegistry(config.LIGHT_GROUPS, self.light_state)
+        self.mqtt = MqttLightSync("broker.local", "user", "password", state_topic=None, on_update=None,
+                                  on_connection_change=self.on_connection_change,
+                                  flush_interval_ms=config.MQTT_FLUSH_MS)
+        self.groups.attach(self.mqtt)
+        self.light_state.set_online(False)
+        self.encoder = RotaryEncoder(clk_pin=config.ENCODER_CLK_PIN, dt_pin=config.ENCODER_DT_PIN,
+                                     sw_pin=config.ENCODER_SW_PIN, mode=RotaryEncoder.IRQ_MODE,
+                                     on_rotate=self.light_state.adjust)
+        self.idle = IdleManager(network.WLAN())
+        self.tasks = []
+    
+    def publish_state_change(self, on_state, color_temp, brightness):
+        self.mqtt.publish_state(on_state, color_temp, brightness, self.groups.active_group().command_topic)
+        self.mqtt_wake.set()
+    
+    def on_connection_change(self, connected):
+        self.light_state.set_online(connected)
+        self.flush.set()
+    
+    def start(self):
+        main = self.main
+        self.encoder.attach_irq(lambda pin: self.wake.set())
+        self.mqtt.connect()
+        self.tasks = [
+            uasyncio.create_task(main.encoder_task(self.encoder, self.wake, self.flush, self.idle)),
+            uasyncio.create_task(main.mqtt_task(self.mqtt, self.mqtt_wake, self.handled)),
+            uasyncio.create_task(main.socket_task(self.mqtt, self.mqtt_wake, self.handled)),
+            uasyncio.create_task(main.flush_task(self.light_state, self.flush)),
+        ]
+    
+    def start_polling(self):
+        async def polling_loop():
+            while True:
+                self.mqtt.check()
+                self.encoder.check()
+                self.light_state.check_pending_updates()
+                self.mqtt.flush()
+                await uasyncio.sleep_ms(10)
+        self.mqtt.connect()
+        self.tasks = [uasyncio.create_task(polling_loop())]
+    
+    def wakes(self, start, end):
+        """Return the number of distinct times any loop task ran in [start, end)."""
+        times = set()
+        for task in self.tasks:
+            if task.name in LOOP_TASKS:
+                times.update(t for t in task.runs if start <= t < end)
+        return len(times)
+    
+    def turn_latencies(self, clock, delays_ms):
+        """Turn the knob one detent after each delay; return ms from each detent to its command."""
+        latencies = []
+        for delay in delays_ms:
+            sent = len(self.broker.commands())
+            fake_board.turn(delay)
+            # The detent is complete on the fourth edge
+            detent_time = clock.now + delay + 3 * 2
+            uasyncio.run_for(delay + 1000)
+            commands = self.broker.commands()
+            assert len(commands) == sent + 1
+            latencies.append(commands[-1][0] - detent_time)
+        return latencies
+
+def simulate(monkeypatch, clock, polling):
+    """Connect, idle for an hour and then turn the knob; return (wakes per idle hour, latencies)."""
+    controller = Controller(monkeypatch)
+    if polling:
+        controller.start_polling()
+    else:
+        controller.start()
+    uasyncio.run_for(5000)
+    assert controller.mqtt.is_connected() and not controller.light_state.reconciling
+    
+    start = clock.now
+    uasyncio.run_for(3600 * 1000)
+    wakes = controller.wakes(start, clock.now)
+    assert controller.mqtt.is_connected()
+    
+    # Turns landing at different points of the old loop's 10 ms period
+    latencies = controller.turn_latencies(clock, (1003, 2507, 4001, 5009, 7555))
+    return wakes, latencies
+
+def test_idle_link_only_wakes_for_keepalive(monkeypatch, clock):
+    wakes, latencies = simulate(monkeypatch, clock, polling=False)
+    polled_wakes, polled_latencies = simulate(monkeypatch, clock, polling=True)
+    
+    # One ping every half keepalive, waking the MQTT task to send it and
+    # the socket watcher and MQTT task again for the answer, instead of
+    # waking every 10 ms
+    pings = 3600 // (config.MQTT_KEEPALIVE // 2)
+    assert wakes <= 2 * pings + 2
+    assert polled_wakes >= 3600 * 100
+    # A turn still goes out once its batch delay is up, at least as soon as the loop sent it
+    assert max(latencies) <= config.BATCH_DELAY_MS
+    assert max(latencies) <= min(polled_latencies)
+
+def test_queued_command_goes_out_on_the_next_wake(connected_mqtt, clock):
+    sync = connected_mqtt
+    sock = sync.client.sock
+    clock.advance(10000)
+    assert sync.next_event_ms() > config.MQTT_FLUSH_MS
+    
+    sync.publish_state(True, 300, 128)
+    assert sync.next_event_ms() == 0
+    sync.flush()
+    assert b"home/living_room_lamps/temp/set" in sock.sent
+    
+    # A second command within the flush window waits only for the window
+    sock.sent.clear()
+    clock.advance(10)
+    sync.publish_state(True, 310, 128)
+    assert sync.next_event_ms() == config.MQTT_FLUSH_MS - 10
+    clock.advance(sync.next_event_ms())
+    sync.flush()
+    assert b"310" in sock.sent
+
+def test_disconnected_link_wakes_for_the_next_attempt(connected_mqtt, clock):
+    sync = connected_mqtt
+    sync._link_lost()
+    delay = sync.next_event_ms()
+    assert 0 < delay <= config.MQTT_RECONNECT_MIN_MS
+    
+    # Without Wi-Fi only network_changed() can give the task work
+    sync.network_changed(False)
+    assert sync.next_event_ms() is None
+
+def test_outage_does_not_keep_the_device_awake(connected_mqtt):
+    sync = connected_mqtt
+    assert sync.is_idle()
+    sync.publish_state(True, 300, 128)
+    assert not sync.is_idle()
+    
+    # Nothing can be sent until the link is back, so sleep through the backoff
+    sync._link_lost()
+    assert sync.is_idle()
+    sync.network_changed(False)
+    assert sync.is_idle()
+
+def test_handshake_keeps_the_device_awake(connected_mqtt):
+    sync = connected_mqtt
+    for state in (sync.CONNECTING, sync.SUBSCRIBING):
+        sync.link_state = state
+        assert not sync.is_idle()
+
+def test_unacknowledged_command_keeps_the_device_awake(connected_mqtt, clock):
+    sync = connected_mqtt
+    sync.publish_state(True, 300, 128)
+    sync.flush()
+    assert not sync.outbox and not sync.is_idle()
+    # PUBACK
+    sync.client.sock.feed(bytes([0x40, 2, 0, sync.client.pid]))
+    sync.check()
+    assert sync.is_idle()
+
+def test_wake_pings_a_connected_broker(connected_mqtt):
+    sync = connected_mqtt
+    sync.wake()
+    assert sync.client.sock.sent == PINGREQ
+
+def test_wake_brings_the_next_attempt_forward(connected_mqtt):
+    sync = connected_mqtt
+    sync._link_lost()
+    assert sync.next_event_ms() > 0
+    sync.wake()
+    assert sync.next_event_ms() == 0
+
+def test_unanswered_ping_drops_the_link(connected_mqtt, clock):
+    sync = connected_mqtt
+    sock = sync.client.sock
+    lost = []
+    link_lost = sync._link_lost
+    sync._link_lost = lambda: lost.append(clock.now) or link_lost()
+    interval = config.MQTT_KEEPALIVE * 500
+    
+    # An answered ping keeps the link
+    clock.advance(sync.next_event_ms())
+    sync.check()
+    assert sock.sent == PINGREQ
+    sock.feed(PINGRESP)
+    sync.check()
+    assert sync.next_event_ms() == interval
+    
+    # An unanswered one is given the same half keepalive before the link is dropped
+    sock.sent.clear()
+    clock.advance(interval)
+    sync.check()
+    assert sock.sent == PINGREQ
+    assert sync.next_event_ms() == interval
+    clock.advance(interval - 1)
+    sync.check()
+    assert sync.is_connected() and not lost
+    clock.advance(1)
+    sync.check()
+    assert lost == [clock.now]
+    assert sock.closed and not sync.is_connected()
+    assert sync.link_state == sync.DISCONNECTED
+    assert 0 < sync.next_event_ms() <= config.MQTT_RECONNECT_MIN_MS
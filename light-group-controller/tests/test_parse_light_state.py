@@ -0,0 +1,104 @@
+import json
+import time
+import tracemalloc
+
+import pytest
+import ujson
+
+import config
+from mqtt import parse_light_state
+
+def reference(payload):
+    """What the ujson fallback in _on_state makes of a payload."""
+    data = json.loads(payload)
+    brightness = data.get("brightness")
+    return (data.get("state", "OFF") == "ON",
+            int(data.get("color_temp", config.DEFAULT_COLOR_TEMP)),
+            None if brightness is None else int(brightness))
+
+HA_PAYLOADS = [
+    # Colour temperature mode reports the mode by name
+    b'{"brightness":255,"state":"ON","color_mode":"color_temp","color_temp":370}',
+    b'{"state": "ON", "color_mode": "color_temp", "brightness": 128, "color_temp": 250, '
+    b'"color_temp_kelvin": 4000, "color": {"h": 26.8, "s": 39.0}, "effect_list": ["colorloop", "color_temp"], '
+    b'"supported_color_modes": ["color_temp", "xy"]}',
+    b'{"state":"OFF","brightness":null}',
+    b'{"state":"OFF"}',
+    b'  {"color_temp": 454 , "state" : "ON" }  ',
+    b'{"state":"ON","color_temp":300,"brightness":1}',
+    # Keys inside string values and nested objects don't count
+    b'{"state":"ON","name":"\\"color_temp\\": 999","color_temp":300}',
+    b'{"state":"ON","attrs":{"color_temp":999,"state":"OFF"},"color_temp":300}',
+    b'{"effect":"state","state":"ON"}',
+    b'{}',
+]
+
+@pytest.mark.parametrize("payload", HA_PAYLOADS)
+def test_matches_the_json_parser(payload):
+    assert parse_light_state(payload) == reference(payload)
+
+@pytest.mark.parametrize("payload", HA_PAYLOADS)
+def test_reads_memoryviews(payload):
+    assert parse_light_state(memoryview(payload)) == reference(payload)
+
+@pytest.mark.parametrize("payload", [
+    # Values we can't read cheaply, and anything that isn't a plain object
+    b'{"state":"ON","color_temp":null}',
+    b'{"state":"ON","color_temp":370.5}',
+    b'{"state":"ON","brightness":-1}',
+    b'{"state":"on"}',
+    b'{"st\\u0061te":"ON"}',
+    b'{"state":"ON"',
+    b'{"state":"ON',
+    # Anything but whitespace after the object
+    b'{"state":"ON"}{"state":"OFF"}',
+    b'{"state":"ON"}x',
+    b'{"state":"ON"}]',
+    b'["state"]',
+    b'ON',
+    b'',
+])
+def test_unusual_payloads_fall_back(payload):
+    assert parse_light_state(payload) is None
+
+def test_repeated_keys_keep_the_last_value():
+    payload = b'{"color_temp":300,"color_temp":310,"state":"ON"}'
+    assert parse_light_state(payload) == reference(payload)
+
+def test_trailing_whitespace_is_allowed():
+    assert parse_light_state(b'{"state":"ON"} \r\n') == (True, config.DEFAULT_COLOR_TEMP, None)
+
+def peak_bytes(parse, payload, runs=9):
+    """Return the median peak memory allocated while parsing payload once."""
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(runs):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            parse(payload)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return sorted(peaks)[runs // 2]
+
+def time_ns(parse, payload, runs=500):
+    """Return the best of three timings of parsing payload, in ns per parse."""
+    best = None
+    for _ in range(3):
+        start = time.perf_counter_ns()
+        for _ in range(runs):
+            parse(payload)
+        elapsed = (time.perf_counter_ns() - start) // runs
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+@pytest.mark.parametrize("payload", HA_PAYLOADS[:3])
+def test_benchmark_against_ujson(payload):
+    # On the board the cost of ujson.loads is the dict, strings and lists it
+    # builds for every key HA reports, paid again in GC pauses
+    assert peak_bytes(parse_light_state, payload) * 4 < peak_bytes(ujson.loads, payload)
+    # On the host ujson is CPython's C parser and this one runs as bytecode,
+    # so it is slower here; the bound only catches a parser that stops
+    # being a single pass
+    assert time_ns(parse_light_state, payload) < 20 * time_ns(ujson.loads, payload)
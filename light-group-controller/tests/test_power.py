@@ -0,0 +1,142 @@
+import json
+
+import config
+import machine
+import network
+import uasyncio
+
+import fake_board
+from light_state import LightState
+from power import IdleManager, save_snapshot
+
+def make_idle(monkeypatch, clock):
+    wakes = []
+    sleeps = []
+    monkeypatch.setattr(machine, "lightsleep", sleeps.append)
+    idle = IdleManager(network.WLAN(), is_busy=lambda: False, on_wake=lambda: wakes.append(clock.now),
+                       powersave_after_ms=1000, sleep_after_ms=2000, max_sleep_ms=500)
+    return idle, wakes, sleeps
+
+def test_timer_wakes_do_not_run_on_wake(monkeypatch, clock):
+    idle, wakes, sleeps = make_idle(monkeypatch, clock)
+    for _ in range(10):
+        idle._lightsleep()
+    assert len(sleeps) == 10
+    assert wakes == []
+
+def test_activity_after_an_idle_spell_runs_on_wake_once(monkeypatch, clock):
+    idle, wakes, _ = make_idle(monkeypatch, clock)
+    idle.activity()
+    assert wakes == []
+    
+    idle._lightsleep()
+    clock.advance(100)
+    idle.activity()
+    idle.activity()
+    assert wakes == [clock.now]
+    assert idle.state == IdleManager.ACTIVE
+    assert idle.wlan.pm == network.WLAN.PM_PERFORMANCE
+
+def test_activity_in_powersave_runs_on_wake(monkeypatch, clock):
+    idle, wakes, _ = make_idle(monkeypatch, clock)
+    idle._set_radio_powersave(True)
+    idle._enter(IdleManager.POWERSAVE)
+    idle.activity()
+    assert len(wakes) == 1
+
+def test_only_a_deep_sleep_reset_is_a_dormant_wake(monkeypatch):
+    from power import woke_from_dormant
+    monkeypatch.setattr(machine, "reset_cause", lambda: machine.WDT_RESET)
+    assert woke_from_dormant()
+    monkeypatch.setattr(machine, "reset_cause", lambda: machine.PWRON_RESET)
+    assert not woke_from_dormant()
+    
+    # Ports that report deep sleep wakes separately
+    monkeypatch.setattr(machine, "DEEPSLEEP_RESET", 4, raising=False)
+    monkeypatch.setattr(machine, "reset_cause", lambda: machine.WDT_RESET)
+    assert not woke_from_dormant()
+    monkeypatch.setattr(machine, "reset_cause", lambda: 4)
+    assert woke_from_dormant()
+
+def simulate_day(idle):
+    """Run idle.run() through a scripted day; return its stats().
+    
+    The knob is used for a minute every two hours, a detent every two
+    seconds, and left alone in between. Activity is scheduled like the pin
+    IRQs that report it, so it also ends a lightsleep early.
+    """
+    for session in range(12):
+        start = session * 2 * 3600 * 1000 + 1000
+        for detent in range(30):
+            uasyncio.call_later(start + detent * 2000, idle.activity)
+    uasyncio.create_task(idle.run())
+    uasyncio.run_for(24 * 3600 * 1000)
+    return idle.stats()
+
+def test_duty_cycle_outlasts_an_always_active_board(monkeypatch, clock):
+    fake_board.install(monkeypatch)
+    # Batches and acknowledgements keep the board up briefly after each detent
+    is_busy = lambda: clock.now - idle.last_activity_time < config.BATCH_DELAY_MS + 200
+    idle = IdleManager(network.WLAN(), is_busy=is_busy,
+                       powersave_after_ms=config.POWERSAVE_AFTER_MS,
+                       sleep_after_ms=config.LIGHTSLEEP_AFTER_MS,
+                       max_sleep_ms=config.LIGHTSLEEP_MAX_MS)
+    stats = simulate_day(idle)
+    
+    fake_board.install(monkeypatch)
+    # Never leaves ACTIVE within the day
+    always_active = IdleManager(network.WLAN(), powersave_after_ms=48 * 3600 * 1000)
+    baseline = simulate_day(always_active)
+    
+    assert baseline["active_ms"] == 24 * 3600 * 1000
+    assert baseline["battery_hours"] == config.BATTERY_MAH // config.CURRENT_ACTIVE_MA
+    # Asleep for most of the day, waking every max_sleep_ms to let due work run
+    assert stats["sleep_ms"] > 0.9 * 24 * 3600 * 1000
+    assert stats["sleeps"] >= 24 * 3600 // (config.LIGHTSLEEP_MAX_MS // 1000) * 0.9
+    assert stats["battery_hours"] >= 8 * baseline["battery_hours"]
+
+STATE_TOPIC = b"home/living_room_lamps/temp/state"
+
+def boot_from_dormant(monkeypatch, clock, ha_state):
+    """Boot main.run() as the switch wakes it from dormant, with HA's retained state.
+    
+    Returns:
+        (ms from boot to the link coming up, ms from boot to the first command, its payload)
+    """
+    broker = fake_board.install(monkeypatch)
+    broker.retained[STATE_TOPIC] = json.dumps({"state": ha_state, "color_temp": 300, "brightness": 128}).encode()
+    # The lights were on when the controller went dormant
+    save_snapshot(config.DORMANT_SNAPSHOT_FILE,
+                  {"on": True, "color_temp": 300, "brightness": 128, "mode": LightState.TEMPERATURE_MODE,
+                   "scene_index": 0, "group": 0})
+    monkeypatch.setattr(machine, "reset_cause", lambda: machine.WDT_RESET)
+    online_at = []
+    set_online = LightState.set_online
+    
+    def record_online(light_state, online):
+        if online and not online_at:
+            online_at.append(clock.now)
+        set_online(light_state, online)
+    
+    monkeypatch.setattr(LightState, "set_online", record_online)
+    import main
+    boot = clock.now
+    uasyncio.run(main.run())
+    uasyncio.run_for(10000)
+    commands = broker.commands()
+    assert len(commands) == 1
+    when, topic, payload = commands[0]
+    return online_at[0] - boot, when - boot, json.loads(payload)
+
+def test_wake_press_toggles_the_state_ha_reports(monkeypatch, clock):
+    # Turned off from HA while the controller was dormant: the press turns them back on
+    online_ms, first_command_ms, command = boot_from_dormant(monkeypatch, clock, "OFF")
+    assert command["state"] == "ON"
+    # Still on: the press turns them off
+    _, _, command = boot_from_dormant(monkeypatch, clock, "ON")
+    assert command["state"] == "OFF"
+    
+    # A DHCP join and the MQTT handshake come first, then the wait for HA's
+    # retained state, which the wake press pays on top
+    assert online_ms >= network.WLAN.dhcp_join_ms
+    assert first_command_ms - online_ms == config.OFFLINE_RECONCILE_MS
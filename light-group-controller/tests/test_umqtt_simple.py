@@ -0,0 +1,59 @@
+from conftest import FakeSocket
+from umqtt.simple import MQTTClient
+
+class RecordingSocket(FakeSocket):
+    """FakeSocket that also keeps each write() separately."""
+    
+    def __init__(self):
+        super().__init__()
+        self.writes = []
+    
+    def write(self, data, n=None):
+        self.writes.append(bytes(data[:n] if n is not None else data))
+        return super().write(data, n)
+
+def make_client(tx_buf_size):
+    client = MQTTClient(b"pico", "broker", user=b"u", password=b"p", keepalive=60, tx_buf_size=tx_buf_size)
+    client.set_callback(lambda topic, msg: None)
+    client.sock = RecordingSocket()
+    return client
+
+def send_all(client):
+    """Send one of each packet the controller builds from parts; return the socket."""
+    sock = client.sock
+    client._send_connect(True)
+    client.publish(b"home/lamps/set", b'{"state":"ON","color_temp":300}')
+    client.publish(b"home/lamps/set", b'{"state":"OFF"}', qos=1, wait=False)
+    client.resend_inflight()
+    # SUBACK for the next packet ID, so subscribe() returns
+    sock.feed(bytes([0x90, 3, 0, client.pid + 1, 1]))
+    client.subscribe(b"home/lamps/state", 1)
+    client.subscribe_many([(b"home/a/state", 1), (b"home/b/+", 0)], wait=False)
+    return sock
+
+def test_connect_wire_format():
+    client = make_client(256)
+    client._send_connect(True)
+    assert client.sock.writes == [b"\x10\x16\x00\x04MQTT\x04\xc2\x00\x3c\x00\x04pico\x00\x01u\x00\x01p"]
+
+def test_each_packet_is_one_write_with_the_unbuffered_bytes():
+    buffered = send_all(make_client(256))
+    # Without a transmit buffer every field is written on its own, as before
+    unbuffered = send_all(make_client(0))
+    assert len(buffered.writes) == 6
+    assert len(unbuffered.writes) > 3 * len(buffered.writes)
+    assert buffered.sent == unbuffered.sent
+    assert buffered.writes[1][0] == 0x30 and buffered.writes[2][0] == 0x32
+    # The retransmission carries DUP
+    assert buffered.writes[3][0] == 0x3A and buffered.writes[3][1:] == buffered.writes[2][1:]
+    assert buffered.writes[4][0] == 0x82 and buffered.writes[5][0] == 0x82
+
+def test_parts_larger_than_the_buffer_keep_their_order():
+    payload = b"x" * 100
+    small = make_client(32)
+    small.publish(b"home/lamps/set", payload)
+    reference = make_client(0)
+    reference.publish(b"home/lamps/set", payload)
+    assert small.sock.sent == reference.sock.sent
+    # Header and topic gathered into one write, then the payload on its own
+    assert small.sock.writes[-1] == payload and len(small.sock.writes) == 2
@@ -0,0 +1,71 @@
+import json
+
+import config
+import network
+import uasyncio
+
+import fake_board
+
+AP_BSSID = network.WLAN.bssid
+# Settings a full join saved on an earlier boot
+CACHE = {
+    "ssid": network.WLAN.ssid,
+    "bssid": AP_BSSID.hex(),
+    "ifconfig": ["192.168.1.77", "255.255.255.0", "192.168.1.1", "192.168.1.1"]
+}
+
+def make_wifi(monkeypatch, cache=None):
+    fake_board.install(monkeypatch)
+    if cache:
+        with open(config.WIFI_CACHE_FILE, "w") as f:
+            json.dump(cache, f)
+    # Only importable once the fake secrets are in place
+    from wifi import WiFiManager
+    return WiFiManager()
+
+def saved_cache():
+    with open(config.WIFI_CACHE_FILE) as f:
+        return json.load(f)
+
+def test_first_join_leases_with_dhcp_and_caches_the_settings(monkeypatch, clock):
+    wifi = make_wifi(monkeypatch)
+    assert wifi.connect() is wifi.wlan
+    assert wifi.timings["path"] == "full" and not wifi.static_ip
+    assert wifi.wlan.joins == [(True, None)]
+    assert saved_cache() == {"ssid": network.WLAN.ssid, "bssid": AP_BSSID.hex(),
+                             "ifconfig": list(network.WLAN.lease)}
+
+def test_fast_join_uses_the_cached_bssid_and_ip(monkeypatch, clock):
+    wifi = make_wifi(monkeypatch, CACHE)
+    assert wifi.connect() is wifi.wlan
+    assert wifi.timings["path"] == "fast" and wifi.static_ip
+    assert wifi.wlan.joins == [(False, AP_BSSID)]
+    assert wifi.wlan.ifconfig() == tuple(CACHE["ifconfig"]) and wifi.wlan.scans == 0
+    # Association only, without the scan and DHCP
+    assert wifi.timings["total_ms"] < network.WLAN.dhcp_join_ms
+
+def test_failed_fast_join_falls_back_to_a_full_join(monkeypatch, clock):
+    # The AP has been replaced since the cache was saved
+    monkeypatch.setattr(network.WLAN, "bssid_reachable", False)
+    wifi = make_wifi(monkeypatch, CACHE)
+    assert wifi.connect() is wifi.wlan
+    assert wifi.timings["path"] == "full" and not wifi.static_ip
+    assert wifi.wlan.joins == [(False, AP_BSSID), (True, None)]
+    assert wifi.timings["total_ms"] >= config.WIFI_FAST_JOIN_TIMEOUT_MS + network.WLAN.dhcp_join_ms
+    assert saved_cache()["ifconfig"] == list(network.WLAN.lease)
+
+def test_borrowed_ip_is_leased_with_dhcp_soon_after(monkeypatch, clock):
+    wifi = make_wifi(monkeypatch, CACHE)
+    wifi.connect()
+    changes = []
+    uasyncio.create_task(wifi.supervise(on_link_change=changes.append))
+    uasyncio.run_for(config.WIFI_STATIC_IP_MAX_MS - 1)
+    assert wifi.static_ip and changes == []
+    
+    # However old the cached address is, it is only used until then
+    uasyncio.run_for(config.WIFI_CHECK_MS + network.WLAN.dhcp_join_ms + 100)
+    assert not wifi.static_ip and changes == [False, True]
+    assert wifi.wlan.joins[-1] == (True, None)
+    assert wifi.wlan.ifconfig() == network.WLAN.lease
+    assert saved_cache() == {"ssid": network.WLAN.ssid, "bssid": AP_BSSID.hex(),
+                             "ifconfig": list(network.WLAN.lease)}
@@ -1,35 +1,172 @@
 import network
 import time
 import machine
+import uasyncio as asyncio
+import ubinascii
+import ujson
+import config
 from secrets import WIFI_SSID, WIFI_PASSWORD
 from led_controller import LedController
 
+# CYW43 link status between association and DHCP completing
+LINK_NOIP = 2
+
 class WiFiManager:
-    def __init__(self, ssid=WIFI_SSID, password=WIFI_PASSWORD):
-        """Initialize WiFi manager with credentials."""
+    def __init__(self, ssid=WIFI_SSID, password=WIFI_PASSWORD, cache_path=config.WIFI_CACHE_FILE):
+        """Initialize WiFi manager with credentials.
+        
+        Args:
+            cache_path: File holding the last good BSSID and IP settings, or None
+        """
         self.ssid = ssid
         self.password = password
         self.wlan = network.WLAN(network.STA_IF)
         self.wlan.active(True)
         self.led = LedController()
+        self.cache_path = cache_path
+        self.cache = self._load_cache()
+        # True while using the cached IP settings instead of a DHCP lease,
+        # since static_since (ticks_ms)
+        self.static_ip = False
+        self.static_since = 0
+        # Phase timings of the last connect, in ms
+        self.timings = {}
+    
+    def _load_cache(self):
+        """Load the fast rejoin hints saved after the last successful full join."""
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path) as f:
+                cache = ujson.load(f)
+            if cache["ssid"] == self.ssid:
+                return cache
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+    
+    def _save_cache(self, scan=True):
+        """Save the AP's BSSID and the IP settings DHCP just leased us for the next fast rejoin.
+        
+        Args:
+            scan: Scan for the strongest AP's BSSID; otherwise the cached one is kept
+        """
+        if not self.cache_path:
+            return
+        bssid = None
+        if not scan:
+            bssid = self.cache["bssid"] if self.cache else None
+        else:
+            try:
+                # Pick the strongest AP with our SSID; cyw43 can't report the associated BSSID
+                best_rssi = None
+                for net in self.wlan.scan():
+                    if net[0].decode() == self.ssid and (best_rssi is None or net[3] > best_rssi):
+                        bssid = ubinascii.hexlify(net[1]).decode()
+                        best_rssi = net[3]
+            except Exception as e:
+                print("WiFi scan failed:", e)
+        
+        self.cache = {
+            "ssid": self.ssid,
+            "bssid": bssid,
+            "ifconfig": list(self.wlan.ifconfig())
+        }
+        try:
+            with open(self.cache_path, "w") as f:
+                ujson.dump(self.cache, f)
+        except OSError as e:
+            print("Could not save WiFi cache:", e)
+    
+    def _wait_connected(self, timeout_ms):
+        """Poll until connected, failed or timed out, recording phase timings.
+        
+        Returns:
+            True if connected
+        """
+        start = time.ticks_ms()
+        while True:
+            elapsed = time.ticks_diff(time.ticks_ms(), start)
+            if self.wlan.isconnected():
+                self.timings["ip_ms"] = elapsed
+                self.timings.setdefault("associate_ms", elapsed)
+                return True
+            
+            status = self.wlan.status()
+            if status == LINK_NOIP:
+                self.timings.setdefault("associate_ms", elapsed)
+            elif status < 0:
+                # Wrong password, no AP found or connect failure
+                print("WiFi join failed, status:", status)
+                return False
+            if elapsed >= timeout_ms:
+                return False
+            
+            # Blink LED while connecting
+            self.led.set_state((elapsed // 500) % 2 == 0)
+            time.sleep_ms(config.WIFI_POLL_MS)
+    
+    def _fast_join(self):
+        """Join using the cached BSSID and a static IP, skipping the scan and DHCP.
+        
+        Returns:
+            True if connected
+        """
+        print("WiFi fast join, IP:", self.cache["ifconfig"][0])
+        try:
+            self.wlan.ifconfig(tuple(self.cache["ifconfig"]))
+            if self.cache["bssid"]:
+                bssid = ubinascii.unhexlify(self.cache["bssid"])
+                self.wlan.connect(self.ssid, self.password, bssid=bssid)
+            else:
+                self.wlan.connect(self.ssid, self.password)
+            if self._wait_connected(config.WIFI_FAST_JOIN_TIMEOUT_MS):
+                self.static_ip = True
+                self.static_since = time.ticks_ms()
+                return True
+        except Exception as e:
+            print("WiFi fast join error:", e)
         
+        print("WiFi fast join failed, falling back to full join")
+        self.cache = None
+        self.timings = {}
+        try:
+            self.wlan.disconnect()
+            self.wlan.ifconfig("dhcp")
+        except Exception as e:
+            print("WiFi reset error:", e)
+        return False
+    
     def connect(self, max_wait=20, retry_count=3):
         """
         Connect to WiFi with retries.
         
+        Tries a fast join from cached settings first, then falls back to a
+        full scan, association and DHCP.
+        
         Args:
             max_wait: Maximum wait time in seconds for each connection attempt
-            retry_count: Number of connection retries before rebooting
-            
+            retry_count: Number of connection retries before giving up; the
+                supervisor keeps trying in the background after that
+        
         Returns:
-            WLAN interface object if connected
+            WLAN interface object if connected, None otherwise
         """
         if self.wlan.isconnected():
             print("Already connected to WiFi")
             print("IP address:", self.wlan.ifconfig()[0])
             self.led.on()  # Indicate successful connection
             return self.wlan
-            
+        
+        start = time.ticks_ms()
+        self.timings = {}
+        if self.cache and self._fast_join():
+            self.timings["path"] = "fast"
+            self.timings["total_ms"] = time.ticks_diff(time.ticks_ms(), start)
+            print("WiFi connected!", self.timings)
+            self.led.on()  # Indicate successful connection
+            return self.wlan
+        
         for attempt in range(retry_count):
             print(f"WiFi connection attempt {attempt+1}/{retry_count}")
             
@@ -38,34 +175,103 @@ class WiFiManager:
                 self.wlan.connect(self.ssid, self.password)
                 
                 # Wait for connection with timeout
-                for i in range(max_wait * 2):  # 0.5 second intervals
-                    if self.wlan.isconnected():
-                        print("WiFi connected!")
-                        print("IP address:", self.wlan.ifconfig()[0])
-                        self.led.on()  # Indicate successful connection
-                        return self.wlan
-                    time.sleep(0.5)
-                    # Blink LED while connecting
-                    if i % 2 == 0:
-                        self.led.on()
-                    else:
-                        self.led.off()
-                    print(f"Waiting for connection... {i+1}/{max_wait*2}")
+                if self._wait_connected(max_wait * 1000):
+                    self.timings["path"] = "full"
+                    self.timings["total_ms"] = time.ticks_diff(time.ticks_ms(), start)
+                    print("WiFi connected!", self.timings)
+                    print("IP address:", self.wlan.ifconfig()[0])
+                    self._save_cache()
+                    self.led.on()  # Indicate successful connection
+                    return self.wlan
                 
                 print(f"Connection attempt {attempt+1} timed out")
                 self.led.off()  # LED off on timeout
             except Exception as e:
                 print(f"Connection error: {e}")
                 self.led.off()  # LED off on error
-                
-        # If we've exhausted all retries, reboot
-        print("Failed to connect to WiFi after multiple attempts. Rebooting.")
+        
+        print("Failed to connect to WiFi after multiple attempts, continuing offline")
+        self.led.off()
+        return None
+    
+    async def _rejoin(self):
+        """Re-associate without blocking other tasks, taking a fresh DHCP lease.
+        
+        Returns:
+            True if connected
+        """
+        if self.static_ip:
+            # The cached address may have been handed to someone else by now
+            self.wlan.ifconfig("dhcp")
+            self.static_ip = False
+        self.wlan.connect(self.ssid, self.password)
+        start = time.ticks_ms()
+        while time.ticks_diff(time.ticks_ms(), start) < config.WIFI_MAX_WAIT * 1000:
+            status = self.wlan.status()
+            if status == network.STAT_GOT_IP:
+                # Keep the new lease for the next fast join
+                self._save_cache(scan=False)
+                return True
+            if status < 0:
+                return False
+            await asyncio.sleep_ms(config.WIFI_POLL_MS)
+        return False
+    
+    def _reboot(self):
+        """Reboot as a last resort after a long outage."""
+        print("WiFi down for too long. Rebooting.")
         # Rapidly blink LED to indicate reboot
         for _ in range(5):
             self.led.toggle()
             time.sleep(0.1)
         time.sleep(2)
         machine.reset()
+    
+    async def supervise(self, on_link_change=None):
+        """Watch the link and re-associate in the background with backoff.
+        
+        Args:
+            on_link_change: Callback for link changes (receives up(bool))
+        """
+        was_up = self.wlan.isconnected()
+        outage_start = None if was_up else time.ticks_ms()
+        retry_delay_ms = config.WIFI_RECONNECT_MIN_MS
+        while True:
+            if self.wlan.status() == network.STAT_GOT_IP:
+                if not was_up:
+                    print("WiFi link restored, IP:", self.wlan.ifconfig()[0])
+                    was_up = True
+                    outage_start = None
+                    retry_delay_ms = config.WIFI_RECONNECT_MIN_MS
+                    if on_link_change:
+                        on_link_change(True)
+                if self.static_ip and time.ticks_diff(time.ticks_ms(), self.static_since) >= config.WIFI_STATIC_IP_MAX_MS:
+                    # The cached address was leased at some unknown time (the
+                    # RTC restarts from its default date on every boot), so
+                    # only borrow it to get going and take a real lease soon
+                    print("WiFi rejoining with DHCP to lease the cached IP")
+                    self.wlan.ifconfig("dhcp")
+                    self.static_ip = False
+                    self.wlan.disconnect()
+                await asyncio.sleep_ms(config.WIFI_CHECK_MS)
+                continue
+            
+            if was_up:
+                print("WiFi link lost, status:", self.wlan.status())
+                was_up = False
+                outage_start = time.ticks_ms()
+                if on_link_change:
+                    on_link_change(False)
+            
+            outage_ms = time.ticks_diff(time.ticks_ms(), outage_start)
+            if config.WIFI_MAX_OUTAGE_S and outage_ms >= config.WIFI_MAX_OUTAGE_S * 1000:
+                self._reboot()
+            
+            if await self._rejoin():
+                continue
+            print("WiFi rejoin failed, retrying in", retry_delay_ms, "ms")
+            await asyncio.sleep_ms(retry_delay_ms)
+            retry_delay_ms = min(retry_delay_ms * 2, config.WIFI_RECONNECT_MAX_MS)
 
 # For backward compatibility
 def connect(max_wait=20):